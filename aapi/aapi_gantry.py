@@ -7,6 +7,7 @@ from collections import defaultdict
 import xml.etree.ElementTree as Et
 from AAPI import *
 import gantryinterface as gi
+import measurement_codec as mc
 import threading
 from gantry import GantryServer, GantryLoopDetector, GantryRegulatorySign
 import logging
@@ -30,6 +31,7 @@ logger.addHandler(fh)
 class Globals(object):
     """Global parameters of the AAPI module"""
     detectors = []
+    detector_schema = []
     detection_time = 0.0
     detection_interval = 0.0
     gantry_servers = dict()
@@ -624,6 +626,10 @@ def AAPIInit():
             #
             AKIPrintString("  [%d] %d / `%s`" % (pos, id_object, name))
 
+        # Static descriptors of the reported detectors. The order corresponds to the order of
+        # measured values sent at every detection interval.
+        GLOBALS.detector_schema = [(name, GLOBALS.gantry_ld_map[name]) for (id_object, name) in GLOBALS.detectors]
+
         #
         #  List all gantries.
         #
@@ -668,11 +674,11 @@ def AAPIManage(timeSim, timeSta, timTrans, acicle):
     try:
         # This loop will exit on Exception in the moment that the data queue is empty
         while True:
-            id_gantry_server, command = INTERFACE.get_command()
-            logger.debug("gantry server %s command %s" % (id_gantry_server, repr(command)))
-            GLOBALS.gantry_servers[id_gantry_server].process_command(command)
-            gantry_update_set.add(id_gantry_server)
-            got_data = True
+            for id_gantry_server, command in INTERFACE.get_command_batch():
+                logger.debug("gantry server %s command %s" % (id_gantry_server, repr(command)))
+                GLOBALS.gantry_servers[id_gantry_server].process_command(command)
+                gantry_update_set.add(id_gantry_server)
+                got_data = True
     except gi.NoData:
         if got_data:
             AKIPrintString("[%f,%f,%f,%f] no further data available" % (timeSim, timeSta, timTrans, acicle))
@@ -710,58 +716,57 @@ def AAPIPostManage(timeSim, timeSta, timTrans, acicle):
         # where `timeSim` is greater (not greater or equal) than a multiple of T.
         if timeSim > GLOBALS.detection_time:
             logger.debug("AAPIPostManage reading out detectors:")
-            # Read all detectors for all vehicles
-            dets = []
-            for (id_detector, name) in GLOBALS.detectors:
+            # Read all detectors for all vehicles into a flat array of values, see measurement_codec.py
+            values = mc.new_values(len(GLOBALS.detectors))
+            for pos_detector, (id_detector, name) in enumerate(GLOBALS.detectors):
                 logger.debug("  id:%d (%s) - count, speed, occupancy" % (id_detector, name))
+                base = pos_detector * mc.VALUES_PER_DETECTOR
                 # Default: vehicle class 0 (other vehicles) is always zero.
-                count = {0: 0}
-                speed = {0: 0}
-                occup = {0: 0}
-                for id_vehicletype in xrange(GLOBALS.num_vehicle_types + 1):
+                values[base + mc.COUNT] = 0
+                values[base + mc.SPEED] = 0
+                values[base + mc.OCCUPANCY] = 0
+                # Aimsun vehicle type N goes to SIRID class N+1, types that do not fit are ignored
+                for id_vehicletype in xrange(min(GLOBALS.num_vehicle_types + 1, mc.NUM_CLASSES - 1)):
+                    pos = base + (id_vehicletype + 1) * mc.NUM_QUANTITIES
                     # Vehicle counts
                     count_val = AKIDetGetCounterAggregatedbyId(id_detector, id_vehicletype)
                     if count_val < 0:
                         logger.error("AKIDetGetCounterAggregatedbyId(%d,%d) returns error code %d" % (
                             id_detector, id_vehicletype, count_val))
-                    count[id_vehicletype + 1] = count_val
+                    values[pos + mc.COUNT] = count_val
                     # Vehicle speeds
                     speed_val = AKIDetGetSpeedAggregatedbyId(id_detector, id_vehicletype)
                     if speed_val < 0:
                         logger.error("AKIDetGetSpeedAggregatedbyId(%d,%d) returns error code %d" % (
                             id_detector, id_vehicletype, speed_val))
-                    speed[id_vehicletype + 1] = speed_val
+                    values[pos + mc.SPEED] = speed_val
                     # Detector occupancies
                     occup_val = AKIDetGetTimeOccupedAggregatedbyId(id_detector, id_vehicletype)
                     if occup_val < 0:
                         logger.error("AKIDetGetTimeOccupedAggregatedbyId(%d,%d) returns error code %d" % (
                             id_detector, id_vehicletype, occup_val))
-                    occup[id_vehicletype + 1] = occup_val
+                    values[pos + mc.OCCUPANCY] = occup_val
                 # Vehicle type 0 which goes to index 1 is treated as "motorcycle" in SIRID, but the original zero
                 # index means all vehicle in Aimsun. SIRID indexes this information as vehicle class 9.
                 # TODO: Check the names of vehicle classes so that te classes may be mapped correctly
-                count[9] = count[1]
-                speed[9] = speed[1]
-                occup[9] = occup[1]
+                pos_all = base + 9 * mc.NUM_QUANTITIES
+                pos_mot = base + 1 * mc.NUM_QUANTITIES
+                values[pos_all:pos_all + mc.NUM_QUANTITIES] = values[pos_mot:pos_mot + mc.NUM_QUANTITIES]
                 # Index 1 in SIRID denotes motorcycles and we do not simulate motorcycles.
-                count[1] = 0
-                speed[1] = 0
-                occup[1] = 0
+                values[pos_mot + mc.COUNT] = 0
+                values[pos_mot + mc.SPEED] = 0
+                values[pos_mot + mc.OCCUPANCY] = 0
                 # Display debug output where vehicle classes are those expected by SIRID subsystem
-                for id_vehicletype in xrange(10):
-                    logger.debug("    [%d] %d %f %f" % (
-                        id_vehicletype, count[id_vehicletype], speed[id_vehicletype], occup[id_vehicletype]))
-                try:
-                    dets.append((name, GLOBALS.gantry_ld_map[name], (count, speed, occup)))
-                except KeyError as e:
-                    logger.exception("Cannot append detector info")
+                for id_vehicletype in xrange(mc.NUM_CLASSES):
+                    pos = base + id_vehicletype * mc.NUM_QUANTITIES
+                    logger.debug("    [%d] %f %f %f" % (
+                        id_vehicletype, values[pos + mc.COUNT], values[pos + mc.SPEED], values[pos + mc.OCCUPANCY]))
 
             time_tuple = time.localtime(GLOBALS.time_offset + timeSim - timTrans)
             time_str = time.strftime("%Y-%m-%d %H:%M:%S", time_tuple)
-            measurements = (time_str, dets)
-            AKIPrintString("Data at %.1fs: %s" % (timeSim, repr(dets)))
+            AKIPrintString("Data at %.1fs: %s" % (timeSim, repr(values)))
             logger.debug("dispatching data at %.1f seconds" % timeSim)
-            INTERFACE.put_measurements(measurements)
+            INTERFACE.put_measurements(time_str, GLOBALS.detector_schema, values)
             # Move last detection time
             GLOBALS.detection_time += GLOBALS.detection_interval
             AKIPrintString("Next detection time: %fs" % GLOBALS.detection_time)
@@ -783,6 +788,8 @@ def AAPIFinish():
     #global fout
     #fout.close()
     AKIPrintString("AAPIFinish()")
+    # Do not lose the measurements still waiting in the send queue
+    INTERFACE.close()
     return 0
 
 
@@ -0,0 +1,264 @@
+#!/usr/bin/python
+#
+# Columnar archive of the detector measurements of a replication
+#
+# The server appends the measurements of every detection interval to an archive of the
+# replication, so that runs can be analysed offline without scraping sirid_server.log or the
+# long_status documents received by the controllers. An archive consists of two files in the
+# archive directory:
+#
+#   replication_<id>_<YYYYmmdd-HHMMSS>.values   the value arrays of the intervals, one row per
+#                                               interval with the layout of `measurement_codec`
+#                                               (detectors x NUM_CLASSES x count/speed/occupancy)
+#                                               as little-endian doubles, NaN for missing values
+#   replication_<id>_<YYYYmmdd-HHMMSS>.index    sidecar index: a JSON header describing the
+#                                               layout and the detectors on the first line, then
+#                                               a `seq_nr<TAB>time stamp` line per interval
+#
+# The row is written before its index line, so after a crash the reader takes the intervals
+# present in both files. A new archive is started when the detector schema changes.
+#
+# ArchiveWriter runs in the server (Python 2.6, no NumPy) and writes from a thread of its
+# own. ArchiveReader memory-maps the values with NumPy and returns views over the file, so
+# that opening an archive of a multi-hour run reads only the index:
+#
+#   reader = archive.ArchiveReader('archive/replication_123_20150601-073000.index')
+#   speed = reader.speed[:, reader.detector_index('LD30815'), 2]    # cars on LD30815
+#
+# Running this module prints a summary of the archives given on the command line.
+#
+import json
+import os
+import Queue
+import sys
+import threading
+import time
+from array import array
+import linkstats
+import measurement_codec as mc
+
+ARCHIVE_VERSION = 1
+# Data type of the values in NumPy notation
+VALUES_DTYPE = '<f8'
+VALUES_SUFFIX = '.values'
+INDEX_SUFFIX = '.index'
+QUANTITY_NAMES = ['count', 'speed', 'occupancy']
+
+
+def archive_header(schema, replication_id):
+    """Return the header of the index of an archive of measurements with the schema.
+
+    :param schema: list of `(name, gantry_ld_map tuple)` detector descriptors
+    :rtype : dict
+    """
+    detectors = []
+    for det_name, det_map in schema:
+        id_gantry_server, id_device, device_type, id_sub_device, \
+            sub_device_type, sub_device_description, id_lane, det_type, str_lane, prefix = det_map
+        detectors.append({'name': det_name, 'gantry_server': id_gantry_server, 'device': id_device,
+                          'subdevice': id_sub_device, 'lane': id_lane, 'type': det_type, 'str_lane': str_lane})
+    return {'version': ARCHIVE_VERSION, 'replication': replication_id, 'dtype': VALUES_DTYPE,
+            'classes': mc.NUM_CLASSES, 'quantities': QUANTITY_NAMES, 'detectors': detectors,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def archive_paths(path):
+    """Return the paths of the value file and of the index of the archive `path`, which may
+    be either of them or their common prefix."""
+    base, ext = os.path.splitext(path)
+    if ext not in (VALUES_SUFFIX, INDEX_SUFFIX):
+        base = path
+    return base + VALUES_SUFFIX, base + INDEX_SUFFIX
+
+
+class ArchiveWriter(object):
+    """Thread appending the measurements of a replication to archives in `directory`."""
+
+    def __init__(self, directory, replication_id, logger=None):
+        self.directory = directory
+        self.replication_id = replication_id
+        self.logger = logger
+        self.counters = linkstats.Counters()
+        self.path = None
+        self._schema = None
+        self._values_file = None
+        self._index_file = None
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='archive')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def add(self, schema, seq_nr, time_str, values):
+        """Queue the measurements of a detection interval for archiving. Never blocks on the
+        disk.
+
+        :param values: flat value array, see `measurement_codec`
+        """
+        self._queue.put((schema, seq_nr, time_str, values))
+
+    def _open(self, schema):
+        """Close the current archive and start a new one for the schema."""
+        self._close_files()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        base = os.path.join(self.directory, 'replication_%d_%s' % (self.replication_id,
+                                                                  time.strftime('%Y%m%d-%H%M%S')))
+        path = base
+        suffix = 1
+        while os.path.exists(path + INDEX_SUFFIX):
+            path = '%s_%d' % (base, suffix)
+            suffix += 1
+        self._values_file = open(path + VALUES_SUFFIX, 'wb')
+        self._index_file = open(path + INDEX_SUFFIX, 'w')
+        self._index_file.write(json.dumps(archive_header(schema, self.replication_id), sort_keys=True) + '\n')
+        self._index_file.flush()
+        self._schema = schema
+        self.path = path
+        self.counters.add('archives')
+        if self.logger is not None:
+            self.logger.info('archiving measurements of %d detectors into %s' % (len(schema), path))
+
+    def _write(self, schema, seq_nr, time_str, values):
+        if self._values_file is None or (schema is not self._schema and schema != self._schema):
+            self._open(schema)
+        if not isinstance(values, array) or values.typecode != 'd':
+            values = array('d', values)
+        if sys.byteorder != 'little':
+            values = array('d', values)
+            values.byteswap()
+        values.tofile(self._values_file)
+        self._values_file.flush()
+        self._index_file.write('%d\t%s\n' % (seq_nr, time_str))
+        self._index_file.flush()
+        self.counters.add('intervals_archived')
+        self.counters.add('bytes_archived', len(values) * values.itemsize)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._close_files()
+                return
+            try:
+                self._write(*item)
+            except (IOError, OSError) as e:
+                self.counters.add('write_errors')
+                if self.logger is not None:
+                    self.logger.error('cannot archive measurements of interval %d: %s' % (item[1], e))
+                # Start a new archive with the next interval
+                self._close_files()
+
+    def _close_files(self):
+        for fhandle in (self._values_file, self._index_file):
+            if fhandle is not None:
+                try:
+                    fhandle.close()
+                except IOError:
+                    pass
+        self._values_file = self._index_file = None
+
+    def close(self, timeout=None):
+        """Write the queued intervals and close the archive."""
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def get_stats(self):
+        """Return the archive statistics.
+
+        :rtype : dict
+        """
+        stats = self.counters.snapshot()
+        stats['queued'] = self._queue.qsize()
+        return stats
+
+
+class ArchiveReader(object):
+    """An archive opened for analysis. The values are NumPy views of the memory-mapped file:
+    `values` has the shape `(intervals, detectors, NUM_CLASSES, 3)`, and `count`, `speed` and
+    `occupancy` the shape `(intervals, detectors, NUM_CLASSES)`."""
+
+    def __init__(self, path):
+        import numpy
+        self.values_path, self.index_path = archive_paths(path)
+        fhandle = open(self.index_path, 'r')
+        try:
+            self.header = json.loads(fhandle.readline())
+            if self.header.get('version') != ARCHIVE_VERSION:
+                raise ValueError('Unsupported archive version %s' % repr(self.header.get('version')))
+            self.seq_nrs = []
+            self.times = []
+            for line in fhandle:
+                if not line.endswith('\n'):
+                    # An index line being written
+                    break
+                seq_nr, time_str = line.rstrip('\n').split('\t', 1)
+                self.seq_nrs.append(int(seq_nr))
+                self.times.append(time_str)
+        finally:
+            fhandle.close()
+        self.detectors = [detector['name'] for detector in self.header['detectors']]
+        self._detector_positions = dict([(name, pos) for pos, name in enumerate(self.detectors)])
+        row_shape = (len(self.detectors), self.header['classes'], len(self.header['quantities']))
+        dtype = numpy.dtype(self.header['dtype'])
+        row_size = dtype.itemsize * row_shape[0] * row_shape[1] * row_shape[2]
+        # Only the intervals present both in the value file and in the index
+        num_intervals = len(self.seq_nrs)
+        if row_size:
+            num_intervals = min(num_intervals, os.path.getsize(self.values_path) // row_size)
+        del self.seq_nrs[num_intervals:]
+        del self.times[num_intervals:]
+        if num_intervals and row_size:
+            self.values = numpy.memmap(self.values_path, dtype=dtype, mode='r',
+                                       shape=(num_intervals,) + row_shape)
+        else:
+            # An empty file cannot be mapped
+            self.values = numpy.zeros((num_intervals,) + row_shape, dtype=dtype)
+        self.count = self.values[..., mc.COUNT]
+        self.speed = self.values[..., mc.SPEED]
+        self.occupancy = self.values[..., mc.OCCUPANCY]
+
+    def __len__(self):
+        return len(self.seq_nrs)
+
+    def detector_index(self, name):
+        """Return the position of the detector `name` on the detector axis."""
+        try:
+            return self._detector_positions[name]
+        except KeyError:
+            raise KeyError('Detector %s is not in the archive' % name)
+
+    def detector(self, name):
+        """Return the values of the detector as a view of the shape `(intervals, NUM_CLASSES, 3)`."""
+        return self.values[:, self.detector_index(name)]
+
+
+def list_archives(directory):
+    """Return the paths of the archives in the directory, oldest first."""
+    paths = []
+    for name in os.listdir(directory):
+        if name.endswith(INDEX_SUFFIX):
+            path = os.path.join(directory, name[:-len(INDEX_SUFFIX)])
+            paths.append((os.path.getmtime(path + INDEX_SUFFIX), path))
+    paths.sort()
+    return [path for mtime, path in paths]
+
+
+def main(argv):
+    if len(argv) < 2:
+        print 'Usage: python archive.py ARCHIVE_OR_DIRECTORY ...'
+        return
+    for arg in argv[1:]:
+        paths = [arg]
+        if os.path.isdir(arg):
+            paths = list_archives(arg)
+        for path in paths:
+            reader = ArchiveReader(path)
+            print '%s: replication %s, %d detectors, %d intervals' % (
+                path, reader.header['replication'], len(reader.detectors), len(reader))
+            if len(reader):
+                print '   %s (%d) .. %s (%d)' % (reader.times[0], reader.seq_nrs[0], reader.times[-1],
+                                                reader.seq_nrs[-1])
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+#
+# Benchmark of the measurement codecs used on the Aimsun -> SIRID server link.
+#
+# Compares the legacy pickled `(time_str, dets)` tuple with the binary interval packet of
+# `measurement_codec` in terms of encoding time, decoding time and packet size. The detector
+# set is taken from the network description and may be replicated to emulate larger networks.
+#
+# Usage: python benchmark_codec.py [network.xml] [replication_factor] [repetitions]
+#
+import os
+import pickle
+import random
+import sys
+import time
+import measurement_codec as mc
+
+DEFAULT_NETWORK = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../sokp/sokp_v7.xml')
+
+
+def make_schema(network_path, factor):
+    """Return the detector schema of the network replicated `factor` times."""
+    schema = mc.load_schema(network_path)
+    replicated = []
+    for i in xrange(factor):
+        for name, det_map in schema:
+            replicated.append(('%s_%d' % (name, i), det_map))
+    return replicated
+
+
+def make_values(num_detectors):
+    """Return random measurements with the same shape as those produced by aapi_gantry.py"""
+    values = mc.new_values(num_detectors)
+    for pos_detector in xrange(num_detectors):
+        for id_class in xrange(mc.NUM_CLASSES):
+            pos = mc.value_index(pos_detector, id_class, 0)
+            values[pos + mc.COUNT] = random.randint(0, 30)
+            values[pos + mc.SPEED] = random.uniform(0.0, 130.0)
+            values[pos + mc.OCCUPANCY] = random.uniform(0.0, 100.0)
+    return values
+
+
+def timeit(function, repetitions):
+    start = time.time()
+    for i in xrange(repetitions):
+        result = function()
+    return (time.time() - start) / repetitions, result
+
+
+def main(argv):
+    network_path = DEFAULT_NETWORK
+    factor = 1
+    repetitions = 200
+    if len(argv) > 1:
+        network_path = argv[1]
+    if len(argv) > 2:
+        factor = int(argv[2])
+    if len(argv) > 3:
+        repetitions = int(argv[3])
+
+    schema = make_schema(network_path, factor)
+    values = make_values(len(schema))
+    time_str = '2014-08-13 15:57:10'
+    dets = mc.values_to_dicts(schema, values)
+    id_schema = mc.schema_id(schema)
+
+    t_pickle_enc, pickle_data = timeit(lambda: pickle.dumps((time_str, dets), -1), repetitions)
+    t_pickle_dec, unused = timeit(lambda: pickle.loads(pickle_data), repetitions)
+    t_binary_enc, binary_data = timeit(lambda: mc.encode_interval(id_schema, time_str, values), repetitions)
+    t_binary_dec, unused = timeit(lambda: mc.decode_interval(buffer(binary_data)), repetitions)
+    schema_size = len(mc.encode_schema(schema))
+
+    print '%d detectors, %d repetitions' % (len(schema), repetitions)
+    print '%-8s %14s %14s %12s' % ('codec', 'encode [us]', 'decode [us]', 'size [B]')
+    print '%-8s %14.1f %14.1f %12d' % ('pickle', 1e6 * t_pickle_enc, 1e6 * t_pickle_dec, len(pickle_data))
+    print '%-8s %14.1f %14.1f %12d' % ('binary', 1e6 * t_binary_enc, 1e6 * t_binary_dec, len(binary_data))
+    print 'one-time schema packet: %d bytes' % schema_size
+
+
+if __name__ == "__main__":
+    main(sys.argv)
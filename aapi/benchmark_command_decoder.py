@@ -0,0 +1,135 @@
+#!/usr/bin/python
+#
+# Benchmark of the decoding of command stanzas.
+#
+# Compares the shared decoder of gantry_command with the former nested walk of the element
+# tree, on the command stanza of `xml_test_packet_1.xml` with its <gantry>
+# elements repeated to make it larger (100 times by default):
+# - `tree + walk`          Et.fromstring() and the walk of the tree (the former parser),
+# - `cElementTree + walk`  the same with the C implementation of ElementTree,
+# - `framer tree + walk`   the streaming framer building the tree and the walk (the former
+#                          path of the server),
+# - `decoder`              gantry_command.decode_command_stanza(), the C parser and a single
+#                          pass collecting the command tuples into a CommandBatch,
+# - `framer decoder`       the streaming framer only splitting the stream and the decoder
+#                          (the current path of the server).
+# Every variant produces the list of command tuples passed on to Aimsun.
+#
+# The decoder is as fast as `cElementTree + walk`: its speed-up over the former parser comes
+# entirely from the C implementation of ElementTree. The gain of the server path (`framer
+# decoder` against `framer tree + walk`) is that the framer no longer builds a Python tree
+# of the command stanzas.
+#
+# Usage: python benchmark_command_decoder.py [scale] [repetitions]
+#
+import os
+import re
+import sys
+import time
+import xml.etree.ElementTree as Et
+import xml.etree.cElementTree as CEt
+import gantry_command
+import linkstats
+import xml_framer
+
+AAPI_DIR = os.path.dirname(os.path.abspath(__file__))
+COMMAND_XML = os.path.join(AAPI_DIR, 'xml_test_packet_1.xml')
+
+
+def load_command_stanza(scale):
+    """Return the command stanza of the test packet with its <gantry> elements repeated
+    `scale` times."""
+    data = open(COMMAND_XML, 'rb').read()
+    for root, xml_string in xml_framer.make_framer(xml_framer.FRAMER_STREAMING, build_tree=False).feed(data):
+        if gantry_command.is_command_stanza(xml_string):
+            match = re.search('<root>(.*)</root>', xml_string, re.DOTALL)
+            return xml_string[:match.start(1)] + match.group(1) * scale + xml_string[match.end(1):]
+    raise ValueError('no command stanza in %s' % COMMAND_XML)
+
+
+def walk_tree(root):
+    """The former nested walk of the command tree, without its console output."""
+    commands = []
+    for gantry_node in root:
+        if gantry_node.tag != "gantry":
+            raise ValueError('Expected <gantry> tag, got <%s>' % gantry_node.tag)
+        id_gantry_server = gantry_node.attrib['id']
+        for device_node in gantry_node:
+            if device_node.tag != 'device':
+                raise ValueError('Expected <device> tag, got <%s>' % device_node.tag)
+            id_device = int(device_node.attrib['id'])
+            for sub_device_node in device_node:
+                if sub_device_node.tag != 'subdevice':
+                    raise ValueError('Expected <subdevice> tag, got <%s>' % sub_device_node.tag)
+                id_sub_device = int(sub_device_node.attrib['id'])
+                if len(sub_device_node) != 1:
+                    raise ValueError('Node <subdevice> has more than one child node')
+                command_node = sub_device_node[0]
+                if command_node.tag != 'command':
+                    raise ValueError('Expected <command> tag, got <%s>' % command_node.tag)
+                validity = int(command_node.attrib['validity'])
+                if len(command_node) > 2:
+                    raise ValueError('Node <command> has more than two child nodes')
+                symbol_node = command_node.find("symbol")
+                if symbol_node is not None:
+                    commands.append((id_gantry_server, (id_device, id_sub_device, int(symbol_node.text), validity)))
+    return commands
+
+
+def tree_and_walk(stanza):
+    return walk_tree(Et.fromstring(stanza))
+
+
+def c_tree_and_walk(stanza):
+    return walk_tree(CEt.fromstring(stanza))
+
+
+def framer_tree_and_walk(stanza):
+    for root, xml_string in xml_framer.make_framer(xml_framer.FRAMER_STREAMING).feed(stanza):
+        return walk_tree(root)
+
+
+def decoder(stanza):
+    return gantry_command.decode_command_stanza(stanza).commands()
+
+
+def framer_decoder(stanza):
+    framer = xml_framer.make_framer(xml_framer.FRAMER_STREAMING, decode_commands=True)
+    for root, xml_string in framer.feed(stanza):
+        return gantry_command.decode_command_stanza(xml_string).commands()
+
+
+VARIANTS = (('tree + walk', tree_and_walk), ('cElementTree + walk', c_tree_and_walk),
+            ('framer tree + walk', framer_tree_and_walk), ('decoder', decoder), ('framer decoder', framer_decoder))
+
+
+def main(argv):
+    scale = 100
+    repetitions = 20
+    if len(argv) > 1:
+        scale = int(argv[1])
+    if len(argv) > 2:
+        repetitions = int(argv[2])
+    stanza = load_command_stanza(scale)
+    expected = tree_and_walk(stanza)
+    print 'command stanza scaled %dx: %d bytes, %d commands, %d repetitions' % (
+        scale, len(stanza), len(expected), repetitions)
+    print '%-20s %9s %9s %9s %12s' % ('variant', 'p50 [ms]', 'max [ms]', 'speed-up', 'commands/s')
+    reference = None
+    for label, decode in VARIANTS:
+        if decode(stanza) != expected:
+            raise ValueError('%s decodes different commands' % label)
+        latencies = linkstats.RollingPercentiles(repetitions)
+        for i in xrange(repetitions):
+            start = time.time()
+            decode(stanza)
+            latencies.add(time.time() - start)
+        stats = latencies.snapshot()
+        if reference is None:
+            reference = stats['p50']
+        print '%-20s %9.2f %9.2f %8.2fx %12.0f' % (label, 1000.0 * stats['p50'], 1000.0 * stats['max'],
+                                                   reference / stats['p50'], len(expected) / stats['p50'])
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+#
+# Benchmark of the command parser pool of the SIRID server.
+#
+# Measures the latency of a command stanza from its arrival on the controller connection
+# until its command batch packet is ready for Aimsun, parsed either in place (the framer
+# builds the element tree and the connection thread validates it) or by a worker process of
+# a multiprocessing pool (the framer only splits the stream). Both variants run once on an
+# idle server and once while another thread renders long_status documents back to back, as
+# the Aimsun receiver thread does during the measurement fan-out.
+#
+# Usage: python benchmark_command_pool.py [network.xml] [stanzas] [workers]
+#
+import os
+import random
+import re
+import sys
+import threading
+import time
+import multiprocessing
+import gantry_command
+import linkstats
+import long_status
+import measurement_codec as mc
+import packet
+import xml_framer
+
+AAPI_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_NETWORK = os.path.join(AAPI_DIR, '../sokp/sokp_v7.xml')
+COMMAND_XML = os.path.join(AAPI_DIR, 'xml_test_packet_1.xml')
+# Seconds between two command stanzas of the controller
+COMMAND_PERIOD = 0.01
+
+
+def load_command_stanza():
+    """Return the command batch of the test packet without the <addsymbol> nodes, whose
+    warnings would flood the console."""
+    data = open(COMMAND_XML, 'rb').read()
+    for root, xml_string in xml_framer.make_framer(xml_framer.FRAMER_STREAMING, build_tree=False).feed(data):
+        if gantry_command.is_command_stanza(xml_string):
+            return re.sub('<addsymbol>[^<]*</addsymbol>', '', xml_string)
+    raise ValueError('no command stanza in %s' % COMMAND_XML)
+
+
+class FanOut(threading.Thread):
+    """Renders long_status documents of the network until stopped."""
+
+    def __init__(self, schema):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.schema = schema
+        self.values = mc.new_values(len(schema))
+        for pos in xrange(len(self.values)):
+            self.values[pos] = random.uniform(0.0, 100.0)
+        self.running = True
+        self.documents = 0
+
+    def run(self):
+        while self.running:
+            long_status.render_long_status(self.schema, '2015-07-23 12:00:00', self.values, self.documents)
+            self.documents += 1
+
+
+def command_in_place(stanza):
+    framer = xml_framer.make_framer(xml_framer.FRAMER_STREAMING)
+    for root, xml_string in framer.feed(stanza):
+        commands, errors = gantry_command.commands_from_root(root)
+        return packet.encode_command_batch(commands)
+
+
+def command_in_pool(stanza, pool):
+    framer = xml_framer.make_framer(xml_framer.FRAMER_STREAMING, build_tree=False)
+    for root, xml_string in framer.feed(stanza):
+        commands, errors = pool.apply(gantry_command.parse_command_stanza, (xml_string,))
+        return packet.encode_command_batch(commands)
+
+
+def run(process, stanza, num_stanzas, schema):
+    """Return the latency statistics of `num_stanzas` stanzas and the number of long_status
+    documents rendered meanwhile (None without the fan-out)."""
+    fan_out = None
+    if schema is not None:
+        fan_out = FanOut(schema)
+        fan_out.start()
+    latencies = linkstats.RollingPercentiles(num_stanzas)
+    for i in xrange(num_stanzas):
+        start = time.time()
+        process(stanza)
+        latencies.add(time.time() - start)
+        time.sleep(COMMAND_PERIOD)
+    documents = None
+    if fan_out is not None:
+        fan_out.running = False
+        fan_out.join()
+        documents = fan_out.documents
+    return latencies.snapshot(), documents
+
+
+def main(argv):
+    network_path = DEFAULT_NETWORK
+    num_stanzas = 200
+    workers = 2
+    if len(argv) > 1:
+        network_path = argv[1]
+    if len(argv) > 2:
+        num_stanzas = int(argv[2])
+    if len(argv) > 3:
+        workers = int(argv[3])
+    schema = mc.load_schema(network_path)
+    stanza = load_command_stanza()
+    pool = multiprocessing.Pool(workers)
+    # Start the workers before measuring
+    pool.apply(gantry_command.parse_command_stanza, (stanza,))
+
+    print '%d stanzas of %d bytes every %.0f ms, %d detectors, %d workers, %d CPUs' % (
+        num_stanzas, len(stanza), 1000.0 * COMMAND_PERIOD, len(schema), workers, multiprocessing.cpu_count())
+    print '%-10s %-8s %9s %9s %9s %9s %10s' % ('parsing', 'fan-out', 'p50 [ms]', 'p95 [ms]', 'p99 [ms]',
+                                              'max [ms]', 'documents')
+    variants = (('in place', command_in_place), ('pool', lambda data: command_in_pool(data, pool)))
+    for fan_out_schema, fan_out_label in ((None, 'idle'), (schema, 'busy')):
+        for label, process in variants:
+            stats, documents = run(process, stanza, num_stanzas, fan_out_schema)
+            if documents is None:
+                documents = '-'
+            print '%-10s %-8s %9.2f %9.2f %9.2f %9.2f %10s' % (
+                label, fan_out_label, 1000.0 * stats['p50'], 1000.0 * stats['p95'], 1000.0 * stats['p99'],
+                1000.0 * stats['max'], documents)
+    pool.close()
+    pool.join()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
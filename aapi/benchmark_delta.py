@@ -0,0 +1,67 @@
+#!/usr/bin/python
+#
+# Benchmark of the delta long_status documents.
+#
+# Renders the full long_status document of the network and delta documents against it with
+# a varying share of the detectors reporting changed values, and compares their size and
+# rendering time.
+#
+# Usage: python benchmark_delta.py [network.xml] [repetitions]
+#
+import logging
+import os
+import random
+import sys
+import time
+from array import array
+import benchmark_codec
+import long_status
+import measurement_codec as mc
+
+DEFAULT_NETWORK = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../sokp/sokp_v7.xml')
+TIME_STR = '2015-07-23 12:00:00'
+CHANGED_SHARES = (0.0, 0.01, 0.1, 0.25, 0.5, 1.0)
+
+
+def changed_values(values, share):
+    """Return a copy of the values with the measurements of `share` of the detectors changed
+    in one category."""
+    num_detectors = len(values) // mc.VALUES_PER_DETECTOR
+    changed = array('d', values)
+    for pos_detector in random.sample(xrange(num_detectors), int(round(share * num_detectors))):
+        pos = mc.value_index(pos_detector, random.randrange(long_status.NUM_CATEGORIES), mc.COUNT)
+        changed[pos] += 1
+    return changed
+
+
+def timeit(function, repetitions):
+    start = time.time()
+    for i in xrange(repetitions):
+        result = function()
+    return (time.time() - start) / repetitions, result
+
+
+def main(argv):
+    network_path = DEFAULT_NETWORK
+    repetitions = 100
+    if len(argv) > 1:
+        network_path = argv[1]
+    if len(argv) > 2:
+        repetitions = int(argv[2])
+    logging.basicConfig(level=logging.ERROR)
+    schema = mc.load_schema(network_path)
+    base_values = benchmark_codec.make_values(len(schema))
+    template = long_status.LongStatusTemplate(schema)
+    full_time, full = timeit(lambda: template.render(TIME_STR, base_values, 2), repetitions)
+
+    print '%d detectors, full document %d bytes rendered in %.2f ms' % (len(schema), len(full), 1000.0 * full_time)
+    print '%8s %10s %8s %10s %8s' % ('changed', 'bytes', 'size', 'time [ms]', 'time')
+    for share in CHANGED_SHARES:
+        values = changed_values(base_values, share)
+        delta_time, delta = timeit(lambda: template.render_delta(TIME_STR, values, 2, base_values, 1), repetitions)
+        print '%7.0f%% %10d %7.1f%% %10.3f %7.1f%%' % (100.0 * share, len(delta), 100.0 * len(delta) / len(full),
+                                                    1000.0 * delta_time, 100.0 * delta_time / full_time)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
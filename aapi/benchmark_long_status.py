@@ -0,0 +1,66 @@
+#!/usr/bin/python
+#
+# Benchmark of the rendering of long_status documents.
+#
+# Compares the reference renderer (element tree pretty-printed by minidom) with the compiled
+# LongStatusTemplate on the detector set of the network, checks that both produce the same
+# bytes and reports the time needed to compile the template once per schema.
+#
+# Usage: python benchmark_long_status.py [network.xml] [repetitions]
+#
+import logging
+import os
+import sys
+import time
+import benchmark_codec
+import linkstats
+import long_status
+import measurement_codec as mc
+
+DEFAULT_NETWORK = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../sokp/sokp_v7.xml')
+TIME_STR = '2015-07-23 12:00:00'
+
+
+def measure(render, repetitions):
+    latencies = linkstats.RollingPercentiles(repetitions)
+    for seq_nr in xrange(repetitions):
+        start = time.time()
+        render(seq_nr)
+        latencies.add(time.time() - start)
+    return latencies.snapshot()
+
+
+def main(argv):
+    network_path = DEFAULT_NETWORK
+    repetitions = 50
+    if len(argv) > 1:
+        network_path = argv[1]
+    if len(argv) > 2:
+        repetitions = int(argv[2])
+    logging.basicConfig(level=logging.ERROR)
+    schema = mc.load_schema(network_path)
+    values = benchmark_codec.make_values(len(schema))
+
+    start = time.time()
+    template = long_status.LongStatusTemplate(schema)
+    compile_time = time.time() - start
+    reference = long_status.render_long_status_minidom(schema, TIME_STR, values, 1).encode('utf-8')
+    if template.render(TIME_STR, values, 1) != reference:
+        raise ValueError('the template renders a different document')
+
+    print '%d detectors, %d bytes per document, %d skeleton parts, compiled in %.2f ms' % (
+        len(schema), len(reference), len(template.skeleton), 1000.0 * compile_time)
+    print '%-10s %9s %9s %9s %12s' % ('renderer', 'p50 [ms]', 'max [ms]', 'speed-up', 'documents/s')
+    variants = (('minidom', lambda seq_nr: long_status.render_long_status_minidom(schema, TIME_STR, values, seq_nr)),
+                ('template', lambda seq_nr: template.render(TIME_STR, values, seq_nr)))
+    baseline = None
+    for label, render in variants:
+        stats = measure(render, repetitions)
+        if baseline is None:
+            baseline = stats['p50']
+        print '%-10s %9.2f %9.2f %8.1fx %12.0f' % (label, 1000.0 * stats['p50'], 1000.0 * stats['max'],
+                                                   baseline / stats['p50'], 1.0 / stats['p50'])
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+#
+# Micro-benchmark of the PacketCommunicator receive paths.
+#
+# Compares the string-based `packet_receive()` payload reading (chunked recv() and string
+# concatenation) with the buffer-based `packet_receive_into()` (recv_into() into a reusable
+# buffer) over a loopback TCP connection.
+#
+# Usage: python benchmark_packet.py [repetitions]
+#
+import socket
+import sys
+import threading
+import time
+import packet
+
+# Payload sizes to test, from a small command batch to a multi-megabyte long_status frame
+SIZES = [10 * 1024, 100 * 1024, 1024 * 1024, 5 * 1024 * 1024]
+
+
+def make_socket_pair():
+    """Return a connected pair of TCP sockets on the loopback interface.
+
+    socket.socketpair() is not available on Windows, so we connect through a temporary
+    listening socket instead."""
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.bind(('127.0.0.1', 0))
+    listen_socket.listen(1)
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client_socket.connect(listen_socket.getsockname())
+    server_socket, addr = listen_socket.accept()
+    listen_socket.close()
+    return client_socket, server_socket
+
+
+def sender(sock, payload, repetitions):
+    for i in xrange(repetitions):
+        sock.sendall(payload)
+
+
+def run(receive_method, size, repetitions):
+    """Transfer `repetitions` payloads of `size` bytes and return seconds per payload."""
+    send_socket, recv_socket = make_socket_pair()
+    comm = packet.PacketCommunicator(recv_socket, 'benchmark')
+    payload = 'x' * size
+    thread = threading.Thread(target=sender, args=(send_socket, payload, repetitions))
+    start = time.time()
+    thread.start()
+    for i in xrange(repetitions):
+        if receive_method(comm, size) is None:
+            raise IOError('connection closed prematurely')
+    elapsed = time.time() - start
+    thread.join()
+    send_socket.close()
+    recv_socket.close()
+    return elapsed / repetitions
+
+
+def receive_string(comm, size):
+    return comm._receive_payload(size)
+
+
+def receive_into(comm, size):
+    return comm._receive_payload_into(size)
+
+
+def main(argv):
+    repetitions = 20
+    if len(argv) > 1:
+        repetitions = int(argv[1])
+    print 'memoryview available: %s, %d repetitions' % (packet.HAS_MEMORYVIEW, repetitions)
+    print '%10s %14s %14s %8s' % ('size', 'string [ms]', 'into [ms]', 'speedup')
+    for size in SIZES:
+        t_string = run(receive_string, size, repetitions)
+        t_into = run(receive_into, size, repetitions)
+        print '%10d %14.3f %14.3f %8.2f' % (size, 1000.0 * t_string, 1000.0 * t_into, t_string / t_into)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,254 @@
+#!/usr/bin/python
+#
+# Connection-scaling benchmark of the controller-facing server modes.
+#
+# The server runs in a child process either as the thread-per-connection ThreadingMixIn server
+# or as the single-threaded event_server.EventLoopServer, both with the framing and the
+# RECEIVER_WFILES style fan-out of sirid_server.py. The benchmark opens 1 to 500 controller
+# connections from a single poll()-driven client thread and measures
+#
+# - request/reply latency: every connection sends <gantry msg="get_long_status"/> at the
+#   same time and waits for a long_status sized reply,
+# - fan-out latency: a background thread of the server (standing for the Aimsun receiver)
+#   writes one document to all connections, measured until the last client has it all,
+# - the number of threads of the server process.
+#
+# Latencies are reported in milliseconds.
+#
+# Usage: python benchmark_server.py [threaded|event ...] [rounds]
+#        python benchmark_server.py --serve threaded|event port     (child process)
+#
+import os
+import select
+import socket
+import SocketServer
+import subprocess
+import sys
+import threading
+import time
+import event_server
+import xml_framer
+
+CLIENT_COUNTS = [1, 10, 50, 100, 250, 500]
+# The size of the long_status document of the sokp_v7 network
+DOCUMENT_SIZE = 18 * 1024
+DOCUMENT = '<root msg="long_status">' + 'x' * DOCUMENT_SIZE + '</root>'
+# Reply to <gantry msg="threads"/>, fixed width so that clients know its length
+THREADS_REPLY_SIZE = 8
+
+REQUEST = '<gantry msg="get_long_status"/>'
+BROADCAST_REQUEST = '<gantry msg="broadcast"/>'
+THREADS_REQUEST = '<gantry msg="threads"/>'
+
+
+class Receivers(object):
+    """The RECEIVER_WFILES dictionary of sirid_server.py and its lock."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wfiles = {}
+
+    def add(self, name, wfile):
+        with self.lock:
+            self.wfiles[name] = wfile
+
+    def remove(self, name):
+        with self.lock:
+            self.wfiles.pop(name, None)
+
+    def send(self, names, data):
+        with self.lock:
+            for name in names:
+                wfile = self.wfiles.get(name)
+                if wfile is None:
+                    continue
+                try:
+                    wfile.write(data)
+                    wfile.flush()
+                except socket.error:
+                    self.wfiles.pop(name, None)
+
+    def broadcast(self, data):
+        self.send(self.wfiles.keys(), data)
+
+
+RECEIVERS = Receivers()
+
+
+def process_stanza(root, name):
+    msg = root.attrib.get('msg')
+    if msg == 'get_long_status':
+        RECEIVERS.send([name], DOCUMENT)
+    elif msg == 'broadcast':
+        # The fan-out is done by another thread, as the Aimsun receiver thread does
+        threading.Thread(target=RECEIVERS.broadcast, args=(DOCUMENT,)).start()
+    elif msg == 'threads':
+        RECEIVERS.send([name], '%0*d' % (THREADS_REPLY_SIZE, threading.active_count()))
+
+
+class ThreadedServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class ThreadedHandler(SocketServer.StreamRequestHandler):
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        SocketServer.StreamRequestHandler.setup(self)
+
+    def handle(self):
+        name = threading.current_thread().name
+        RECEIVERS.add(name, self.wfile)
+        framer = xml_framer.make_framer(xml_framer.FRAMER_STREAMING)
+        try:
+            while True:
+                data = self.request.recv(64 * 1024)
+                if not data:
+                    break
+                for root, xml_string in framer.feed(data):
+                    process_stanza(root, name)
+        finally:
+            RECEIVERS.remove(name)
+
+
+class EventHandler(object):
+
+    def __init__(self, connection):
+        self.name = connection.name
+        self.framer = xml_framer.make_framer(xml_framer.FRAMER_STREAMING)
+        RECEIVERS.add(self.name, connection)
+
+    def data_received(self, data):
+        for root, xml_string in self.framer.feed(data):
+            process_stanza(root, self.name)
+
+    def connection_lost(self):
+        RECEIVERS.remove(self.name)
+
+
+def serve(mode, port):
+    if mode == 'event':
+        server = event_server.EventLoopServer(('127.0.0.1', port), EventHandler, backlog=1024)
+    else:
+        server = ThreadedServer(('127.0.0.1', port), ThreadedHandler)
+    print 'ready'
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+class Clients(object):
+    """A set of controller connections driven from a single thread."""
+
+    def __init__(self, port, count):
+        self.sockets = []
+        for i in xrange(count):
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sockets.append(sock)
+        self.by_fd = dict([(sock.fileno(), sock) for sock in self.sockets])
+        self.poller = select.poll()
+        for sock in self.sockets:
+            sock.setblocking(0)
+            self.poller.register(sock.fileno(), select.POLLIN)
+
+    def receive(self, sizes, start):
+        """Read until every socket in `sizes` has received its number of bytes; return the
+        latencies of the sockets since `start`."""
+        remaining = dict(sizes)
+        latencies = []
+        while remaining:
+            for fd, event in self.poller.poll(30000):
+                if fd not in remaining:
+                    continue
+                data = self.by_fd[fd].recv(256 * 1024)
+                if not data:
+                    raise IOError('server closed a connection')
+                remaining[fd] -= len(data)
+                if remaining[fd] <= 0:
+                    del remaining[fd]
+                    latencies.append(time.time() - start)
+            if not latencies and time.time() - start > 60:
+                raise IOError('no reply from the server')
+        return latencies
+
+    def request_reply(self):
+        start = time.time()
+        for sock in self.sockets:
+            sock.sendall(REQUEST)
+        return self.receive([(sock.fileno(), len(DOCUMENT)) for sock in self.sockets], start)
+
+    def fan_out(self):
+        start = time.time()
+        self.sockets[0].sendall(BROADCAST_REQUEST)
+        return self.receive([(sock.fileno(), len(DOCUMENT)) for sock in self.sockets], start)
+
+    def server_threads(self):
+        sock = self.sockets[0]
+        sock.sendall(THREADS_REQUEST)
+        sock.setblocking(1)
+        data = ''
+        while len(data) < THREADS_REPLY_SIZE:
+            data += sock.recv(THREADS_REPLY_SIZE - len(data))
+        sock.setblocking(0)
+        return int(data)
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def run(mode, port, rounds):
+    script = os.path.abspath(__file__)
+    child = subprocess.Popen([sys.executable, script, '--serve', mode, str(port)], stdout=subprocess.PIPE)
+    child.stdout.readline()
+    try:
+        for count in CLIENT_COUNTS:
+            clients = Clients(port, count)
+            # Warm up and make sure that all connections have been accepted
+            clients.request_reply()
+            request_latencies = []
+            fan_out_latencies = []
+            for i in xrange(rounds):
+                request_latencies.extend(clients.request_reply())
+                fan_out_latencies.append(max(clients.fan_out()))
+            threads = clients.server_threads()
+            clients.close()
+            print '%-9s %7d %8d %10.2f %10.2f %10.2f %10.2f' % (
+                mode, count, threads, 1000.0 * percentile(request_latencies, 0.5),
+                1000.0 * percentile(request_latencies, 0.99), 1000.0 * percentile(fan_out_latencies, 0.5),
+                1000.0 * max(fan_out_latencies))
+            sys.stdout.flush()
+            # Let the server reap the closed connections
+            time.sleep(0.5)
+    finally:
+        child.kill()
+        child.wait()
+
+
+def main(argv):
+    if len(argv) > 1 and argv[1] == '--serve':
+        serve(argv[2], int(argv[3]))
+        return
+    modes = [arg for arg in argv[1:] if arg in ('threaded', 'event')] or ['threaded', 'event']
+    rounds = 20
+    numbers = [arg for arg in argv[1:] if arg.isdigit()]
+    if numbers:
+        rounds = int(numbers[0])
+    print '%d rounds, %d byte documents' % (rounds, len(DOCUMENT))
+    print '%-9s %7s %8s %10s %10s %10s %10s' % ('mode', 'clients', 'threads', 'req p50', 'req p99',
+                                                'fanout p50', 'fanout max')
+    port = 19990
+    for mode in modes:
+        run(mode, port, rounds)
+        port += 1
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,83 @@
+#!/usr/bin/python
+#
+# Benchmark of the Aimsun -> SIRID server transports.
+#
+# Sends packets of the size of a binary measurement interval (and larger) through the
+# loopback TCP connection with PacketCommunicator and through the shared-memory lanes of
+# ShmCommunicator, and reports the time per packet as seen by the receiver.
+#
+# Usage: python benchmark_transport.py [repetitions]
+#
+import os
+import sys
+import tempfile
+import threading
+import time
+import packet
+import shmring
+from benchmark_packet import make_socket_pair
+
+# From a command batch over one sokp_v7 interval (75 detectors) to a tenfold network
+SIZES = [256, 18 * 1024, 180 * 1024, 1024 * 1024]
+
+
+def sender(comm, payload, repetitions):
+    for i in xrange(repetitions):
+        comm.packet_send(payload)
+
+
+def run(make_pair, size, repetitions):
+    """Transfer `repetitions` packets of `size` bytes and return seconds per packet."""
+    send_comm, recv_comm, cleanup = make_pair()
+    payload = 'x' * size
+    thread = threading.Thread(target=sender, args=(send_comm, payload, repetitions))
+    start = time.time()
+    thread.start()
+    for i in xrange(repetitions):
+        if recv_comm.packet_receive_into() is None:
+            raise IOError('connection closed prematurely')
+    elapsed = time.time() - start
+    thread.join()
+    cleanup()
+    return elapsed / repetitions
+
+
+def make_tcp_pair():
+    send_socket, recv_socket = make_socket_pair()
+    send_comm = packet.PacketCommunicator(send_socket, 'benchmark', packet.FRAMING_BINARY)
+    recv_comm = packet.PacketCommunicator(recv_socket, 'benchmark', packet.FRAMING_BINARY)
+
+    def cleanup():
+        send_socket.close()
+        recv_socket.close()
+    return send_comm, recv_comm, cleanup
+
+
+def make_shm_pair():
+    send_socket, recv_socket = make_socket_pair()
+    path = os.path.join(tempfile.gettempdir(), 'sirid_benchmark_%d.shm' % os.getpid())
+    recv_comm = shmring.ShmCommunicator(path, shmring.ROLE_SERVER, 'benchmark', recv_socket, create=True)
+    send_comm = shmring.ShmCommunicator(path, shmring.ROLE_AIMSUN, 'benchmark', send_socket)
+
+    def cleanup():
+        send_comm.close()
+        recv_comm.close(remove=True)
+        send_socket.close()
+        recv_socket.close()
+    return send_comm, recv_comm, cleanup
+
+
+def main(argv):
+    repetitions = 200
+    if len(argv) > 1:
+        repetitions = int(argv[1])
+    print '%d repetitions' % repetitions
+    print '%10s %14s %14s %8s' % ('size', 'tcp [us]', 'shm [us]', 'speedup')
+    for size in SIZES:
+        t_tcp = run(make_tcp_pair, size, repetitions)
+        t_shm = run(make_shm_pair, size, repetitions)
+        print '%10d %14.1f %14.1f %8.2f' % (size, 1e6 * t_tcp, 1e6 * t_shm, t_tcp / t_shm)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
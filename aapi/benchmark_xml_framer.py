@@ -0,0 +1,78 @@
+#!/usr/bin/python
+#
+# Benchmark of the XML framers splitting the controller stream into stanzas.
+#
+# The legacy framer scans the data for the root tag and its closing counterpart and every
+# stanza is then parsed by ElementTree; the streaming framer parses the data with expat while
+# they arrive. Both are fed with the same stream cut into chunks of the given sizes: 16 bytes
+# is the read size of the original request handler, random chunks emulate a fragmented
+# stream and 64 KB reads deliver back-to-back stanzas together.
+#
+# Usage: python benchmark_xml_framer.py [xml_file] [copies] [repetitions]
+#
+import os
+import random
+import sys
+import time
+import xml.etree.ElementTree as Et
+import xml_framer
+
+DEFAULT_XML = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xml_test_packet_1.xml')
+
+
+def make_chunks(stream, chunk_size):
+    """Cut the stream into chunks of `chunk_size` bytes, or of random sizes between 1 and
+    -`chunk_size` bytes if `chunk_size` is negative."""
+    chunks = []
+    pos = 0
+    rng = random.Random(1)
+    while pos < len(stream):
+        if chunk_size < 0:
+            size = rng.randint(1, -chunk_size)
+        else:
+            size = chunk_size
+        chunks.append(stream[pos:pos + size])
+        pos += size
+    return chunks
+
+
+def run(framer_name, chunks, repetitions):
+    """Frame and parse the chunked stream, return seconds per pass and number of stanzas."""
+    start = time.time()
+    for i in xrange(repetitions):
+        framer = xml_framer.make_framer(framer_name)
+        count = 0
+        for chunk in chunks:
+            for root, xml_string in framer.feed(chunk):
+                if root is None:
+                    root = Et.fromstring(xml_string)
+                count += 1
+    return (time.time() - start) / repetitions, count
+
+
+def main(argv):
+    xml_path = DEFAULT_XML
+    copies = 100
+    repetitions = 3
+    if len(argv) > 1:
+        xml_path = argv[1]
+    if len(argv) > 2:
+        copies = int(argv[2])
+    if len(argv) > 3:
+        repetitions = int(argv[3])
+    stream = open(xml_path, 'rb').read() * copies
+
+    print '%d bytes in the stream, %d repetitions' % (len(stream), repetitions)
+    print '%-14s %8s %8s %14s %14s %8s' % ('chunks', 'reads', 'stanzas', 'legacy [ms]', 'stream [ms]', 'speedup')
+    for chunk_size, label in ((16, '16 B'), (-100, 'random 1-100 B'), (1460, '1460 B'), (65536, '64 KB')):
+        chunks = make_chunks(stream, chunk_size)
+        t_legacy, n_legacy = run(xml_framer.FRAMER_LEGACY, chunks, repetitions)
+        t_stream, n_stream = run(xml_framer.FRAMER_STREAMING, chunks, repetitions)
+        if n_legacy != n_stream:
+            print '!! framers disagree: %d vs %d stanzas' % (n_legacy, n_stream)
+        print '%-14s %8d %8d %14.1f %14.1f %8.2f' % (label, len(chunks), n_stream, 1000.0 * t_legacy,
+                                                    1000.0 * t_stream, t_legacy / t_stream)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,134 @@
+#
+# Last-writer-wins coalescing of the commands sent to Aimsun
+#
+# Controllers may send several command batches within one simulation step, often setting
+# the same sign more than once. Aimsun would apply every one of them and recompute speed
+# limits and lane closures after each batch. The coalescer collects the commands for a
+# window of time and keeps only the latest command for every sign, that is, for every
+# `(id_gantry_server, id_device, id_sub_device)`. The window opens with the first pending
+# command; it closes when it expires or when `flush()` is called, e.g. at the end of the
+# simulation step of a synchronous simulation.
+#
+import threading
+import time
+import linkstats
+import packet
+
+
+class CommandCoalescer(object):
+    """Collects command tuples `(id_gantry_server, (id_device, id_sub_device, id_message,
+    validity))` and forwards the surviving ones by calling `forward(commands, start_times)`,
+    where `start_times` are the start times passed to `add()` for the coalesced batches.
+
+    The commands are forwarded in the order of their latest update. Calls of `forward` never
+    overlap.
+    """
+
+    def __init__(self, window, forward, logger=None):
+        self.window = window
+        self.forward = forward
+        self.logger = logger
+        self.counters = linkstats.Counters()
+        self._condition = threading.Condition()
+        # Serialises the forwarding so that flushes reach Aimsun in order
+        self._forward_lock = threading.Lock()
+        # Pending commands by sign, values are `(update number, command)`
+        self._pending = {}
+        self._start_times = []
+        self._updates = 0
+        self._deadline = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='coalescer')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def add(self, commands, start=None):
+        """Add the commands of a batch; `start` is the time its processing started. Raises
+        ValueError for a batch with a command that cannot be forwarded, so that it does not
+        spoil the window of the other batches."""
+        if not commands:
+            return
+        for command in commands:
+            packet.check_command(command)
+        with self._condition:
+            if self._closed:
+                raise ValueError('Command coalescer has been closed')
+            for command in commands:
+                id_gantry_server, (id_device, id_sub_device, id_message, validity) = command
+                key = (id_gantry_server, id_device, id_sub_device)
+                if key in self._pending:
+                    self.counters.add('commands_superseded')
+                self._updates += 1
+                self._pending[key] = (self._updates, command)
+            if start is None:
+                start = time.time()
+            self._start_times.append(start)
+            self.counters.add('batches_in')
+            self.counters.add('commands_in', len(commands))
+            if len(self._pending) > self.counters.get('pending_max'):
+                self.counters.set('pending_max', len(self._pending))
+            if self._deadline is None:
+                self._deadline = time.time() + self.window
+                self._condition.notify_all()
+
+    def _take(self):
+        """Remove and return the pending commands in the order of their latest update."""
+        items = self._pending.values()
+        items.sort()
+        commands = [command for update, command in items]
+        start_times = self._start_times
+        self._pending = {}
+        self._start_times = []
+        self._deadline = None
+        return commands, start_times
+
+    def flush(self):
+        """Forward the pending commands now."""
+        with self._forward_lock:
+            with self._condition:
+                commands, start_times = self._take()
+            if commands:
+                self.counters.add('flushes')
+                self.counters.add('commands_out', len(commands))
+                self.forward(commands, start_times)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed and (self._deadline is None or time.time() < self._deadline):
+                    if self._deadline is None:
+                        self._condition.wait()
+                    else:
+                        self._condition.wait(max(self._deadline - time.time(), 0.0))
+                if self._closed:
+                    return
+            # noinspection PyBroadException
+            try:
+                self.flush()
+            except Exception:
+                if self.logger is not None:
+                    self.logger.exception('forwarding of coalesced commands failed')
+
+    def pending(self):
+        with self._condition:
+            return len(self._pending)
+
+    def close(self):
+        """Stop the coalescer; pending commands are discarded and returned."""
+        with self._condition:
+            self._closed = True
+            commands, start_times = self._take()
+            self._condition.notify_all()
+        self.counters.add('commands_discarded', len(commands))
+        return commands
+
+    def get_stats(self):
+        """Return the coalescing statistics.
+
+        :rtype : dict
+        """
+        stats = self.counters.snapshot()
+        stats['window'] = self.window
+        stats['pending'] = self.pending()
+        stats['coalescing_ratio'] = linkstats.ratio(stats.get('commands_in', 0), stats.get('commands_out', 0))
+        return stats
@@ -0,0 +1,172 @@
+#
+# Lifecycle of the controller connections: dead peers, idle connections and stalled writes
+#
+# A controller that vanishes without closing its connection (power loss, a broken link)
+# leaves a connection that never reports end of file. Three mechanisms find such connections:
+# - TCP keepalive probes the peer of a connection silent for `keepalive_idle` seconds and
+#   lets the operating system reset the connection if the peer does not answer,
+# - the idle timeout aborts a connection that neither received nor sent anything for
+#   `idle_timeout` seconds (0 disables it, controllers waiting for pushed documents may be
+#   silent for a long time),
+# - the write timeout aborts a connection whose writer has been stuck on a single document
+#   for `write_timeout` seconds, because the peer stopped reading.
+#
+# The ConnectionReaper thread checks the registered connections every `interval` seconds and
+# calls their abort callback, which shall remove the connection from the receiver tables and
+# shut its socket down. An aborted connection stays registered as a zombie until its handler
+# has finished and unregistered it.
+#
+import socket
+import threading
+import time
+import linkstats
+
+DEFAULT_IDLE_TIMEOUT = 0.0
+DEFAULT_WRITE_TIMEOUT = 60.0
+DEFAULT_INTERVAL = 1.0
+DEFAULT_KEEPALIVE_IDLE = 60
+DEFAULT_KEEPALIVE_INTERVAL = 10
+DEFAULT_KEEPALIVE_COUNT = 5
+
+REASON_IDLE = 'idle'
+REASON_WRITE = 'write'
+
+
+def enable_keepalive(sock, idle=DEFAULT_KEEPALIVE_IDLE, interval=DEFAULT_KEEPALIVE_INTERVAL,
+                     count=DEFAULT_KEEPALIVE_COUNT):
+    """Turn TCP keepalive on for the socket: the first probe is sent after `idle` seconds of
+    silence, then every `interval` seconds until `count` probes went unanswered. Where the
+    timing cannot be set, the defaults of the operating system apply."""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'SIO_KEEPALIVE_VALS'):
+        # Windows takes the timing in milliseconds and has a fixed number of probes
+        sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, idle * 1000, interval * 1000))
+    elif hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+
+
+class TrackedConnection(object):
+    """A connection registered with the reaper."""
+
+    def __init__(self, name, queue, abort):
+        """
+        :type queue: outbound.OutboundQueue
+        """
+        self.name = name
+        self.queue = queue
+        self.abort = abort
+        self.last_received = time.time()
+        # Time and reason of the abort, None while the connection is live
+        self.aborted_at = None
+        self.reason = None
+
+    def idle_time(self, now):
+        """Return the seconds since anything was received or written."""
+        return now - max(self.last_received, self.queue.last_written)
+
+
+class ConnectionReaper(object):
+    """Watches the controller connections and aborts the idle and stalled ones."""
+
+    def __init__(self, idle_timeout=DEFAULT_IDLE_TIMEOUT, write_timeout=DEFAULT_WRITE_TIMEOUT,
+                 interval=DEFAULT_INTERVAL, logger=None):
+        self.idle_timeout = idle_timeout
+        self.write_timeout = write_timeout
+        self.interval = interval
+        self.logger = logger
+        self.counters = linkstats.Counters()
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='reaper')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def register(self, name, queue, abort):
+        """Start watching a connection; `abort` is called without arguments to give it up."""
+        with self._lock:
+            self._connections[name] = TrackedConnection(name, queue, abort)
+        self.counters.add('registered')
+
+    def unregister(self, name):
+        """Stop watching a connection whose handler has finished."""
+        with self._lock:
+            tracked = self._connections.pop(name, None)
+        if tracked is not None and tracked.aborted_at is not None:
+            self.counters.add('zombies_released')
+
+    def received(self, name):
+        """Record that data have been received on a connection."""
+        tracked = self._connections.get(name)
+        if tracked is not None:
+            tracked.last_received = time.time()
+
+    def check(self):
+        """Abort the connections that are idle or stalled for too long. Returns the names of
+        the aborted connections."""
+        now = time.time()
+        with self._lock:
+            candidates = [tracked for tracked in self._connections.values() if tracked.aborted_at is None]
+        reaped = []
+        for tracked in candidates:
+            write_time = tracked.queue.write_time()
+            if self.write_timeout > 0 and write_time > self.write_timeout:
+                reason = REASON_WRITE
+                detail = 'writing a document for %.1f s' % write_time
+            elif self.idle_timeout > 0 and tracked.idle_time(now) > self.idle_timeout:
+                reason = REASON_IDLE
+                detail = 'idle for %.1f s' % tracked.idle_time(now)
+            else:
+                continue
+            tracked.aborted_at = now
+            tracked.reason = reason
+            self.counters.add('reaped_' + reason)
+            if self.logger is not None:
+                self.logger.warning('connection %s %s, aborting it' % (tracked.name, detail))
+            # noinspection PyBroadException
+            try:
+                tracked.abort()
+            except Exception:
+                if self.logger is not None:
+                    self.logger.exception('aborting connection %s failed' % tracked.name)
+            reaped.append(tracked.name)
+        return reaped
+
+    def _run(self):
+        while not self._stopped.isSet():
+            self._stopped.wait(self.interval)
+            # noinspection PyBroadException
+            try:
+                self.check()
+            except Exception:
+                if self.logger is not None:
+                    self.logger.exception('connection reaper failed')
+
+    def counts(self):
+        """Return the numbers of live and zombie connections. A zombie has been aborted but
+        its handler has not finished yet."""
+        with self._lock:
+            connections = self._connections.values()
+        zombies = len([tracked for tracked in connections if tracked.aborted_at is not None])
+        return len(connections) - zombies, zombies
+
+    def get_stats(self):
+        """Return the lifecycle statistics of the connections.
+
+        :rtype : dict
+        """
+        stats = self.counters.snapshot()
+        stats['live'], stats['zombies'] = self.counts()
+        stats['idle_timeout'] = self.idle_timeout
+        stats['write_timeout'] = self.write_timeout
+        return stats
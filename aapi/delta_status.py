@@ -0,0 +1,96 @@
+#
+# Delta long_status documents
+#
+# At night most detectors report the same values interval after interval, yet every
+# long_status document repeats all lanes and categories. A controller may opt in for delta
+# documents in its get_long_status request:
+#
+#   <gantry msg="get_long_status"><delta keyframe_interval="10">true</delta></gantry>
+#
+# and acknowledge every document it has processed with
+#
+#   <gantry msg="ack"><seq_nr>N</seq_nr></gantry>
+#
+# (a get_long_status request with `<seq_nr>N</seq_nr>` acknowledges N as well). Instead of
+# the full document the controller then gets a `long_status_delta` document holding only the
+# categories that changed since the last document it acknowledged, see
+# `LongStatusTemplate.render_delta()`. Deltas are cumulative: a delta dropped by the slow
+# consumer policy of the outbound queue is covered by the next one.
+#
+# The controller gets the full long_status document as a keyframe
+# - until it has acknowledged a document,
+# - after `keyframe_interval` deltas (0 means never),
+# - when the acknowledged document is no longer in the status cache,
+# - when the detector schema has changed,
+# - on a get_long_status request without <seq_nr>, which serves as the full resync.
+#
+import threading
+
+# Key of the `(template, values, time_str)` measurements of a document in the encoded
+# variants of its status cache entry
+MEASUREMENTS_KEY = 'measurements'
+DEFAULT_KEYFRAME_INTERVAL = 10
+
+
+class DeltaState(object):
+    """Delta mode state of a controller connection."""
+
+    def __init__(self, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL):
+        self.keyframe_interval = keyframe_interval
+        self._lock = threading.Lock()
+        # Sequence number of the last document acknowledged by the controller
+        self.acknowledged = None
+        # Deltas sent since the last keyframe, None if the next document shall be a keyframe
+        self.deltas_sent = None
+
+    def acknowledge(self, seq_nr):
+        with self._lock:
+            if self.acknowledged is None or seq_nr > self.acknowledged:
+                self.acknowledged = seq_nr
+
+    def resync(self):
+        """Make the next document a keyframe."""
+        with self._lock:
+            self.deltas_sent = None
+
+    def next_base(self, seq_nr):
+        """Return the sequence number of the document that the document `seq_nr` shall be a
+        delta against, or None if it shall be sent in full. The document is counted as sent.
+        """
+        with self._lock:
+            if self.acknowledged is None or seq_nr is None or self.acknowledged >= seq_nr or \
+                    self.deltas_sent is None or \
+                    (self.keyframe_interval > 0 and self.deltas_sent >= self.keyframe_interval):
+                self.deltas_sent = 0
+                return None
+            self.deltas_sent += 1
+            return self.acknowledged
+
+    def keyframe_forced(self):
+        """Count the document returned by `next_base()` as a keyframe after all, because the
+        delta could not be rendered."""
+        with self._lock:
+            self.deltas_sent = 0
+
+
+def delta_document(entry, base_entry):
+    """Return the delta document of a status cache entry against an older one, or None if
+    the entries do not carry measurements of the same schema. Deltas are kept in the encoded
+    variants of the entry, so that controllers with the same base share them.
+
+    :rtype : str
+    """
+    seq_nr, xml_string, encoded_cache = entry
+    key = ('delta', base_entry[0])
+    try:
+        return encoded_cache[key]
+    except KeyError:
+        pass
+    measurements = encoded_cache.get(MEASUREMENTS_KEY)
+    base_measurements = base_entry[2].get(MEASUREMENTS_KEY)
+    if measurements is None or base_measurements is None or measurements[0] is not base_measurements[0]:
+        return None
+    template, values, time_str = measurements
+    document = template.render_delta(time_str, values, seq_nr, base_measurements[1], base_entry[0])
+    encoded_cache[key] = document
+    return document
@@ -0,0 +1,353 @@
+#
+# Single-threaded event-loop TCP server for the controller connections
+#
+# The threaded server of sirid_server.py starts one OS thread per controller connection. With
+# many controllers and dashboards attached, the threads and their context switches dominate.
+# EventLoopServer serves all connections from a single thread: it waits for readiness with
+# poll() (or select() where poll() is not available, e.g. on Windows), reads whatever has
+# arrived and passes it to the handler of the connection, and writes the data queued for
+# the connection as far as its socket accepts them; the rest is sent when the socket becomes
+# writable again.
+#
+# `Connection.write()` may be called from any thread (the Aimsun receiver thread fans the
+# measurements out to the controllers); it only puts the data into the outbound queue of
+# the connection and wakes the loop up.
+#
+import errno
+import logging
+import select
+import socket
+import threading
+import outbound
+
+# Maximum number of bytes read from a connection in one go
+RECV_SIZE = 64 * 1024
+# Maximum number of bytes passed to a single send()
+SEND_SIZE = 256 * 1024
+
+LOGGER = logging.getLogger('sirid_server.event_server')
+
+# Errors meaning "try again later" for non-blocking sockets, Windows uses WSAEWOULDBLOCK
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, 10035)
+
+
+def make_wakeup_pair():
+    """Return a connected pair of TCP sockets on the loopback interface used to wake the
+    loop up. socket.socketpair() is not available on Windows."""
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.bind(('127.0.0.1', 0))
+    listen_socket.listen(1)
+    write_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    write_socket.connect(listen_socket.getsockname())
+    read_socket, addr = listen_socket.accept()
+    listen_socket.close()
+    read_socket.setblocking(0)
+    write_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return read_socket, write_socket
+
+
+class Connection(object):
+    """A client connection of the event loop with a file-like `write()` interface.
+
+    The data waiting to be sent are kept in `queue`, an unbounded outbound.OutboundQueue that
+    the handler may reconfigure with a size and a slow-consumer policy.
+    """
+
+    def __init__(self, server, sock, address, name):
+        self.server = server
+        self.socket = sock
+        self.address = address
+        self.name = name
+        self.closed = False
+        self.queue = outbound.OutboundQueue(name)
+        self.queue.on_ready = self._queue_ready
+        self.queue.on_overrun = self.abort
+        # The string being sent and the number of its bytes that have been sent already
+        self._current = None
+        self._offset = 0
+        # The connection is closed once the queued data have been sent
+        self.closing = False
+        self.handler = None
+
+    def _queue_ready(self):
+        self.server.wakeup(self)
+
+    def write(self, data):
+        """Queue data for sending. Safe to call from any thread."""
+        if self.closed or not self.queue.put(data):
+            raise socket.error(errno.EPIPE, 'connection %s closed' % self.name)
+
+    def flush(self):
+        """The data are sent by the event loop as soon as the socket is writable."""
+        pass
+
+    def close_when_sent(self):
+        """Close the connection after the queued data have been sent. Safe to call from any
+        thread."""
+        self.closing = True
+        self.server.wakeup(self)
+
+    def abort(self):
+        """Shut the socket down, the event loop then closes the connection. Safe to call from
+        any thread."""
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def has_output(self):
+        return self._current is not None or self.queue.depth() > 0
+
+    def _send(self):
+        """Send as much of the queued data as the socket accepts. Returns False if the
+        connection has failed."""
+        while True:
+            if self._current is None:
+                self._current = self.queue.take_nowait()
+                self._offset = 0
+                if self._current is None:
+                    return True
+                if isinstance(self._current, unicode):
+                    # The documents rendered by minidom are unicode strings
+                    self._current = self._current.encode('utf-8')
+            try:
+                num_sent = self.socket.send(buffer(self._current, self._offset, SEND_SIZE))
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK:
+                    return True
+                LOGGER.info('send to %s/%s failed: %s' % (self.name, self.address, e))
+                return False
+            self._offset += num_sent
+            if self._offset >= len(self._current):
+                self._current = None
+                self.queue.done()
+            else:
+                # The socket buffer is full, wait for the next writable event
+                return True
+
+
+class EventLoopServer(object):
+    """Event-loop server. `handler_factory(connection)` is called for every accepted
+    connection and returns a handler with methods `data_received(data)` and
+    `connection_lost()`."""
+
+    def __init__(self, server_address, handler_factory, backlog=128):
+        self.handler_factory = handler_factory
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(backlog)
+        self.socket.setblocking(0)
+        self.server_address = self.socket.getsockname()
+        self._wakeup_read, self._wakeup_write = make_wakeup_pair()
+        self._wakeup_lock = threading.Lock()
+        self._wakeup_pending = False
+        self._connections = {}
+        # Connections with data queued since the last iteration of the loop
+        self._want_write = []
+        # Connections waiting for their sockets to become writable, by file descriptor
+        self._writing = {}
+        self._poller = None
+        self._loop_thread = None
+        self._next_id = 1
+        self._running = False
+        # Functions called in the loop thread at its next iteration, see `call_soon()`
+        self._callbacks = []
+
+    def wakeup(self, connection=None):
+        """Interrupt the wait of the loop, e.g. because data have been queued for `connection`.
+        Safe to call from any thread."""
+        with self._wakeup_lock:
+            if connection is not None:
+                self._want_write.append(connection)
+            if self._wakeup_pending or threading.current_thread() is self._loop_thread:
+                # The loop checks the queued data before it waits again
+                return
+            self._wakeup_pending = True
+        try:
+            self._wakeup_write.send('x')
+        except socket.error:
+            pass
+
+    def call_soon(self, callback):
+        """Call `callback()` in the loop thread at its next iteration. Safe to call from any
+        thread."""
+        with self._wakeup_lock:
+            self._callbacks.append(callback)
+        self.wakeup()
+
+    def _run_callbacks(self):
+        with self._wakeup_lock:
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            # noinspection PyBroadException
+            try:
+                callback()
+            except Exception:
+                LOGGER.exception('exception in callback %s' % repr(callback))
+
+    def connection_count(self):
+        return len(self._connections)
+
+    def _register(self, fd, writing):
+        if self._poller is None:
+            return
+        if writing:
+            self._poller.modify(fd, select.POLLIN | select.POLLOUT)
+        else:
+            self._poller.modify(fd, select.POLLIN)
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK:
+                    return
+                raise
+            sock.setblocking(0)
+            # Replies are written as whole documents, do not let Nagle hold back their tails
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = Connection(self, sock, address, 'Connection-%d' % self._next_id)
+            self._next_id += 1
+            self._connections[sock.fileno()] = connection
+            if self._poller is not None:
+                self._poller.register(sock.fileno(), select.POLLIN)
+            try:
+                connection.handler = self.handler_factory(connection)
+            except Exception:
+                LOGGER.exception('cannot create handler for %s' % str(address))
+                self._close(connection)
+
+    def _close(self, connection):
+        if connection.closed:
+            return
+        connection.closed = True
+        connection.queue.close()
+        fd = connection.socket.fileno()
+        self._connections.pop(fd, None)
+        self._writing.pop(fd, None)
+        if self._poller is not None:
+            self._poller.unregister(fd)
+        if connection.handler is not None:
+            # noinspection PyBroadException
+            try:
+                connection.handler.connection_lost()
+            except Exception:
+                LOGGER.exception('exception in connection_lost() of %s' % connection.name)
+        try:
+            connection.socket.close()
+        except socket.error:
+            pass
+
+    def _read(self, connection):
+        try:
+            data = connection.socket.recv(RECV_SIZE)
+        except socket.error as e:
+            if e.args[0] in WOULD_BLOCK:
+                return
+            LOGGER.info('recv from %s/%s failed: %s' % (connection.name, connection.address, e))
+            self._close(connection)
+            return
+        if not data:
+            # An empty read means the connection has been closed by the peer
+            self._close(connection)
+            return
+        # noinspection PyBroadException
+        try:
+            connection.handler.data_received(data)
+        except Exception:
+            # A failing request must not stop the loop serving the other connections
+            LOGGER.exception('exception when processing data of %s, closing it' % connection.name)
+            self._close(connection)
+
+    def _write(self, connection):
+        """Send the queued data of the connection and wait for the socket to become writable
+        if some of them remain."""
+        if connection.closed:
+            return
+        if not connection._send():
+            self._close(connection)
+            return
+        fd = connection.socket.fileno()
+        writing = connection.has_output()
+        if not writing and connection.closing:
+            self._close(connection)
+            return
+        if writing != (fd in self._writing):
+            if writing:
+                self._writing[fd] = connection
+            else:
+                del self._writing[fd]
+            self._register(fd, writing)
+
+    def _wait(self, timeout):
+        """Return lists of readable and writable file descriptors."""
+        if self._poller is not None:
+            readable = []
+            writable = []
+            for fd, event in self._poller.poll(int(timeout * 1000)):
+                if event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                    readable.append(fd)
+                if event & select.POLLOUT:
+                    writable.append(fd)
+            return readable, writable
+        read_fds = [self.socket.fileno(), self._wakeup_read.fileno()] + self._connections.keys()
+        readable, writable, unused = select.select(read_fds, self._writing.keys(), [], timeout)
+        return readable, writable
+
+    def _flush_queued(self):
+        """Start sending the data queued since the last call."""
+        with self._wakeup_lock:
+            connections = self._want_write
+            self._want_write = []
+        for connection in connections:
+            self._write(connection)
+
+    def serve_forever(self, poll_interval=0.5):
+        self._loop_thread = threading.current_thread()
+        if hasattr(select, 'poll'):
+            self._poller = select.poll()
+            self._poller.register(self.socket.fileno(), select.POLLIN)
+            self._poller.register(self._wakeup_read.fileno(), select.POLLIN)
+            for fd in self._connections:
+                self._poller.register(fd, select.POLLIN)
+        self._running = True
+        while self._running:
+            readable, writable = self._wait(poll_interval)
+            for fd in writable:
+                connection = self._connections.get(fd)
+                if connection is not None:
+                    self._write(connection)
+            for fd in readable:
+                if fd == self.socket.fileno():
+                    self._accept()
+                elif fd == self._wakeup_read.fileno():
+                    with self._wakeup_lock:
+                        self._wakeup_pending = False
+                    try:
+                        self._wakeup_read.recv(4096)
+                    except socket.error:
+                        pass
+                else:
+                    connection = self._connections.get(fd)
+                    if connection is not None:
+                        self._read(connection)
+            self._run_callbacks()
+            # Data queued by the handlers and by other threads are sent right away if the
+            # sockets accept them
+            self._flush_queued()
+        self._loop_thread = None
+
+    def shutdown(self):
+        """Stop the loop; may be called from another thread."""
+        self._running = False
+        self.wakeup()
+
+    def server_close(self):
+        for connection in self._connections.values():
+            self._close(connection)
+        self.socket.close()
+        self._wakeup_read.close()
+        self._wakeup_write.close()
@@ -5,6 +5,7 @@
 import re
 import xml.etree.ElementTree as Et
 from collections import defaultdict
+import gantry_command
 
 # Warning: Do not change the definition of SYMBOLS, it is only for documentation purposes.
 # Particular symbol strings are defined as class variables in corresponding classes.
@@ -510,30 +511,11 @@ class GantryServer:
     def process_xml_commands(self, gantry_xml_node):
         """Process a portion of XML command batch sent from the controller"""
         # The `id` attribute contains gantry server name
-        for device_node in gantry_xml_node:
-            if device_node.tag != 'device':
-                raise ValueError('Expected <device> tag, got <%s>' % device_node.tag)
-            id_device = int(device_node.attrib['id'])
-            for sub_device_node in device_node:
-                if sub_device_node.tag != 'subdevice':
-                    raise ValueError('Expected <subdevice> tag, got <%s>' % sub_device_node.tag)
-                id_sub_device = int(sub_device_node.attrib['id'])
-                # Device may span several gantries. We assume that a sub-device is local to the given gantry.
-                sub_device = self.locate_sub_device(id_device, id_sub_device)
-                if len(sub_device_node) != 1:
-                    raise ValueError('Node <subdevice> has more than one child node')
-                # Sub-device node contains only a single child node. This node should be a
-                # command node
-                command_node = sub_device_node[0]
-                if command_node.tag == 'command':
-                    validity = int(command_node.attrib['validity'])
-                    if len(command_node) != 1:
-                        raise ValueError('Node <command> has more than one child node')
-                    symbol_node = command_node[0]
-                    message_id = int(symbol_node.text)
-                    sub_device.set_message_id(message_id)
-                else:
-                    raise ValueError('Expected <command> tag, got <%s>' % command_node.tag)
+        batch = gantry_command.decode_command_element(gantry_xml_node)
+        if batch.errors:
+            raise ValueError('Node <command> without <symbol> for ' + ', '.join(batch.errors))
+        for id_gantry_server, command in batch.commands():
+            self.process_command(command)
 
     def process_command(self, command):
         """Process a binary command specified as tuple
@@ -2,40 +2,186 @@
 # -*- coding: windows-1250 -*-
 
 import xml.etree.ElementTree as Et
+try:
+    import xml.etree.cElementTree as CEt
+except ImportError:
+    CEt = Et
+from xml.parsers.expat import ExpatError
 import pickle
 
+
+class CommandBatch(object):
+    """Commands of a single command stanza as `(id_gantry_server, (id_device, id_sub_device,
+    id_message, validity))` tuples, the form in which they are passed on to Aimsun. `errors`
+    lists the `id_gantry_server/id_device/id_sub_device` of the commands skipped for a missing
+    <symbol>, `num_addsymbols` counts the commands with an <addsymbol>.
+    """
+
+    # Command batches take the place of the <root> element of the stanza they came from
+    tag = 'root'
+
+    def __init__(self):
+        self.command_list = []
+        self.errors = []
+        self.num_addsymbols = 0
+
+    def __len__(self):
+        return len(self.command_list)
+
+    def addsymbols(self):
+        """Return the number of commands with an <addsymbol>."""
+        return self.num_addsymbols
+
+    def commands(self):
+        """Return the commands as `(id_gantry_server, (id_device, id_sub_device, id_message,
+        validity))` tuples.
+
+        :rtype : list
+        """
+        return self.command_list
+
+
+def required_attribute(node, name):
+    """Return the attribute of the node, raising ValueError if it is missing."""
+    value = node.get(name)
+    if value is None:
+        raise ValueError('Missing %s attribute of <%s>' % (name, node.tag))
+    return value
+
+
+def decode_gantry_element(batch, gantry_node):
+    """Decode the commands of a <gantry> element of a command stanza into the batch."""
+    if gantry_node.tag != "gantry":
+        raise ValueError('Expected <gantry> tag, got <%s>' % gantry_node.tag)
+    id_gantry_server = required_attribute(gantry_node, 'id')
+    commands = batch.command_list
+    for device_node in gantry_node:
+        if device_node.tag != 'device':
+            raise ValueError('Expected <device> tag, got <%s>' % device_node.tag)
+        id_device = int(required_attribute(device_node, 'id'))
+        for sub_device_node in device_node:
+            if sub_device_node.tag != 'subdevice':
+                raise ValueError('Expected <subdevice> tag, got <%s>' % sub_device_node.tag)
+            id_sub_device = int(required_attribute(sub_device_node, 'id'))
+            if len(sub_device_node) != 1:
+                raise ValueError('Node <subdevice> has more than one child node')
+            # Sub-device node contains only a single child node. This node should be a
+            # command node
+            command_node = sub_device_node[0]
+            if command_node.tag != 'command':
+                raise ValueError('Expected <command> tag, got <%s>' % command_node.tag)
+            validity = int(required_attribute(command_node, 'validity'))
+            if len(command_node) > 2:
+                raise ValueError('Node <command> has more than two child nodes: ' +
+                                 repr([node.tag for node in command_node]))
+            id_message = None
+            addsymbol = None
+            for node in command_node:
+                if node.tag == 'symbol':
+                    id_message = int(node.text or '')
+                elif node.tag == 'addsymbol':
+                    # Validated, but Aimsun has no use for it yet
+                    addsymbol = int(node.text or '')
+            if id_message is None:
+                batch.errors.append('%s/%s/%s' % (id_gantry_server, id_device, id_sub_device))
+            else:
+                commands.append((id_gantry_server, (id_device, id_sub_device, id_message, validity)))
+                if addsymbol is not None:
+                    batch.num_addsymbols += 1
+
+
+def decode_command_element(element):
+    """Decode a command stanza parsed into an element tree, given by its <root> element or
+    by one of its <gantry> elements. Raises ValueError if the stanza is malformed.
+
+    This is the single decoder of command stanzas shared by the SIRID server, the parser
+    pool and GantryServer.
+
+    :type element: Et.Element
+    :rtype : CommandBatch
+    """
+    batch = CommandBatch()
+    if element.tag == 'gantry':
+        decode_gantry_element(batch, element)
+    else:
+        for gantry_node in element:
+            decode_gantry_element(batch, gantry_node)
+    return batch
+
+
+def decode_command_stanza(xml_string):
+    """Decode a command stanza from its XML string. The stanza is parsed by the C
+    implementation of ElementTree, which is several times faster than building the tree in
+    Python. Raises SyntaxError or ExpatError if the stanza is not well-formed and ValueError
+    if it is not a valid command batch.
+
+    :rtype : CommandBatch
+    """
+    root = CEt.fromstring(xml_string)
+    if root.tag != 'root':
+        raise ValueError('Expected <root> tag, got <%s>' % root.tag)
+    return decode_command_element(root)
+
+
+def command_batch(root):
+    """Return the CommandBatch of a command stanza given either as its element tree or as a
+    batch decoded already.
+
+    :rtype : CommandBatch
+    """
+    if isinstance(root, CommandBatch):
+        return root
+    return decode_command_element(root)
+
+
 def process_gantry_server_commands(tree):
     """Process a XML command batch sent from the controller"""
 
-    root = tree.getroot()
-
-    for gantry_node in root:
-        if gantry_node.tag != "gantry":
-            raise ValueError('Expected <gantry> tag, got <%s>' % gantry_node.tag)
-        id_gantry_server = gantry_node.attrib['id']
-        for device_node in gantry_node:
-            if device_node.tag != 'device':
-                raise ValueError('Expected <device> tag, got <%s>' % device_node.tag)
-            id_device = int(device_node.attrib['id'])
-            for sub_device_node in device_node:
-                if sub_device_node.tag != 'subdevice':
-                    raise ValueError('Expected <subdevice> tag, got <%s>' % sub_device_node.tag)
-                id_sub_device = int(sub_device_node.attrib['id'])
-                if len(sub_device_node) != 1:
-                    raise ValueError('Node <subdevice> has more than one child node')
-                # Sub-device node contains only a single child node. This node should be a
-                # command node
-                command_node = sub_device_node[0]
-                if command_node.tag == 'command':
-                    validity = int(command_node.attrib['validity'])
-                    if len(command_node) != 1:
-                        raise ValueError('Node <command> has more than one child node')
-                    symbol_node = command_node[0]
-                    id_message = int(symbol_node.text)
-                    command = (id_gantry_server, id_device, id_sub_device, id_message, validity)
-                    print pickle.dumps(command,pickle.HIGHEST_PROTOCOL)
-                else:
-                    raise ValueError('Expected <command> tag, got <%s>' % command_node.tag)
+    batch = command_batch(tree.getroot())
+    for id_gantry_server, (id_device, id_sub_device, id_message, validity) in batch.commands():
+        command = (id_gantry_server, id_device, id_sub_device, id_message, validity)
+        print pickle.dumps(command,pickle.HIGHEST_PROTOCOL)
+
+
+def commands_from_root(root):
+    """Validate a XML command batch sent from the controller and convert it to a list of
+    `(id_gantry_server, (id_device, id_sub_device, id_message, validity))` command tuples.
+
+    Raises ValueError if the batch is malformed. Commands without a <symbol> node are
+    skipped and reported in the returned list of errors.
+
+    :type root: Et.Element
+    :rtype : tuple
+    """
+    batch = command_batch(root)
+    return batch.commands(), batch.errors
+
+
+def is_command_stanza(xml_string):
+    """Return True if the root element of the XML stanza is <root>, that is, if the stanza is
+    a command batch. Only the beginning of the string is inspected."""
+    pos = xml_string.find('<')
+    if xml_string.startswith('<?', pos):
+        pos = xml_string.find('<', xml_string.find('?>', pos))
+    return xml_string.startswith('<root', pos) and xml_string[pos + 5:pos + 6] in ('>', ' ', '/', '\t', '\r', '\n')
+
+
+def parse_command_stanza(xml_string):
+    """Parse and validate a command batch, see `commands_from_root()`.
+
+    This is the job of the worker processes of the command parser pool of the SIRID server:
+    only the compact command tuples travel back to the server process. Returns None if the
+    stanza is not well-formed XML.
+
+    :rtype : tuple
+    """
+    try:
+        batch = decode_command_stanza(xml_string)
+    except (ExpatError, SyntaxError):
+        # Python 2.7 raises ParseError, a subclass of SyntaxError
+        return None
+    return batch.commands(), batch.errors
+
 
 if __name__ == "__main__":
     tree = Et.parse('gantry_command.xml')
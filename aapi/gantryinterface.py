@@ -10,7 +10,12 @@ import logging
 from AAPI import AKIPrintString
 import pickle
 import threading
+import time
 import packet
+import linkstats
+import measurement_codec
+import shmring
+import handshake
 
 logger = logging.getLogger('aapi_gantry.interface')
 
@@ -22,6 +27,9 @@ VMS_TEXT     = 3
 # Lock object that is used for synchronisation
 LOCK = threading.Lock()
 
+# Seconds `GantryInterface.close()` waits for the queued packets to be written
+CLOSE_TIMEOUT = 10.0
+
 class NoData(Exception) :
     def __init__ ( self ) :
         pass
@@ -34,45 +42,208 @@ class GantryInterface :
         self._qin  = Queue.Queue()
         self._qout = Queue.Queue()
         self._socket = None
+        self._packetcomm = None
         self._is_synchronous = False
+        # Measurement codec negotiated with the server and the id of the detector schema that
+        # has been already sent to the server
+        self._codec = measurement_codec.CODEC_PICKLE
+        self._sent_schema = None
+        self._sent_schema_id = None
+        # Control channel carrying the synchronisation tokens, see `packet.CONTROL_HELLO`
+        self._control_channel = False
+        self._control_packetcomm = None
+        self._framing = packet.FRAMING_LEGACY
+        # Packets received before the final configuration, processed by the communication
+        # thread first
+        self._early_packets = []
+        # Number of bulk packets processed by the communication thread; @UNLOCK received over
+        # the control channel waits until the packets sent before it have been processed
+        self._bulk_processed = 0
+        self._bulk_condition = threading.Condition()
+        # One-way latency of the control tokens and time @UNLOCK waited for bulk packets
+        self.control_latency = linkstats.RollingPercentiles()
+        self.unlock_wait = linkstats.LatencyStats()
+        # Latency of commands from sending by the server to their application in AAPIManage(),
+        # and the part of it the commands spent waiting in the command queue
+        self.command_latency = linkstats.RollingPercentiles()
+        self.command_queue_delay = linkstats.RollingPercentiles()
 
     def set_socket(self, sirid_socket):
         self._socket = sirid_socket
         self._packetcomm = packet.PacketCommunicator(sirid_socket, "aapi_gantry.interface")
 
-    def get_command ( self ) :
-        logger.debug("get_command()")
+    def get_command_batch(self):
+        """Return the oldest list of commands received from the server. All commands of the
+        list come from a single controller message and shall be applied together."""
+        logger.debug("get_command_batch()")
         try :
-            return self._qin.get_nowait()
+            commands, sent_time, received_time = self._qin.get_nowait()
         except Queue.Empty as e :
             raise NoData() 
+        # The batch is taken from the queue in the simulation step that applies it
+        now = time.time()
+        self.command_queue_delay.add(now - received_time)
+        if sent_time is not None:
+            self.command_latency.add(now - sent_time)
+        return commands
 
     def put_command(self, command):
         logger.debug("put_command(%s)" % repr(command))
-        self._qin.put_nowait(command)
+        self._qin.put_nowait(([command], None, time.time()))
+
+    def put_command_batch(self, commands, sent_time=None):
+        """Queue a batch of commands, `sent_time` is the time the server sent the batch."""
+        logger.debug("put_command_batch(%d commands)" % len(commands))
+        self._qin.put_nowait((commands, sent_time, time.time()))
 
-    def put_measurements(self, measurements):
+    def put_measurements(self, time_str, schema, values):
         """Store measurements from detectors in a queue and send them to server as soon as the
-        communication has been established."""
+        communication has been established.
+
+        :param time_str: time stamp of the measurements
+        :param schema: list of `(name, gantry_ld_map tuple)` detector descriptors
+        :param values: flat value array, see `measurement_codec`
+        """
         logger.debug("put_measurements()")
-        self._qout.put_nowait(measurements)
+        self._qout.put_nowait((time_str, schema, values))
         if self._socket:
             while not self._qout.empty():
-                measurements = self._qout.get_nowait()
-                data = pickle.dumps(measurements, -1)
-                self._packetcomm.packet_send(data)
+                time_str, schema, values = self._qout.get_nowait()
+                if self._codec == measurement_codec.CODEC_BINARY:
+                    # The static detector descriptors are sent only once
+                    if schema is not self._sent_schema:
+                        self._sent_schema_id = measurement_codec.schema_id(schema)
+                        logger.debug("sending detector schema %08x" % self._sent_schema_id)
+                        self._packetcomm.packet_send(measurement_codec.encode_schema(schema))
+                        self._sent_schema = schema
+                    data = measurement_codec.encode_interval(self._sent_schema_id, time_str, values)
+                else:
+                    dets = measurement_codec.values_to_dicts(schema, values)
+                    data = pickle.dumps((time_str, dets), -1)
+                try:
+                    # Measurements of a single interval may be dropped if the server cannot keep up
+                    self._packetcomm.packet_send(data, droppable=True)
+                except packet.SendQueueFull as e:
+                    logger.error("measurements of %s not sent: %s" % (time_str, str(e)))
+            logger.debug("link statistics: %s" % repr(self.get_stats()))
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        """Write the packets still queued for the server, e.g. the last detection interval of
+        the replication. Only a send queue (see `packet.AsyncPacketCommunicator`) holds any."""
+        if isinstance(self._packetcomm, packet.AsyncPacketCommunicator):
+            logger.debug("writing %d queued packets" % self._packetcomm.queue_depth())
+            self._packetcomm.close(timeout)
 
     def receive_data_packet(self):
+        if self._early_packets:
+            return self._early_packets.pop(0)
         return self._packetcomm.packet_receive()
 
     def send_data_packet(self, data):
         self._packetcomm.packet_send(data)
 
+    def has_control_channel(self):
+        return self._control_channel
+
+    def set_control_socket(self, control_socket):
+        """Open the control channel over an already connected socket."""
+        control_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._control_packetcomm = packet.PacketCommunicator(control_socket, "aapi_gantry.interface.control",
+                                                             self._framing)
+        self._control_packetcomm.packet_send(packet.CONTROL_HELLO)
+
+    def receive_control_packet(self):
+        return self._control_packetcomm.packet_receive()
+
+    def send_control_packet(self, data):
+        self._control_packetcomm.packet_send(data)
+
+    def bulk_packet_processed(self):
+        with self._bulk_condition:
+            self._bulk_processed += 1
+            self._bulk_condition.notify_all()
+
+    def wait_for_bulk_packets(self, bulk_seq):
+        """Block until `bulk_seq` packets of the bulk channel have been processed."""
+        start = time.time()
+        with self._bulk_condition:
+            while self._bulk_processed < bulk_seq:
+                self._bulk_condition.wait(1.0)
+        self.unlock_wait.add(time.time() - start)
+
+    def get_stats(self):
+        """Return statistics of the bulk and control channels.
+
+        :rtype : dict
+        """
+        stats = {'bulk': self._packetcomm.get_stats(), 'commands': self.command_latency.snapshot('latency_')}
+        stats['commands'].update(self.command_queue_delay.snapshot('queue_delay_'))
+        if self._control_packetcomm is not None:
+            stats['control'] = self._control_packetcomm.get_stats()
+            stats['control'].update(self.control_latency.snapshot('latency_'))
+            stats['control'].update(self.unlock_wait.snapshot('unlock_wait_'))
+        return stats
+
+    def get_capabilities(self):
+        """Return the protocol capabilities announced to the SIRID server in the handshake."""
+        return handshake.capabilities()
+
     def receive_configuration_data(self):
         logger.debug("receiving configuration data")
         data = self.receive_data_packet()
         config = pickle.loads(data)
+        if 'offer' in config:
+            # Version 2 server, announce our capabilities and wait for the settled configuration
+            logger.debug("server offers protocol version %d" % config['offer'].get('version', 1))
+            self.send_data_packet(handshake.make_caps_packet(self.get_capabilities()))
+            config = self.receive_final_configuration()
         self._is_synchronous = config['synchronous']
+        # Servers that do not understand the extended handshake do not send the framing
+        framing = config.get('framing', packet.FRAMING_LEGACY)
+        logger.debug("using %s framing" % framing)
+        send_queue = config.get('send_queue')
+        if send_queue:
+            # Packets are written by a background thread so that the simulation thread never
+            # waits for the server
+            logger.debug("using send queue of %d packets with %s policy" % (send_queue['size'], send_queue['policy']))
+            self._packetcomm = packet.AsyncPacketCommunicator(self._socket, "aapi_gantry.interface", framing,
+                                                              send_queue['size'], send_queue['policy'])
+        self._packetcomm.set_framing(framing)
+        self._framing = framing
+        self._control_channel = config.get('control_channel', False)
+        self._codec = config.get('codec', measurement_codec.CODEC_PICKLE)
+        logger.debug("using %s measurement codec" % self._codec)
+        compression = config.get('compression', {'method': packet.COMPRESSION_NONE})
+        self._packetcomm.set_compression(
+            compression['method'],
+            compression.get('level', packet.DEFAULT_COMPRESSION_LEVEL),
+            compression.get('threshold', packet.DEFAULT_COMPRESSION_THRESHOLD))
+        transport = config.get('transport', {'method': shmring.TRANSPORT_TCP})
+        if transport['method'] == shmring.TRANSPORT_SHM:
+            # The server has created the shared file before sending the configuration
+            logger.debug("switching to shared-memory transport `%s`" % transport['path'])
+            self._packetcomm = shmring.ShmCommunicator(
+                transport['path'], shmring.ROLE_AIMSUN, "aapi_gantry.interface", self._socket,
+                poll_interval=transport.get('poll_interval', shmring.DEFAULT_POLL_INTERVAL))
+
+    def receive_final_configuration(self):
+        """Wait for the configuration settled by the server after our capabilities. A server
+        that timed out waiting for them has already switched to protocol version 1 and may
+        send commands before it answers the late capabilities with the version 1
+        configuration; those packets are kept for the communication thread.
+
+        :rtype : dict
+        """
+        while True:
+            data = self._packetcomm.packet_receive()
+            if not data:
+                raise socket.error('connection closed by the server during the handshake')
+            if not data.startswith('@') and not packet.is_command_batch(data):
+                config = pickle.loads(data)
+                if isinstance(config, dict) and 'synchronous' in config:
+                    return config
+            logger.debug("packet received before the final configuration kept for later")
+            self._early_packets.append(data)
 
     def is_synchronous(self):
         return self._is_synchronous
@@ -93,6 +264,64 @@ class GantryInterface :
         logger.debug("interface thread started")
 
 
+def process_control_token(interface, data, tlogger, reply):
+    """Process a synchronisation token received over the control or the bulk channel.
+
+    :type interface: GantryInterface
+    :param reply: function sending a packet back over the channel the token came from
+    """
+    t = threading.current_thread()
+    token, args = packet.parse_control(data)
+    if token == '@LOCK':
+        AKIPrintString("%s: locking other threads" % t.name)
+        #GLOBALS.lock.acquire()
+        AKIPrintString("%s: locked other threads" % t.name)
+    elif token == packet.UNLOCK:
+        AKIPrintString("%s: unlocking other threads" % t.name)
+        tlogger.debug("command: UNLOCK")
+        if args:
+            # Control channel: the token carries the bulk sequence number and its send time
+            interface.control_latency.add(time.time() - float(args[1]))
+            interface.wait_for_bulk_packets(int(args[0]))
+        if interface.is_synchronous():
+            # Receiving a message means receiving a command and we shall therefore unlock the AAPI thread.
+            if LOCK.locked():
+                logger.debug("releasing lock")
+                LOCK.release()
+                logger.debug("lock released")
+            else:
+                tlogger.warning("synchronous interface but lock has not been locked - synchronisation problems?")
+        else:
+            tlogger.warning("@UNLOCK command is ignored in asynchronous operation mode")
+        AKIPrintString("%s: unlocked other threads" % t.name)
+    elif token == packet.PING:
+        # Heartbeat of the server, echo it back with our time stamp
+        interface.control_latency.add(time.time() - float(args[1]))
+        reply(packet.make_pong(args))
+    elif token == '@EXIT':
+        AKIPrintString("%s: exit requested" % t.name)
+    else:
+        tlogger.warning("unknown control token %s ignored" % repr(data))
+
+
+def gantry_control_thread(interface):
+    """Communication thread servicing the control channel, so that synchronisation tokens
+    are not delayed by packets being processed by `gantry_socket_thread`.
+
+    :type interface: GantryInterface
+    """
+    tlogger = logging.getLogger('aapi_gantry.interface.control')
+    t = threading.current_thread()
+    AKIPrintString("%s: control channel thread started" % t.name)
+    while True:
+        data = interface.receive_control_packet()
+        if data is None:
+            tlogger.debug("control channel closed")
+            break
+        process_control_token(interface, data, tlogger, interface.send_control_packet)
+    AKIPrintString("%s: exitting" % t.name)
+
+
 def gantry_socket_thread(interface):
     """Communication thread for the SIRID gantry interface,.
 
@@ -112,7 +341,7 @@ def gantry_socket_thread(interface):
     sirid_socket.connect(('localhost', 1251))
 
     interface.set_socket(sirid_socket)
-    interface.send_data_packet("AIMSUN_UP_AND_RUNNING")
+    interface.send_data_packet(packet.AIMSUN_UP)
 
     AKIPrintString("%s: sent message to sirid server" % t.name)
     tlogger.debug("sent AIMSUN_UP_AND_RUNNING, waiting on configuration data")
@@ -121,6 +350,14 @@ def gantry_socket_thread(interface):
 
     tlogger.debug("got configuration data")
 
+    if interface.has_control_channel():
+        control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        control_socket.connect(('localhost', 1251))
+        interface.set_control_socket(control_socket)
+        control_thread = threading.Thread(target=gantry_control_thread, args=(interface,))
+        control_thread.start()
+        tlogger.debug("control channel connected")
+
     if interface.is_synchronous():
         # For the synchronous operation mode we have to lock the execution of Aimsun after sending detector data
         if LOCK.locked():
@@ -132,30 +369,28 @@ def gantry_socket_thread(interface):
 
     # Now enter the loop processing commands
     tlogger.debug("entering the main loop")
+    # Commands of the parts of a controller message received so far
+    message_commands = []
     while True:
 
         data = interface.receive_data_packet()
-
-        if data == '@LOCK':
-            AKIPrintString("%s: locking other threads" % t.name)
-            #GLOBALS.lock.acquire()
-            AKIPrintString("%s: locked other threads" % t.name)
-        elif data == '@UNLOCK':
-            AKIPrintString("%s: unlocking other threads" % t.name)
-            tlogger.debug("command: UNLOCK")
-            if interface.is_synchronous():
-                # Receiving a message means receiving a command and we shall therefore unlock the AAPI thread.
-                if LOCK.locked():
-                    logger.debug("releasing lock")
-                    LOCK.release()
-                    logger.debug("lock released")
-                else:
-                    tlogger.warning("synchronous interface but lock has not been locked - synchronisation problems?")
-            else:
-                tlogger.warning("@UNLOCK command is ignored in asynchronous operation mode")
-            AKIPrintString("%s: unlocked other threads" % t.name)
-        elif data == '@EXIT':
-            AKIPrintString("%s: exit requested" % t.name)
+        if not data:
+            tlogger.debug("connection closed by the server")
+            break
+
+        if data.startswith('@'):
+            process_control_token(interface, data, tlogger, interface.send_data_packet)
+        elif packet.is_command_batch(data):
+            # The whole batch goes into the queue as a single item, so AAPIManage() applies all
+            # commands of a controller message in the same simulation step. A message split
+            # into several batches is queued when its last part arrives.
+            commands = packet.decode_command_batch(data)
+            tlogger.debug("received batch of %d commands" % len(commands))
+            message_commands.extend(commands)
+            if not packet.command_batch_continues(data):
+                interface.put_command_batch(message_commands, packet.command_batch_time(data))
+                AKIPrintString("%s: batch of %d commands put into queue" % (t.name, len(message_commands)))
+                message_commands = []
         else:
             AKIPrintString("%s: received data `%s`" % (t.name, repr(data)))
             tlogger.debug("received data %s" % repr(data))
@@ -165,10 +400,12 @@ def gantry_socket_thread(interface):
             tlogger.debug("put command %s into queue" % repr(command_item))
             AKIPrintString("%s: Command item `%s` put into queue" % (t.name, repr(command_item)))
 
+        interface.bulk_packet_processed()
         AKIPrintString("%s: looping back to next recv()" % t.name)
 
     AKIPrintString("%s: closing socket" % t.name)
     tlogger.debug("closing socket")
+    interface.close()
     sirid_socket.close()
     # Create the server, binding to localhost on port 9999
     #server = SocketServer.TCPServer((HOST, PORT), GantryRequest)
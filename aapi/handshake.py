@@ -0,0 +1,124 @@
+#
+# Capability negotiation of the Aimsun extension and the SIRID server
+#
+# Protocol version 1 is the original handshake: the extension sends AIMSUN_UP and the server
+# replies with a pickled `{'synchronous': ...}` dictionary. Version 2 keeps this exchange,
+# so that any combination of old and new peers still connects:
+#
+# 1) the extension sends plain AIMSUN_UP,
+# 2) the server replies with the legacy configuration extended by `offer`, the dictionary of
+#    its own capabilities; old extensions ignore the unknown key,
+# 3) a new extension answers with CAPS_TOKEN followed by its pickled capabilities (an old
+#    server sends no offer and gets no answer),
+# 4) the server settles on the fastest common set of features (see `negotiate()`) and sends
+#    the final configuration. If no answer comes within HANDSHAKE_TIMEOUT, the server treats
+#    the extension as a version 1 peer and the first configuration stays in force. An
+#    extension that answers late still waits for the final configuration, so the server
+#    replies to a late answer with the version 1 configuration.
+#
+# The lists in the capabilities are ordered by preference, fastest first. Every feature
+# degrades to its version 1 behaviour if the peer does not announce it.
+#
+import pickle
+import packet
+import measurement_codec
+import shmring
+
+PROTOCOL_VERSION = 2
+CAPS_TOKEN = '@CAPS'
+# Seconds the server waits for the capabilities of the extension after sending its offer
+HANDSHAKE_TIMEOUT = 2.0
+
+# Largest number of commands in a single command batch the extension accepts
+MAX_BATCH_COMMANDS = 65535
+# Encoded size of a command in a batch (five 32-bit integers) and a conservative allowance
+# for the batch header and the table of gantry server ids, used to fit batches into the
+# 99999 bytes of the legacy framing. Larger messages are sent in parts, see
+# `packet.BATCH_VERSION_PARTS`.
+BATCH_COMMAND_SIZE = 20
+LEGACY_BATCH_COMMANDS = (99999 - 4096) // BATCH_COMMAND_SIZE
+
+
+def capabilities():
+    """Return the protocol capabilities of this implementation.
+
+    :rtype : dict
+    """
+    return {'version': PROTOCOL_VERSION,
+            'framing': packet.SUPPORTED_FRAMINGS,
+            'codec': measurement_codec.SUPPORTED_CODECS,
+            'compression': packet.SUPPORTED_COMPRESSIONS,
+            'transport': shmring.SUPPORTED_TRANSPORTS,
+            'batch': True,
+            'batch_version': packet.BATCH_VERSION_PARTS,
+            'max_batch_commands': MAX_BATCH_COMMANDS,
+            'control_channel': True,
+            'send_queue': packet.QUEUE_POLICIES,
+            'heartbeat': True}
+
+
+def make_caps_packet(caps):
+    """Return the packet announcing capabilities in reply to the offer of the server."""
+    return CAPS_TOKEN + pickle.dumps(caps, pickle.HIGHEST_PROTOCOL)
+
+
+def parse_caps_packet(data):
+    """Return the capabilities announced in the packet, or None if `data` is another packet.
+
+    :rtype : dict
+    """
+    data = str(data)
+    if data.startswith(CAPS_TOKEN):
+        return pickle.loads(data[len(CAPS_TOKEN):])
+    return None
+
+
+# Settings of the server (sirid_server.ini) that take part in the negotiation
+DEFAULT_PREFERENCES = {'transport': shmring.TRANSPORT_TCP,
+                       'compression': packet.COMPRESSION_ZLIB,
+                       'compression_level': packet.DEFAULT_COMPRESSION_LEVEL,
+                       'compression_threshold': packet.DEFAULT_COMPRESSION_THRESHOLD,
+                       'control_channel': True,
+                       # The send queue may drop measurements, it is used only if configured
+                       'send_queue_size': 0,
+                       'send_queue_policy': packet.QUEUE_DROP_OLDEST,
+                       'heartbeat_interval': packet.DEFAULT_HEARTBEAT_INTERVAL,
+                       'max_batch_commands': MAX_BATCH_COMMANDS}
+
+
+def negotiate(peer_caps, preferences=None):
+    """Settle the connection parameters given the capabilities announced by the peer and the
+    preferences of this side. An empty `peer_caps` yields the version 1 protocol.
+
+    :rtype : dict
+    """
+    prefs = dict(DEFAULT_PREFERENCES)
+    if preferences:
+        prefs.update(preferences)
+    settings = {'version': min(peer_caps.get('version', 1), PROTOCOL_VERSION)}
+    framing = packet.select_framing(peer_caps.get('framing', []))
+    settings['framing'] = framing
+    settings['codec'] = measurement_codec.select_codec(peer_caps.get('codec', []))
+    transport = shmring.select_transport(peer_caps.get('transport', []), prefs['transport'])
+    settings['transport'] = transport
+    compression = packet.select_compression(peer_caps.get('compression', []), framing, prefs['compression'])
+    if transport == shmring.TRANSPORT_SHM:
+        # Packets copied in memory are not worth compressing
+        compression = packet.COMPRESSION_NONE
+    settings['compression'] = {'method': compression, 'level': prefs['compression_level'],
+                               'threshold': prefs['compression_threshold']}
+    settings['batch'] = bool(peer_caps.get('batch', False))
+    settings['batch_version'] = min(peer_caps.get('batch_version', packet.BATCH_VERSION), packet.BATCH_VERSION_PARTS)
+    max_batch_commands = min(peer_caps.get('max_batch_commands', MAX_BATCH_COMMANDS), prefs['max_batch_commands'])
+    if framing == packet.FRAMING_LEGACY:
+        max_batch_commands = min(max_batch_commands, LEGACY_BATCH_COMMANDS)
+    settings['max_batch_commands'] = max(max_batch_commands, 1)
+    settings['control_channel'] = bool(peer_caps.get('control_channel', False)) and prefs['control_channel']
+    settings['send_queue'] = None
+    if prefs['send_queue_size'] > 0 and prefs['send_queue_policy'] in peer_caps.get('send_queue', []) and \
+            transport == shmring.TRANSPORT_TCP:
+        settings['send_queue'] = {'size': prefs['send_queue_size'], 'policy': prefs['send_queue_policy']}
+    settings['heartbeat'] = 0.0
+    if peer_caps.get('heartbeat', False) and prefs['heartbeat_interval'] > 0:
+        settings['heartbeat'] = prefs['heartbeat_interval']
+    return settings
@@ -0,0 +1,297 @@
+#
+# In-memory history of the detector measurements
+#
+# STATUS_CACHE keeps only the few latest long_status documents. A controller that reconnects,
+# or one that predicts the traffic from the last minutes of detector data, asks for the
+# history instead:
+#
+#   <gantry msg="get_history">
+#     <seq_nr>120</seq_nr>                   intervals newer than document 120
+#     <from>2015-06-01 07:30:00</from>       intervals with the time stamp in the range,
+#     <to>2015-06-01 07:45:00</to>           both ends included
+#     <seconds>900</seconds>                 intervals of the last 900 seconds of simulation time
+#     <last>15</last>                        at most the 15 newest of the selected intervals
+#     <gantry_server>R01-R-MX20*</gantry_server>
+#     <device>20</device>                    detectors and vehicle categories, as in a
+#     <category>2</category>                 subscription (see `subscription`), or by name
+#     <detector>D1234</detector>
+#   </gantry>
+#
+# All elements are optional and may be combined; all but the range elements may be repeated.
+# The reply holds one series of values per detector, category and quantity, the values of
+# the selected intervals separated by spaces (`nan` for a missing value):
+#
+#   <root msg="history" intervals="3">
+#     <interval seq_nr="118" send_time="2015-06-01 07:44:00"/>
+#     ...
+#     <detector device="20" gantry="R01-R-MX20" id="D1234" lane="1" subdevice="3">
+#       <category id="2"><intensity>12 9 14</intensity><speed>...</speed><occupancy>...</occupancy></category>
+#     </detector>
+#   </root>
+#
+# The measurements are kept as they come from Aimsun, in a ring of flat value arrays (see
+# `measurement_codec`) preallocated for `size` intervals or `max_bytes` bytes, whichever is
+# less. The history starts over when the detector schema changes.
+#
+import calendar
+import threading
+import time
+from array import array
+import gantry
+import linkstats
+import long_status
+import measurement_codec as mc
+import subscription
+
+# Number of detection intervals kept, 0 disables the history
+DEFAULT_SIZE = 60
+# Upper limit of the memory taken by the measured values
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# Format of the time stamps of the measurements, see `aapi_gantry`; the time stamps of this
+# format sort as strings
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+QUANTITIES = (('intensity', mc.COUNT), ('speed', mc.SPEED), ('occupancy', mc.OCCUPANCY))
+
+
+class HistoryQuery(object):
+    """Intervals and detectors selected by a `get_history` request. None or an empty tuple
+    means no restriction."""
+
+    def __init__(self, seq_nr=None, from_time=None, to_time=None, seconds=None, last=None,
+                 detectors=(), selection=None):
+        """
+        :type selection: subscription.Subscription
+        """
+        self.seq_nr = seq_nr
+        self.from_time = from_time
+        self.to_time = to_time
+        self.seconds = seconds
+        self.last = last
+        self.detectors = frozenset(detectors)
+        if selection is None:
+            selection = subscription.Subscription()
+        self.selection = selection
+
+    def matches_detector(self, det_name, det_map):
+        """Return True if the detector with the descriptor `(name, gantry_ld_map tuple)` is
+        selected."""
+        if self.detectors and det_name not in self.detectors:
+            return False
+        if not self.selection.matches_gantry_server(det_map[0]):
+            return False
+        return not self.selection.devices or str(det_map[1]) in self.selection.devices
+
+    def categories(self):
+        """Return the ids of the selected vehicle categories."""
+        if not self.selection.categories:
+            return range(long_status.NUM_CATEGORIES)
+        return [id_category for id_category in xrange(long_status.NUM_CATEGORIES)
+                if str(id_category) in self.selection.categories]
+
+
+def parse_history_request(root):
+    """Return the HistoryQuery of a `<gantry msg="get_history">` request.
+
+    :type root: Et.Element
+    :rtype : HistoryQuery
+    """
+    numbers = {'seq_nr': None, 'seconds': None, 'last': None}
+    times = {'from': None, 'to': None}
+    detectors = []
+    selection = []
+    for node in root:
+        text = (node.text or '').strip()
+        if not text:
+            raise ValueError('Empty history element <%s>' % node.tag)
+        if node.tag in numbers:
+            try:
+                numbers[node.tag] = int(text)
+            except ValueError:
+                raise ValueError('Invalid number %s in <%s>' % (repr(text), node.tag))
+        elif node.tag in times:
+            try:
+                time.strptime(text, TIME_FORMAT)
+            except ValueError:
+                raise ValueError('Invalid time stamp %s in <%s>' % (repr(text), node.tag))
+            times[node.tag] = text
+        elif node.tag == 'detector':
+            detectors.append(text)
+        elif node.tag in ('gantry_server', 'device', 'category'):
+            selection.append(node)
+        else:
+            raise ValueError('Unsupported history element <%s>' % node.tag)
+    # The detector and category elements have the meaning they have in a subscription
+    envelope = root.makeelement('gantry', {})
+    for node in selection:
+        envelope.append(node)
+    return HistoryQuery(numbers['seq_nr'], times['from'], times['to'], numbers['seconds'], numbers['last'],
+                        detectors, subscription.parse_subscription(envelope))
+
+
+def time_before(time_str, seconds):
+    """Return the time stamp `seconds` before `time_str`."""
+    timestamp = calendar.timegm(time.strptime(time_str, TIME_FORMAT))
+    return time.strftime(TIME_FORMAT, time.gmtime(timestamp - seconds))
+
+
+def format_value(value):
+    # NaN is the only value that is not equal to itself, see `mc.is_missing()`
+    if value != value:
+        return 'nan'
+    return str(value)
+
+
+def format_count(value):
+    if value != value:
+        return 'nan'
+    return str(int(value))
+
+
+class MeasurementHistory(object):
+    """Ring of the measurements of the last detection intervals."""
+
+    def __init__(self, size=DEFAULT_SIZE, max_bytes=DEFAULT_MAX_BYTES):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.counters = linkstats.Counters()
+        self._lock = threading.Lock()
+        self.schema = None
+        # Number of intervals the ring holds and the number of values of an interval
+        self.capacity = 0
+        self.width = 0
+        # Values of the intervals, interval `slot` starts at `slot * width`
+        self._values = array('d')
+        self._seq_nrs = []
+        self._time_strs = []
+        # Slot written next and the number of intervals held
+        self._next = 0
+        self._count = 0
+
+    def _reset(self, schema, width):
+        """Allocate the ring for a new detector schema."""
+        self.schema = schema
+        self.width = width
+        capacity = max(self.size, 0)
+        if width:
+            capacity = min(capacity, int(self.max_bytes) // (width * self._values.itemsize))
+        self.capacity = capacity
+        self._values = array('d', [mc.MISSING]) * (capacity * width)
+        self._seq_nrs = [None] * capacity
+        self._time_strs = [None] * capacity
+        self._next = 0
+        self._count = 0
+        self.counters.add('resets')
+
+    def add(self, schema, seq_nr, time_str, values):
+        """Store the measurements of a detection interval.
+
+        :param schema: list of `(name, gantry_ld_map tuple)` detector descriptors
+        :param values: flat value array, see `measurement_codec`
+        """
+        if not isinstance(values, array) or values.typecode != 'd':
+            values = array('d', values)
+        with self._lock:
+            if (self.schema is not schema and self.schema != schema) or self.width != len(values):
+                self._reset(schema, len(values))
+            if not self.capacity:
+                return
+            slot = self._next
+            start = slot * self.width
+            self._values[start:start + self.width] = values
+            self._seq_nrs[slot] = seq_nr
+            self._time_strs[slot] = time_str
+            self._next = (slot + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+        self.counters.add('intervals_added')
+
+    def __len__(self):
+        return self._count
+
+    def _slots(self):
+        """Return the occupied slots, oldest first. Called with the lock held."""
+        first = (self._next - self._count) % self.capacity if self.capacity else 0
+        return [(first + i) % self.capacity for i in xrange(self._count)]
+
+    def _select_slots(self, query):
+        """Return the slots of the intervals selected by the query. Called with the lock held.
+
+        :type query: HistoryQuery
+        """
+        slots = self._slots()
+        newest_slot = slots and slots[-1]
+        if query.seq_nr is not None:
+            slots = [slot for slot in slots if self._seq_nrs[slot] > query.seq_nr]
+        if query.from_time is not None:
+            slots = [slot for slot in slots if self._time_strs[slot] >= query.from_time]
+        if query.to_time is not None:
+            slots = [slot for slot in slots if self._time_strs[slot] <= query.to_time]
+        if query.seconds is not None and slots:
+            from_time = time_before(self._time_strs[newest_slot], query.seconds)
+            slots = [slot for slot in slots if self._time_strs[slot] >= from_time]
+        if query.last is not None:
+            slots = slots[max(len(slots) - query.last, 0):]
+        return slots
+
+    def query(self, query):
+        """Render the reply to a `get_history` request.
+
+        :type query: HistoryQuery
+        :rtype : str
+        """
+        self.counters.add('queries')
+        categories = query.categories()
+        # Copy the selected values with the lock held and format them without it
+        with self._lock:
+            slots = self._select_slots(query)
+            intervals = [(self._seq_nrs[slot], self._time_strs[slot]) for slot in slots]
+            starts = [slot * self.width for slot in slots]
+            values = self._values
+            detectors = []
+            for pos_detector, (det_name, det_map) in enumerate(self.schema or ()):
+                if not query.matches_detector(det_name, det_map):
+                    continue
+                base = pos_detector * mc.VALUES_PER_DETECTOR
+                series = []
+                for id_category in categories:
+                    pos = base + id_category * mc.NUM_QUANTITIES
+                    series.append([[values[start + pos + quantity] for start in starts]
+                                   for name, quantity in QUANTITIES])
+                detectors.append((det_name, det_map, series))
+        parts = ['<?xml version="1.0" encoding="UTF-8" ?>\n',
+                 long_status.start_tag('root', {'msg': 'history', 'intervals': str(len(intervals))}, 0), '\n']
+        for seq_nr, time_str in intervals:
+            parts.append(long_status.start_tag('interval', {'seq_nr': str(seq_nr), 'send_time': time_str}, 2, True))
+        for det_name, det_map, series in detectors:
+            id_gantry_server, id_device, device_type, id_sub_device, \
+                sub_device_type, sub_device_description, id_lane, det_type, str_lane, prefix = det_map
+            parts.append(long_status.start_tag('detector', {'id': det_name, 'gantry': id_gantry_server,
+                                                            'device': str(id_device),
+                                                            'subdevice': str(id_sub_device),
+                                                            'lane': str(id_lane)}, 2) + '\n')
+            for id_category, category_series in zip(categories, series):
+                parts.append(long_status.start_tag('category', {'id': gantry.CATEGORY[id_category]['id']}, 4))
+                for (name, quantity), quantity_values in zip(QUANTITIES, category_series):
+                    if quantity == mc.COUNT:
+                        text = ' '.join([format_count(value) for value in quantity_values])
+                    else:
+                        text = ' '.join([format_value(value) for value in quantity_values])
+                    parts.append('<%s>%s</%s>' % (name, text, name))
+                parts.append('</category>\n')
+            parts.append(long_status.end_tag('detector', 2))
+        parts.append(long_status.end_tag('root', 0))
+        self.counters.add('intervals_sent', len(intervals))
+        return ''.join(parts)
+
+    def get_stats(self):
+        """Return the statistics of the history.
+
+        :rtype : dict
+        """
+        stats = self.counters.snapshot()
+        with self._lock:
+            stats['capacity'] = self.capacity
+            stats['intervals'] = self._count
+            stats['bytes'] = len(self._values) * self._values.itemsize
+        return stats
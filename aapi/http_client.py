@@ -0,0 +1,80 @@
+#!/usr/bin/python
+#
+# Client of the HTTP gateway of the SIRID server
+#
+# Fetches a single long_status document, or follows the event stream of the gateway and
+# prints a line per received document:
+#
+#   python http_client.py [host:port] [/long_status.json | /stream | /stream.json] [events]
+#
+import socket
+import sys
+import time
+
+
+def read_head(sock_file):
+    """Read the status line and the headers of a response."""
+    status = sock_file.readline().rstrip('\r\n')
+    headers = {}
+    while True:
+        line = sock_file.readline().rstrip('\r\n')
+        if not line:
+            return status, headers
+        name, sep, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+
+def read_events(sock_file):
+    """Yield the server-sent events of a stream as `(id, event, data)`."""
+    fields = {'id': None, 'event': 'message'}
+    data = []
+    while True:
+        line = sock_file.readline()
+        if not line:
+            return
+        line = line.rstrip('\r\n')
+        if not line:
+            yield fields['id'], fields['event'], '\n'.join(data)
+            fields = {'id': None, 'event': 'message'}
+            data = []
+            continue
+        name, sep, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+        if name == 'data':
+            data.append(value)
+        elif name in fields:
+            fields[name] = value
+
+
+def main(argv):
+    host, port = 'localhost', 8080
+    path = '/stream'
+    max_events = 0
+    if len(argv) > 1:
+        host, sep, port = argv[1].partition(':')
+        port = int(port or 8080)
+    if len(argv) > 2:
+        path = argv[2]
+    if len(argv) > 3:
+        max_events = int(argv[3])
+    sock = socket.create_connection((host, port))
+    sock.sendall('GET %s HTTP/1.1\r\nHost: %s\r\nAccept: */*\r\n\r\n' % (path, host))
+    sock_file = sock.makefile('rb')
+    status, headers = read_head(sock_file)
+    print status
+    if not headers.get('content-type', '').startswith('text/event-stream'):
+        print sock_file.read(int(headers.get('content-length', 0)))
+        return
+    received = 0
+    start = time.time()
+    for event_id, event, data in read_events(sock_file):
+        received += 1
+        print '%8.3f s  event %s id %s, %d bytes' % (time.time() - start, event, event_id, len(data))
+        if received == max_events:
+            break
+    sock.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
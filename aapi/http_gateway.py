@@ -0,0 +1,318 @@
+#!/usr/bin/python
+#
+# HTTP streaming gateway for read-only long_status consumers
+#
+# Dashboards and other viewers do not need the XML command protocol of the controllers. The
+# gateway serves them over plain HTTP from a single event-loop thread (see event_server), so
+# that they neither cost a server thread each nor interfere with the controller connections:
+#
+#   GET /long_status.xml     the latest long_status document
+#   GET /long_status.json    the latest document converted to JSON
+#   GET /stream              server-sent events, one `long_status` event per document with
+#   GET /stream.json         the sequence number as the event id; a reconnecting client that
+#                            sends Last-Event-ID gets the documents it missed first
+#
+# Every document is encoded once per format and the same string is queued for all viewers.
+# The encoding happens in the gateway thread, not in the thread publishing the documents.
+# The outbound queue of a viewer keeps only the latest document, a slow viewer skips frames.
+#
+# Running this module starts a standalone gateway publishing random long_status documents of
+# a network every few seconds, which is enough to try the gateway with `http_client.py` or a
+# web browser:
+#
+#   python http_gateway.py [port] [period] [network.xml]
+#
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import xml.etree.ElementTree as Et
+try:
+    import xml.etree.cElementTree as CEt
+except ImportError:
+    CEt = Et
+import event_server
+import linkstats
+import long_status
+import measurement_codec as mc
+import outbound
+import status_cache
+
+FORMAT_XML = 'xml'
+FORMAT_JSON = 'json'
+CONTENT_TYPES = {FORMAT_XML: 'application/xml; charset=utf-8', FORMAT_JSON: 'application/json'}
+
+# Largest request head accepted from a viewer
+MAX_REQUEST_SIZE = 16 * 1024
+
+
+def element_to_dict(element):
+    """Convert a long_status element into a dictionary: attributes become keys, text-only
+    children become values and repeated element children become lists named by their tag
+    with an `s` appended (`devices`, `lanes`, `categories`, ...)."""
+    result = dict(element.attrib)
+    for child in element:
+        if len(child) or child.attrib:
+            name = child.tag + 's'
+            if child.tag.endswith('y'):
+                name = child.tag[:-1] + 'ies'
+            result.setdefault(name, []).append(element_to_dict(child))
+        else:
+            result[child.tag] = child.text
+    return result
+
+
+def long_status_to_json(xml_string):
+    """Convert a long_status document into JSON.
+
+    :rtype : str
+    """
+    if isinstance(xml_string, unicode):
+        xml_string = xml_string.encode('utf-8')
+    root = CEt.fromstring(xml_string)
+    return json.dumps(element_to_dict(root), separators=(',', ':'), sort_keys=True)
+
+
+def to_utf8(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
+def sse_event(event_id, event, data):
+    """Return a server-sent event; every line of `data` becomes a `data:` field."""
+    lines = ['id: %s' % event_id, 'event: %s' % event]
+    for line in to_utf8(data).splitlines():
+        lines.append('data: ' + line)
+    return '\n'.join(lines) + '\n\n'
+
+
+def http_response(status, content_type, body, extra_headers=()):
+    headers = ['HTTP/1.1 %s' % status, 'Content-Type: %s' % content_type, 'Content-Length: %d' % len(body),
+               'Cache-Control: no-cache', 'Access-Control-Allow-Origin: *', 'Connection: close']
+    headers.extend(extra_headers)
+    return '\r\n'.join(headers) + '\r\n\r\n' + body
+
+
+SSE_HEAD = '\r\n'.join(['HTTP/1.1 200 OK', 'Content-Type: text/event-stream', 'Cache-Control: no-cache',
+                        'Access-Control-Allow-Origin: *', 'Connection: keep-alive']) + '\r\n\r\n'
+
+
+class HttpGateway(object):
+    """The gateway. `publish()` is called with every new entry of the status cache."""
+
+    def __init__(self, server_address, cache):
+        """
+        :type cache: status_cache.StatusCache
+        """
+        self.cache = cache
+        self.counters = linkstats.Counters()
+        self.server = event_server.EventLoopServer(server_address, self._make_viewer)
+        self.server_address = self.server.server_address
+        self._lock = threading.Lock()
+        # Viewers of the event streams by connection name, values are `(viewer, format)`
+        self._streams = {}
+        # The newest published entry not pushed to the viewers yet
+        self._pending = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='http-gateway')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def shutdown(self):
+        self.server.shutdown()
+        if self._thread is not None:
+            self._thread.join()
+        self.server.server_close()
+
+    def _make_viewer(self, connection):
+        return HttpViewer(self, connection)
+
+    def encoded(self, entry, kind, fmt):
+        """Return the document of a status cache entry encoded as a complete HTTP response
+        (`kind` 'http') or as a server-sent event ('sse'). Each variant is encoded once and
+        kept in the entry."""
+        seq_nr, xml_string, encoded_cache = entry
+        key = ('http_gateway', kind, fmt)
+        try:
+            return encoded_cache[key]
+        except KeyError:
+            pass
+        body = xml_string
+        if fmt == FORMAT_JSON:
+            body = long_status_to_json(xml_string)
+        if kind == 'sse':
+            data = sse_event(seq_nr, 'long_status', body)
+        else:
+            body = to_utf8(body)
+            extra_headers = []
+            if seq_nr is not None:
+                extra_headers.append('ETag: "%d"' % seq_nr)
+            data = http_response('200 OK', CONTENT_TYPES[fmt], body, extra_headers)
+        self.counters.add('encoded_documents')
+        encoded_cache[key] = data
+        return data
+
+    def subscribe(self, viewer, fmt):
+        with self._lock:
+            self._streams[viewer.connection.name] = (viewer, fmt)
+
+    def unsubscribe(self, viewer):
+        with self._lock:
+            self._streams.pop(viewer.connection.name, None)
+
+    def publish(self, entry):
+        """Push a new status cache entry to the viewers of the event streams. The entry is
+        encoded and queued for the viewers by the gateway thread, so the caller (the Aimsun
+        receiver thread) never waits for the JSON conversion; an entry not pushed yet is
+        replaced by the newer one."""
+        with self._lock:
+            if self._pending is not None:
+                self.counters.add('coalesced_documents')
+            self._pending = entry
+        self.server.call_soon(self._push_pending)
+
+    def _push_pending(self):
+        with self._lock:
+            entry = self._pending
+            self._pending = None
+            streams = self._streams.values()
+        if entry is None:
+            return
+        for viewer, fmt in streams:
+            viewer.connection.queue.put(self.encoded(entry, 'sse', fmt), frame=True)
+        self.counters.add('published_documents')
+        self.counters.add('pushed_events', len(streams))
+
+    def get_stats(self):
+        """Return the statistics of the gateway.
+
+        :rtype : dict
+        """
+        stats = self.counters.snapshot()
+        with self._lock:
+            stats['streams'] = len(self._streams)
+        stats['connections'] = self.server.connection_count()
+        return stats
+
+
+class HttpViewer(object):
+    """Handler of a viewer connection of the gateway."""
+
+    def __init__(self, gateway, connection):
+        """
+        :type gateway: HttpGateway
+        :type connection: event_server.Connection
+        """
+        self.gateway = gateway
+        self.connection = connection
+        self.request = ''
+        self.handled = False
+        connection.queue.configure(0, outbound.POLICY_LATEST)
+
+    def data_received(self, data):
+        if self.handled:
+            # Viewers are read-only
+            return
+        self.request += data
+        head_end = self.request.find('\r\n\r\n')
+        if head_end == -1:
+            if len(self.request) > MAX_REQUEST_SIZE:
+                self.respond('431 Request Header Fields Too Large', 'request head too large\n')
+            return
+        self.handled = True
+        lines = self.request[:head_end].split('\r\n')
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        try:
+            method, target, version = lines[0].split(' ', 2)
+        except ValueError:
+            self.respond('400 Bad Request', 'malformed request line\n')
+            return
+        self.handle_request(method, target.split('?', 1)[0], headers)
+
+    def respond(self, status, text):
+        self.gateway.counters.add('errors')
+        self.connection.write(http_response(status, 'text/plain', text))
+        self.connection.close_when_sent()
+
+    def handle_request(self, method, path, headers):
+        if method != 'GET':
+            self.respond('405 Method Not Allowed', 'only GET is supported\n')
+            return
+        if path in ('/long_status.xml', '/long_status.json'):
+            fmt = path.rsplit('.', 1)[1]
+            entry = self.gateway.cache.latest()
+            if entry is None or not entry[1]:
+                self.respond('404 Not Found', 'no measurements available\n')
+                return
+            self.gateway.counters.add('document_requests')
+            self.connection.write(self.gateway.encoded(entry, 'http', fmt))
+            self.connection.close_when_sent()
+        elif path in ('/stream', '/stream.xml', '/stream.json'):
+            fmt = FORMAT_XML
+            if path.endswith('.json'):
+                fmt = FORMAT_JSON
+            self.gateway.counters.add('stream_requests')
+            self.connection.write(SSE_HEAD)
+            # Start with the documents the viewer missed, or with the latest one
+            entries = [self.gateway.cache.latest()]
+            if 'last-event-id' in headers:
+                try:
+                    entries = self.gateway.cache.newer_than(int(headers['last-event-id']))
+                except ValueError:
+                    pass
+            # Written at once, frames would replace each other in the queue of the viewer
+            events = [self.gateway.encoded(entry, 'sse', fmt) for entry in entries
+                      if entry is not None and entry[1]]
+            if events:
+                self.connection.write(''.join(events))
+            self.gateway.subscribe(self, fmt)
+        else:
+            self.respond('404 Not Found', 'unknown resource %s\n' % path)
+
+    def connection_lost(self):
+        self.gateway.unsubscribe(self)
+
+
+def main(argv):
+    port = 8080
+    period = 5.0
+    network_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../sokp/sokp_v7.xml')
+    if len(argv) > 1:
+        port = int(argv[1])
+    if len(argv) > 2:
+        period = float(argv[2])
+    if len(argv) > 3:
+        network_path = argv[3]
+    logging.basicConfig()
+    schema = mc.load_schema(network_path)
+    values = mc.new_values(len(schema))
+    cache = status_cache.StatusCache()
+    gateway = HttpGateway(('', port), cache)
+    gateway.start()
+    print 'HTTP gateway on port %d, publishing a document of %d detectors every %.1f seconds' % (
+        gateway.server_address[1], len(schema), period)
+    seq_nr = 0
+    try:
+        while True:
+            seq_nr += 1
+            for pos in xrange(len(values)):
+                values[pos] = random.uniform(0.0, 100.0)
+            time_str = time.strftime('%Y-%m-%d %H:%M:%S')
+            xml_string = long_status.render_long_status(schema, time_str, values, seq_nr)
+            gateway.publish(cache.add(seq_nr, xml_string))
+            time.sleep(period)
+    except KeyboardInterrupt:
+        gateway.shutdown()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,153 @@
+#
+# Counters and statistics of the SIRID communication links
+#
+# Every component that wants to expose its statistics registers a provider, that is, a
+# callable returning a dictionary of values. The SIRID server renders a snapshot of all
+# providers as a reply to the `get_stats` request.
+#
+import threading
+from collections import deque
+
+
+class Counters(object):
+    """A thread-safe set of named counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def add(self, name, value=1):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + value
+
+    def set(self, name, value):
+        with self._lock:
+            self._values[name] = value
+
+    def get(self, name, default=0):
+        with self._lock:
+            return self._values.get(name, default)
+
+    def snapshot(self):
+        """Return a copy of all counter values.
+
+        :rtype : dict
+        """
+        with self._lock:
+            return dict(self._values)
+
+
+class LatencyStats(object):
+    """Thread-safe summary (count, mean, maximum and last value) of latency samples in seconds."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+        self._last = 0.0
+
+    def add(self, seconds):
+        with self._lock:
+            self._count += 1
+            self._total += seconds
+            self._last = seconds
+            if seconds > self._max:
+                self._max = seconds
+
+    def snapshot(self, prefix=''):
+        """Return the summary as a dictionary with keys prefixed by `prefix`.
+
+        :rtype : dict
+        """
+        with self._lock:
+            mean = 0.0
+            if self._count:
+                mean = self._total / self._count
+            return {prefix + 'count': self._count, prefix + 'mean': mean,
+                    prefix + 'max': self._max, prefix + 'last': self._last}
+
+
+class RollingPercentiles(object):
+    """Thread-safe distribution of the last `window` latency samples in seconds.
+
+    The snapshot holds the 50th, 95th and 99th percentile and the maximum of the window, and a
+    histogram of all samples ever added with bucket upper bounds in HISTOGRAM_BOUNDS."""
+
+    # Upper bounds of the histogram buckets in seconds, the last bucket is unbounded
+    HISTOGRAM_BOUNDS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0]
+
+    def __init__(self, window=1000):
+        self._lock = threading.Lock()
+        self._samples = deque()
+        self._window = window
+        self._count = 0
+        self._histogram = [0] * (len(self.HISTOGRAM_BOUNDS) + 1)
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            if len(self._samples) > self._window:
+                self._samples.popleft()
+            self._count += 1
+            bucket = 0
+            while bucket < len(self.HISTOGRAM_BOUNDS) and seconds > self.HISTOGRAM_BOUNDS[bucket]:
+                bucket += 1
+            self._histogram[bucket] += 1
+
+    def snapshot(self, prefix=''):
+        """Return the percentiles and the histogram as a dictionary with keys prefixed by `prefix`.
+
+        :rtype : dict
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+            stats = {prefix + 'count': self._count}
+            histogram = list(self._histogram)
+        for name, fraction in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99)):
+            value = 0.0
+            if samples:
+                value = samples[min(len(samples) - 1, int(fraction * len(samples)))]
+            stats[prefix + name] = value
+        stats[prefix + 'max'] = 0.0
+        if samples:
+            stats[prefix + 'max'] = samples[-1]
+        for bound, count in zip(self.HISTOGRAM_BOUNDS, histogram):
+            stats['%shist_le_%gms' % (prefix, 1000.0 * bound)] = count
+        stats[prefix + 'hist_inf'] = histogram[-1]
+        return stats
+
+
+def ratio(numerator, denominator):
+    """Return numerator/denominator as float, or zero if the denominator is zero."""
+    if not denominator:
+        return 0.0
+    return float(numerator) / denominator
+
+
+_PROVIDERS = {}
+_PROVIDERS_LOCK = threading.Lock()
+
+
+def register(name, provider):
+    """Register a callable returning a dictionary of statistics under the given name."""
+    with _PROVIDERS_LOCK:
+        _PROVIDERS[name] = provider
+
+
+def unregister(name):
+    with _PROVIDERS_LOCK:
+        _PROVIDERS.pop(name, None)
+
+
+def snapshot():
+    """Return a dictionary of statistics of all registered providers indexed by provider names.
+
+    :rtype : dict[str,dict]
+    """
+    with _PROVIDERS_LOCK:
+        providers = _PROVIDERS.items()
+    stats = {}
+    for name, provider in providers:
+        stats[name] = provider()
+    return stats
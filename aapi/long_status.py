@@ -0,0 +1,407 @@
+#
+# Rendering of detector measurements into the `long_status` XML document sent to controllers
+#
+import re  # needed for re-formatting minidom output (only for Python <= 2.6
+import base64
+import logging
+import zlib
+from collections import defaultdict
+import xml.etree.ElementTree as Et
+from xml.dom import minidom
+import gantry  # needed for CATEOGRY definition list
+import measurement_codec as mc
+
+# See http://stackoverflow.com/questions/749796/pretty-printing-xml-in-python
+MINIDOM_TEXT_RE = re.compile('>\n\s+([^<>\s].*?)\n\s+</', re.DOTALL)
+
+# Number of vehicle categories reported to the controllers
+NUM_CATEGORIES = 9
+# Parts of a category in the skeleton of LongStatusTemplate: the start of the category, the
+# number of vehicles, the speed and the occupancy, each value followed by the markup after it
+CATEGORY_PARTS = 7
+
+LOGGER = logging.getLogger('sirid_server.long_status')
+
+
+def recursive_defaultdict():
+    return defaultdict(recursive_defaultdict)
+
+
+def group_detectors(schema):
+    """Group the detectors by gantry server, device, sub-device and lane.
+
+    Returns a tuple `(gantry_server, gs_device_type, gs_sub_device_type)` of nested
+    dictionaries; the lanes of `gantry_server` hold `(det_type, det_name, prefix, str_lane,
+    base)` tuples, where `base` is the position of the values of the detector in the value
+    array. Both renderers iterate these dictionaries, so the elements come in the same order.
+
+    :param schema: list of `(name, gantry_ld_map tuple)` detector descriptors
+    """
+    gantry_server = recursive_defaultdict()
+    gs_device_type = recursive_defaultdict()
+    gs_sub_device_type = recursive_defaultdict()
+    for pos_detector, (det_name, det_map) in enumerate(schema):
+        # Consult aapi_gantry.py to see how these pieces are glued together
+        # TODO: This is ugly. Group the information into a class or some other structure.
+        id_gantry_server, id_device, device_type, id_sub_device, \
+            sub_device_type, sub_device_description, id_lane, det_type, str_lane, prefix = det_map
+        # Store information needed to construct the XML output
+        gs_device_type[id_gantry_server][id_device] = \
+            device_type
+        gs_sub_device_type[id_gantry_server][id_device][id_sub_device] = \
+            (sub_device_type, sub_device_description)
+        gantry_server[id_gantry_server][id_device][id_sub_device][id_lane] = \
+            (det_type, det_name, prefix, str_lane, pos_detector * mc.VALUES_PER_DETECTOR)
+    return gantry_server, gs_device_type, gs_sub_device_type
+
+
+def render_long_status_minidom(schema, time_str, values, seq_nr):
+    """Render measurements of a single detection interval as a pretty-printed `long_status`
+    XML document by building an element tree and pretty-printing it with minidom.
+
+    This is the reference implementation of the document format; the server renders the
+    documents with LongStatusTemplate, see `render_long_status()`.
+
+    :param schema: list of `(name, gantry_ld_map tuple)` detector descriptors
+    :param time_str: time stamp of the measurements
+    :param values: flat value array, see `measurement_codec`
+    :param seq_nr: sequence number of the document
+    :rtype : unicode
+    """
+    # Group the detectors by gantry server, device and sub-device
+    gantry_server, gs_device_type, gs_sub_device_type = group_detectors(schema)
+
+    envelope = Et.Element('root', attrib={'msg': 'long_status'})
+    for id_gantry_server in gantry_server:
+        # Create root element of the gantry server packet
+        root = Et.SubElement(envelope, 'gantry', attrib={'msg': 'long_status', 'id': id_gantry_server})
+        # print 'gantry server:', id_gantry_server
+        seq_nr_node = Et.SubElement(root, 'seq_nr')
+        seq_nr_node.text = str(seq_nr)
+        send_time_node = Et.SubElement(root, 'send_time')
+        send_time_node.text = str(time_str)
+        sender_node = Et.SubElement(root, 'sender')
+        sender_node.text = id_gantry_server
+        devices = gantry_server[id_gantry_server]
+        for id_device in devices:
+            device_type = gs_device_type[id_gantry_server][id_device]
+            device_node = Et.SubElement(root, 'device', attrib={'id': str(id_device), 'type': device_type})
+            sub_devices = devices[id_device]
+            for id_sub_device in sub_devices:
+                sub_device_type, sub_device_description = \
+                    gs_sub_device_type[id_gantry_server][id_device][id_sub_device]
+                sub_device_attribs = {'id': str(id_sub_device), 'time_stamp': time_str,
+                                      'type': sub_device_type, 'description': sub_device_description}
+                sub_device_node = Et.SubElement(device_node, 'subdevice', attrib=sub_device_attribs)
+                lanes = sub_devices[id_sub_device]
+                for id_lane in lanes:
+                    det_type, det_name, prefix, str_lane, base = lanes[id_lane]
+                    lane_node = Et.SubElement(sub_device_node,
+                                              'lane',
+                                              attrib={'id': str(id_lane), 'type': det_type, 'lane': str_lane})
+                    LOGGER.debug("   %d/%d/%d (%s,%s)" % (id_device, id_sub_device, id_lane, det_name, prefix))
+                    for i in xrange(NUM_CATEGORIES):
+                        category_node = Et.SubElement(lane_node, 'category', attrib=gantry.CATEGORY[i])
+                        count_node = Et.SubElement(category_node, 'intensity')
+                        speed_node = Et.SubElement(category_node, 'speed')
+                        occup_node = Et.SubElement(category_node, 'occupancy')
+                        pos = base + i * mc.NUM_QUANTITIES
+                        count = values[pos + mc.COUNT]
+                        speed = values[pos + mc.SPEED]
+                        occup = values[pos + mc.OCCUPANCY]
+                        if mc.is_missing(count) or mc.is_missing(speed) or mc.is_missing(occup):
+                            # Accept the situation when the model does not provide 9 classes of vehicles
+                            # TODO: This is just a kludge, the model does have to have 9 classes
+                            LOGGER.warning('Missing value when processing detector data of %s, category %d' %
+                                           (det_name, i))
+                            continue
+                        count_node.text = str(int(count))
+                        speed_node.text = str(float(speed))
+                        occup_node.text = str(float(occup))
+                        LOGGER.debug("    [%d]: %10f %10f %10f" % (i, count, speed, occup))
+
+    # See also http://pymotw.com/2/xml/etree/ElementTree/create.html for information about pretty-printing
+    minified_str = Et.tostring(envelope, 'UTF-8')
+    reparsed = minidom.parseString(minified_str)
+    xml_with_text_indents = reparsed.toprettyxml(indent="  ")
+    return MINIDOM_TEXT_RE.sub('>\g<1></', xml_with_text_indents)
+
+
+def escape(text):
+    """Escape text and attribute values the way minidom does."""
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+
+def to_utf8(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
+def start_tag(tag, attrib, indent, empty=False):
+    """Return the pretty-printed start tag with the attributes in the order of minidom."""
+    parts = [' ' * indent, '<', tag]
+    for name in sorted(attrib.keys()):
+        parts.append(' %s="%s"' % (name, escape(attrib[name])))
+    if empty:
+        parts.append('/>\n')
+    else:
+        parts.append('>')
+    return to_utf8(u''.join(parts))
+
+
+def end_tag(tag, indent):
+    return '%s</%s>\n' % (' ' * indent, tag)
+
+
+class LongStatusTemplate(object):
+    """The long_status document of a detector schema compiled into a skeleton.
+
+    The skeleton is a list of UTF-8 encoded fragments of the pretty-printed document with
+    slots left for the parts that change with every detection interval: the sequence number,
+    the time stamp and the measured values. Rendering copies the skeleton, fills the slots
+    and joins the list. The result is byte for byte the document rendered by
+    `render_long_status_minidom()`, encoded in UTF-8.
+    """
+
+    def __init__(self, schema):
+        """
+        :param schema: list of `(name, gantry_ld_map tuple)` detector descriptors
+        """
+        self.schema = schema
+        skeleton = ['<?xml version="1.0" ?>\n']
+        # Slots of the sequence number, of the time stamp as element text and as attribute
+        self.seq_nr_slots = []
+        self.time_text_slots = []
+        self.time_attrib_slots = []
+        # Lanes as `(slot, base, det_name)`; the lane has NUM_CATEGORIES categories of
+        # CATEGORY_PARTS parts each starting at `slot`
+        self.lanes = []
+        # Positions of the start tags of the gantry, device and sub-device of every lane, see
+        # `render_delta()`
+        self.lane_parents = []
+        # Categories as rendered without values, by category id
+        self.empty_categories = []
+        category_parts = []
+        for i in xrange(NUM_CATEGORIES):
+            category = start_tag('category', gantry.CATEGORY[i], 10)
+            self.empty_categories.append(''.join([category, '\n', start_tag('intensity', {}, 12, True),
+                                                  start_tag('speed', {}, 12, True),
+                                                  start_tag('occupancy', {}, 12, True), end_tag('category', 10)]))
+            category_parts.append([category + '\n' + start_tag('intensity', {}, 12), None,
+                                   '</intensity>\n' + start_tag('speed', {}, 12), None,
+                                   '</speed>\n' + start_tag('occupancy', {}, 12), None,
+                                   '</occupancy>\n' + end_tag('category', 10)])
+
+        gantry_server, gs_device_type, gs_sub_device_type = group_detectors(schema)
+        if not gantry_server:
+            skeleton.append(start_tag('root', {'msg': 'long_status'}, 0, True))
+        else:
+            skeleton.append(start_tag('root', {'msg': 'long_status'}, 0) + '\n')
+        for id_gantry_server in gantry_server:
+            gantry_pos = len(skeleton)
+            skeleton.append(start_tag('gantry', {'msg': 'long_status', 'id': id_gantry_server}, 2) + '\n' +
+                            start_tag('seq_nr', {}, 4))
+            self.seq_nr_slots.append(len(skeleton))
+            skeleton.append(None)
+            skeleton.append('</seq_nr>\n')
+            self.time_text_slots.append(len(skeleton))
+            skeleton.append(None)
+            skeleton.append(start_tag('sender', {}, 4) + to_utf8(escape(id_gantry_server)) + '</sender>\n')
+            devices = gantry_server[id_gantry_server]
+            for id_device in devices:
+                device_type = gs_device_type[id_gantry_server][id_device]
+                device_pos = len(skeleton)
+                skeleton.append(start_tag('device', {'id': str(id_device), 'type': device_type}, 4) + '\n')
+                sub_devices = devices[id_device]
+                for id_sub_device in sub_devices:
+                    sub_device_type, sub_device_description = \
+                        gs_sub_device_type[id_gantry_server][id_device][id_sub_device]
+                    # The time stamp attribute sorts between `id` and `type`
+                    head = start_tag('subdevice', {'id': str(id_sub_device), 'time_stamp': '',
+                                                   'type': sub_device_type,
+                                                   'description': sub_device_description}, 6)
+                    before, after = head.split(' time_stamp=""')
+                    sub_device_pos = len(skeleton)
+                    skeleton.append(before + ' time_stamp="')
+                    self.time_attrib_slots.append(len(skeleton))
+                    skeleton.append(None)
+                    skeleton.append('"' + after + '\n')
+                    lanes = sub_devices[id_sub_device]
+                    for id_lane in lanes:
+                        det_type, det_name, prefix, str_lane, base = lanes[id_lane]
+                        skeleton.append(start_tag('lane', {'id': str(id_lane), 'type': det_type,
+                                                           'lane': str_lane}, 8) + '\n')
+                        self.lanes.append((len(skeleton), base, det_name))
+                        self.lane_parents.append((gantry_pos, device_pos, sub_device_pos))
+                        for parts in category_parts:
+                            skeleton.extend(parts)
+                        skeleton.append(end_tag('lane', 8))
+                    skeleton.append(end_tag('subdevice', 6))
+                skeleton.append(end_tag('device', 4))
+            skeleton.append(end_tag('gantry', 2))
+        if gantry_server:
+            skeleton.append(end_tag('root', 0))
+        self.skeleton = skeleton
+
+    def render(self, time_str, values, seq_nr):
+        """Render the measurements of a single detection interval.
+
+        :param time_str: time stamp of the measurements
+        :param values: flat value array, see `measurement_codec`
+        :param seq_nr: sequence number of the document
+        :rtype : str
+        """
+        parts = self.skeleton[:]
+        seq_nr_str = str(seq_nr)
+        for slot in self.seq_nr_slots:
+            parts[slot] = seq_nr_str
+        time_attrib, time_text = self._time_parts(time_str)
+        for slot in self.time_text_slots:
+            parts[slot] = time_text
+        for slot in self.time_attrib_slots:
+            parts[slot] = time_attrib
+        empty_categories = self.empty_categories
+        num_quantities, speed_offset, occup_offset = mc.NUM_QUANTITIES, mc.SPEED, mc.OCCUPANCY
+        for slot, base, det_name in self.lanes:
+            for i in xrange(NUM_CATEGORIES):
+                pos = base + i * num_quantities
+                count = values[pos + mc.COUNT]
+                speed = values[pos + speed_offset]
+                occup = values[pos + occup_offset]
+                # NaN is the only value that is not equal to itself, see `mc.is_missing()`
+                if count != count or speed != speed or occup != occup:
+                    # Accept the situation when the model does not provide 9 classes of vehicles
+                    LOGGER.warning('Missing value when processing detector data of %s, category %d' %
+                                   (det_name, i))
+                    parts[slot] = empty_categories[i]
+                    parts[slot + 2] = parts[slot + 4] = parts[slot + 6] = ''
+                    parts[slot + 1] = parts[slot + 3] = parts[slot + 5] = ''
+                else:
+                    parts[slot + 1] = str(int(count))
+                    parts[slot + 3] = str(float(speed))
+                    parts[slot + 5] = str(float(occup))
+                slot += CATEGORY_PARTS
+        return ''.join(parts)
+
+    @staticmethod
+    def _time_parts(time_str):
+        """Return the time stamp as attribute value and as the <send_time> element."""
+        time_attrib = to_utf8(escape(time_str))
+        if time_attrib:
+            return time_attrib, '    <send_time>' + time_attrib + '</send_time>\n'
+        return time_attrib, '    <send_time/>\n'
+
+    def render_delta(self, time_str, values, seq_nr, base_values, base_seq_nr):
+        """Render a `long_status_delta` document with only the categories whose values
+        differ from `base_values`, the measurements of document `base_seq_nr`:
+
+        <root base_seq_nr="B" msg="long_status_delta" send_time="..." seq_nr="N">
+          <gantry id="..." msg="long_status">  ... as in long_status, but only the lanes with
+          changed categories and only the changed categories in them ... </gantry>
+        </root>
+
+        The elements are laid out as in the full document. Missing values are compared as
+        equal.
+
+        :rtype : str
+        """
+        skeleton = self.skeleton
+        seq_nr_str = str(seq_nr)
+        time_attrib, time_text = self._time_parts(time_str)
+        head = '<?xml version="1.0" ?>\n<root base_seq_nr="%d" msg="long_status_delta" send_time="%s" seq_nr="%d"' % (
+            base_seq_nr, time_attrib, seq_nr)
+        # NaN values differ from themselves, the byte images of the arrays do not
+        current = values.tostring()
+        previous = base_values.tostring()
+        itemsize = values.itemsize
+        lane_size = NUM_CATEGORIES * mc.NUM_QUANTITIES * itemsize
+        category_size = mc.NUM_QUANTITIES * itemsize
+        parts = []
+        # Start tags of the gantry, device and sub-device currently open
+        open_gantry = open_device = open_sub_device = None
+        for (slot, base, det_name), (gantry_pos, device_pos, sub_device_pos) in zip(self.lanes, self.lane_parents):
+            start = base * itemsize
+            if current[start:start + lane_size] == previous[start:start + lane_size]:
+                continue
+            if sub_device_pos != open_sub_device:
+                if open_sub_device is not None:
+                    parts.append(end_tag('subdevice', 6))
+                if device_pos != open_device:
+                    if open_device is not None:
+                        parts.append(end_tag('device', 4))
+                    if gantry_pos != open_gantry:
+                        if open_gantry is not None:
+                            parts.append(end_tag('gantry', 2))
+                        parts.extend((skeleton[gantry_pos], seq_nr_str, skeleton[gantry_pos + 2], time_text,
+                                      skeleton[gantry_pos + 4]))
+                        open_gantry = gantry_pos
+                    parts.append(skeleton[device_pos])
+                    open_device = device_pos
+                parts.extend((skeleton[sub_device_pos], time_attrib, skeleton[sub_device_pos + 2]))
+                open_sub_device = sub_device_pos
+            parts.append(skeleton[slot - 1])
+            for i in xrange(NUM_CATEGORIES):
+                offset = start + i * category_size
+                if current[offset:offset + category_size] != previous[offset:offset + category_size]:
+                    pos = base + i * mc.NUM_QUANTITIES
+                    count = values[pos + mc.COUNT]
+                    speed = values[pos + mc.SPEED]
+                    occup = values[pos + mc.OCCUPANCY]
+                    if count != count or speed != speed or occup != occup:
+                        parts.append(self.empty_categories[i])
+                    else:
+                        parts.extend((skeleton[slot], str(int(count)), skeleton[slot + 2], str(float(speed)),
+                                      skeleton[slot + 4], str(float(occup)), skeleton[slot + 6]))
+                slot += CATEGORY_PARTS
+            parts.append(end_tag('lane', 8))
+        if open_gantry is None:
+            return head + '/>\n'
+        parts.extend((end_tag('subdevice', 6), end_tag('device', 4), end_tag('gantry', 2), end_tag('root', 0)))
+        return head + '>\n' + ''.join(parts)
+
+
+# The template of the last schema rendered, as a `(schema, template)` tuple
+TEMPLATE_CACHE = None
+
+
+def render_long_status(schema, time_str, values, seq_nr):
+    """Render measurements of a single detection interval as a pretty-printed `long_status`
+    XML document. The schema is compiled into a LongStatusTemplate once and reused as long as
+    the schema does not change.
+
+    :param schema: list of `(name, gantry_ld_map tuple)` detector descriptors
+    :param time_str: time stamp of the measurements
+    :param values: flat value array, see `measurement_codec`
+    :param seq_nr: sequence number of the document
+    :rtype : str
+    """
+    return template_for(schema).render(time_str, values, seq_nr)
+
+
+def template_for(schema):
+    """Return the LongStatusTemplate of the schema, compiling it if the schema differs from
+    the last one.
+
+    :rtype : LongStatusTemplate
+    """
+    global TEMPLATE_CACHE
+    cached = TEMPLATE_CACHE
+    if cached is not None and (cached[0] is schema or cached[0] == schema):
+        return cached[1]
+    template = LongStatusTemplate(schema)
+    LOGGER.info('long_status template compiled for %d detectors' % len(schema))
+    TEMPLATE_CACHE = (schema, template)
+    return template
+
+
+def compress_document(xml_string, level):
+    """Wrap a zlib-compressed XML document into a `<root msg="compressed">` envelope.
+
+    The envelope text is base64 encoded so that the result remains a valid XML stanza which
+    the controllers can frame in the same way as uncompressed documents.
+
+    :rtype : str
+    """
+    return '<?xml version="1.0" encoding="UTF-8" ?><root msg="compressed" encoding="zlib+base64" size="%d">%s</root>' % \
+        (len(xml_string), base64.b64encode(zlib.compress(xml_string, level)))
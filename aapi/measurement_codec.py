@@ -0,0 +1,205 @@
+#
+# Binary codec for detector measurements sent from the Aimsun extension to the SIRID server
+#
+# The original protocol pickles a list of `(name, gantry_ld_map tuple, (count, speed, occup))`
+# tuples at every detection interval, repeating the static detector description and building
+# three dictionaries per detector. This codec splits the data into
+#
+# 1) a schema packet holding the list of `(name, gantry_ld_map tuple)` detector descriptors,
+#    sent once before the first interval (and again only if the detector set changes), and
+# 2) an interval packet holding the time stamp and a flat array of doubles with the layout
+#    detectors x NUM_CLASSES vehicle classes x (count, speed, occupancy).
+#
+# Missing values (vehicle classes that the model does not provide) are stored as NaN.
+#
+import pickle
+import struct
+import sys
+import zlib
+from array import array
+import xml.etree.ElementTree as Et
+
+# Number of SIRID vehicle classes, see `gantry.CATEGORY`
+NUM_CLASSES = 10
+# Measured quantities and their offsets within a vehicle class
+NUM_QUANTITIES = 3
+COUNT = 0
+SPEED = 1
+OCCUPANCY = 2
+VALUES_PER_DETECTOR = NUM_CLASSES * NUM_QUANTITIES
+
+# Value used for classes that are not provided by the model
+MISSING = float('nan')
+
+CODEC_VERSION = 1
+# The magic strings cannot start a pickle, a command batch or a '@' control token
+SCHEMA_MAGIC = 'MS'
+INTERVAL_MAGIC = 'MI'
+# Magic, version, schema id
+SCHEMA_HEAD = struct.Struct('!2sBI')
+# Magic, version, schema id, number of detectors, length of the time string
+INTERVAL_HEAD = struct.Struct('!2sBIIB')
+
+# Codecs for the measurement packets, in the order of preference
+CODEC_BINARY = 'binary'
+CODEC_PICKLE = 'pickle'
+SUPPORTED_CODECS = [CODEC_BINARY, CODEC_PICKLE]
+
+
+def select_codec(offered_codecs):
+    """Return the most preferred measurement codec supported by both sides."""
+    for codec in SUPPORTED_CODECS:
+        if codec in offered_codecs:
+            return codec
+    return CODEC_PICKLE
+
+
+def value_index(pos_detector, id_class, quantity):
+    """Return the position of a measured value in the flat value array."""
+    return (pos_detector * NUM_CLASSES + id_class) * NUM_QUANTITIES + quantity
+
+
+def new_values(num_detectors):
+    """Return a value array for `num_detectors` detectors with all values missing.
+
+    :rtype : array
+    """
+    return array('d', [MISSING]) * (num_detectors * VALUES_PER_DETECTOR)
+
+
+def is_missing(value):
+    """NaN is the only value that is not equal to itself."""
+    return value != value
+
+
+def schema_id(schema):
+    """Return a 32-bit identifier of the detector schema."""
+    return zlib.crc32(pickle.dumps(schema, pickle.HIGHEST_PROTOCOL)) & 0xffffffff
+
+
+def is_schema(data):
+    return data[:len(SCHEMA_MAGIC)] == SCHEMA_MAGIC
+
+
+def is_interval(data):
+    return data[:len(INTERVAL_MAGIC)] == INTERVAL_MAGIC
+
+
+def encode_schema(schema):
+    """Encode the list of `(name, gantry_ld_map tuple)` detector descriptors.
+
+    :rtype : str
+    """
+    return SCHEMA_HEAD.pack(SCHEMA_MAGIC, CODEC_VERSION, schema_id(schema)) + \
+        pickle.dumps(schema, pickle.HIGHEST_PROTOCOL)
+
+
+def decode_schema(data):
+    """Decode the schema packet and return a tuple `(schema_id, schema)`."""
+    magic, version, id_schema = SCHEMA_HEAD.unpack_from(data)
+    if version != CODEC_VERSION:
+        raise ValueError("Unsupported measurement codec version %d" % version)
+    return id_schema, pickle.loads(str(data[SCHEMA_HEAD.size:]))
+
+
+def encode_interval(id_schema, time_str, values):
+    """Encode measurements of a single detection interval.
+
+    :rtype : str
+    """
+    num_detectors = len(values) // VALUES_PER_DETECTOR
+    if sys.byteorder == 'big':
+        # The value array is always sent in little-endian byte order
+        values = array('d', values)
+        values.byteswap()
+    return INTERVAL_HEAD.pack(INTERVAL_MAGIC, CODEC_VERSION, id_schema, num_detectors, len(time_str)) + \
+        time_str + values.tostring()
+
+
+def decode_interval(data):
+    """Decode the interval packet and return a tuple `(schema_id, time_str, values)`.
+
+    `data` may be a string or a buffer, the value array is filled directly from it."""
+    magic, version, id_schema, num_detectors, time_len = INTERVAL_HEAD.unpack_from(data)
+    if version != CODEC_VERSION:
+        raise ValueError("Unsupported measurement codec version %d" % version)
+    offset = INTERVAL_HEAD.size
+    time_str = str(data[offset:offset + time_len])
+    offset += time_len
+    values = array('d')
+    values.fromstring(data[offset:offset + num_detectors * VALUES_PER_DETECTOR * values.itemsize])
+    if len(values) != num_detectors * VALUES_PER_DETECTOR:
+        raise ValueError("Truncated interval packet")
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return id_schema, time_str, values
+
+
+def dicts_to_values(dets):
+    """Convert the legacy list of `(name, gantry_ld_map tuple, (count, speed, occup))` tuples
+    into a schema and a value array.
+
+    :rtype : (list, array)
+    """
+    schema = []
+    values = new_values(len(dets))
+    for pos_detector, (name, det_map, (count, speed, occup)) in enumerate(dets):
+        schema.append((name, det_map))
+        base = pos_detector * VALUES_PER_DETECTOR
+        for quantity, measured in ((COUNT, count), (SPEED, speed), (OCCUPANCY, occup)):
+            for id_class in measured:
+                if 0 <= id_class < NUM_CLASSES:
+                    values[base + id_class * NUM_QUANTITIES + quantity] = measured[id_class]
+    return schema, values
+
+
+def values_to_dicts(schema, values):
+    """Convert a schema and a value array into the legacy list of
+    `(name, gantry_ld_map tuple, (count, speed, occup))` tuples.
+
+    :rtype : list
+    """
+    dets = []
+    for pos_detector, (name, det_map) in enumerate(schema):
+        count = {}
+        speed = {}
+        occup = {}
+        base = pos_detector * VALUES_PER_DETECTOR
+        for id_class in xrange(NUM_CLASSES):
+            pos = base + id_class * NUM_QUANTITIES
+            for quantity, measured in ((COUNT, count), (SPEED, speed), (OCCUPANCY, occup)):
+                value = values[pos + quantity]
+                if not is_missing(value):
+                    measured[id_class] = value
+        dets.append((name, det_map, (count, speed, occup)))
+    return dets
+
+
+def load_schema(network_path):
+    """Build the detector schema from the XML description of the network (`sokp_v7.xml`).
+
+    The descriptors are ordered as in the network description; the Aimsun extension orders
+    them by Aimsun detector ids. This is meant for offline tools and benchmarks.
+
+    :rtype : list
+    """
+    schema = []
+    root = Et.parse(network_path).getroot()
+    for gantry_node in root:
+        id_gantry = gantry_node.attrib['id']
+        for device in gantry_node:
+            id_device = int(device.attrib['id'])
+            device_type = device.attrib.get('type', '')
+            for sub_device in device:
+                sub_device_type = sub_device.attrib['type']
+                if sub_device_type != 'LD4':
+                    continue
+                id_sub_device = int(sub_device.attrib['id'])
+                sub_device_description = sub_device.attrib.get('description', '')
+                for loop_detector in sub_device:
+                    prefix = loop_detector.attrib['prefix']
+                    det_map = (id_gantry, id_device, device_type, id_sub_device, sub_device_type,
+                               sub_device_description, int(loop_detector.attrib['id']),
+                               loop_detector.attrib['type'], loop_detector.attrib['position'], prefix)
+                    schema.append((prefix, det_map))
+    return schema
@@ -0,0 +1,220 @@
+#
+# Outbound queues of the connections to the controllers
+#
+# The Aimsun receiver thread fans every long_status document out to all controllers. Writing
+# to the sockets directly would let a single slow or stalled controller hold up the fan-out
+# to everyone else, and through the receiver thread also Aimsun. Instead every connection
+# has an OutboundQueue: the receiver thread only appends a reference to the shared, already
+# encoded document and a writer (a QueueWriter thread, or the event loop of event_server)
+# takes the documents out and writes them to the socket.
+#
+# Documents are either frames (long_status documents, each of them superseding the previous
+# one) or messages (replies and notifications that must not be lost). When a controller
+# falls behind, the policy of its queue decides:
+# - `drop_stale` discards the oldest queued frame when the queue is full,
+# - `latest` keeps only the newest frame in the queue, older ones are replaced,
+# - `disconnect` closes the connection when the queue is full or when the oldest document
+#   not yet written is more than `max_lag` seconds old.
+# Messages are never dropped; they count towards the size of the queue, though.
+#
+import threading
+import time
+from collections import deque
+
+POLICY_DROP_STALE = 'drop_stale'
+POLICY_LATEST = 'latest'
+POLICY_DISCONNECT = 'disconnect'
+POLICIES = [POLICY_DROP_STALE, POLICY_LATEST, POLICY_DISCONNECT]
+
+# Number of documents queued for a controller, 0 means unbounded
+DEFAULT_QUEUE_SIZE = 16
+# Seconds a controller may fall behind before the `disconnect` policy closes the connection
+DEFAULT_MAX_LAG = 30.0
+
+
+class OutboundQueue(object):
+    """Bounded queue of documents waiting to be written to a controller connection.
+
+    `put()` never blocks. The writer calls `take()` (or `take_nowait()`) to get the next
+    document and `done()` when it has been written. Two optional callbacks may be set:
+    `on_ready` is called when a document arrives in an empty queue, `on_overrun` when the
+    `disconnect` policy gives up on the connection; it shall abort the connection.
+    """
+
+    def __init__(self, name, size=0, policy=POLICY_DROP_STALE, max_lag=DEFAULT_MAX_LAG, counters=None):
+        """
+        :type counters: linkstats.Counters
+        """
+        self.name = name
+        self.on_ready = None
+        self.on_overrun = None
+        self.counters = counters
+        # Items are tuples `(data, is_frame, enqueue time)`
+        self._queue = deque()
+        self._condition = threading.Condition()
+        # Enqueue time and size of the document being written, None if the writer is idle
+        self._in_flight = None
+        self._in_flight_size = 0
+        # When the writer took the document being written, and when it last finished one
+        self._taken_at = None
+        self.last_written = time.time()
+        self._closed = False
+        self.configure(size, policy, max_lag)
+
+    def configure(self, size, policy, max_lag=DEFAULT_MAX_LAG):
+        if policy not in POLICIES:
+            raise ValueError("Unsupported outbound queue policy `%s`" % policy)
+        with self._condition:
+            self.size = size
+            self.policy = policy
+            self.max_lag = max_lag
+
+    def _count(self, name, value=1):
+        if self.counters is not None:
+            self.counters.add(name, value)
+
+    def depth(self):
+        with self._condition:
+            return len(self._queue)
+
+    def lag(self):
+        """Return the age in seconds of the oldest document that has not been written yet."""
+        with self._condition:
+            return self._lag(time.time())
+
+    def write_time(self):
+        """Return the seconds the writer has been writing the current document, 0.0 if it is
+        not writing any."""
+        with self._condition:
+            if self._taken_at is None:
+                return 0.0
+            return time.time() - self._taken_at
+
+    def _lag(self, now):
+        if self._in_flight is not None:
+            return now - self._in_flight
+        if self._queue:
+            return now - self._queue[0][2]
+        return 0.0
+
+    def _drop_frames(self, keep):
+        """Remove queued frames, oldest first, until at most `keep` documents remain or there
+        is no frame left. Returns the number of frames removed."""
+        dropped = 0
+        pos = 0
+        while len(self._queue) > keep and pos < len(self._queue):
+            if self._queue[pos][1]:
+                del self._queue[pos]
+                dropped += 1
+            else:
+                pos += 1
+        return dropped
+
+    def put(self, data, frame=False):
+        """Queue a document for writing. Returns False if the queue does not accept it any
+        more, because it has been closed or the connection has been given up."""
+        now = time.time()
+        overrun = False
+        with self._condition:
+            if self._closed:
+                return False
+            if self.policy == POLICY_DISCONNECT:
+                if self.max_lag > 0 and self._lag(now) > self.max_lag:
+                    overrun = True
+                elif self.size and len(self._queue) >= self.size:
+                    self._count('queue_full')
+                    overrun = True
+            elif frame and self.policy == POLICY_LATEST:
+                self._count('replaced_frames', self._drop_frames(0))
+            elif self.size and len(self._queue) >= self.size:
+                self._count('queue_full')
+                self._count('dropped_frames', self._drop_frames(self.size - 1))
+            if overrun:
+                self._closed = True
+                self._queue.clear()
+                self._condition.notify_all()
+            else:
+                was_empty = not self._queue
+                self._queue.append((data, frame, now))
+                self._condition.notify_all()
+        if overrun:
+            self._count('overruns')
+            if self.on_overrun is not None:
+                self.on_overrun()
+            return False
+        if was_empty and self.on_ready is not None:
+            self.on_ready()
+        return True
+
+    def take(self):
+        """Wait for the next document and return it, or None if the queue has been closed and
+        emptied."""
+        with self._condition:
+            while not self._queue and not self._closed:
+                self._condition.wait()
+            return self._take()
+
+    def take_nowait(self):
+        """Return the next document, or None if there is none."""
+        with self._condition:
+            return self._take()
+
+    def _take(self):
+        if not self._queue:
+            return None
+        data, frame, enqueued = self._queue.popleft()
+        self._in_flight = enqueued
+        self._in_flight_size = len(data)
+        self._taken_at = time.time()
+        return data
+
+    def done(self):
+        """Tell the queue that the last document taken has been written."""
+        with self._condition:
+            self._in_flight = None
+            self._taken_at = None
+            self.last_written = time.time()
+            size = self._in_flight_size
+        self._count('documents_sent')
+        self._count('bytes_sent', size)
+
+    def close(self):
+        """Stop accepting documents; the writer gets None once the queue is empty."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def is_closed(self):
+        with self._condition:
+            return self._closed
+
+
+class QueueWriter(threading.Thread):
+    """Thread writing the documents of an OutboundQueue to a file-like object."""
+
+    def __init__(self, queue, wfile, logger, on_error=None):
+        """
+        :type queue: OutboundQueue
+        """
+        threading.Thread.__init__(self, name='%s-writer' % queue.name)
+        self.setDaemon(True)
+        self.queue = queue
+        self.wfile = wfile
+        self.logger = logger
+        self.on_error = on_error
+
+    def run(self):
+        while True:
+            data = self.queue.take()
+            if data is None:
+                return
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except Exception as e:
+                self.logger.error('writing to controller %s failed: %s' % (self.queue.name, e))
+                self.queue.close()
+                if self.on_error is not None:
+                    self.on_error()
+                return
+            self.queue.done()
@@ -2,27 +2,369 @@ __author__ = 'prikryl'
 # Simple packet communication for SIRID
 import socket
 import logging
+import pickle
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from collections import deque
+import linkstats
 
 HEAD_LENGTH = 5
 HEAD_FORMAT = "%05d"
 
+# Framing modes. The legacy framing prefixes every packet with its length written as
+# 5 decimal digits, which limits the packet size to 99999 bytes. The binary framing
+# uses a magic byte, a flags byte and a 32-bit length in network byte order. The magic
+# byte is not a digit, so the receiver recognises both framings without negotiation.
+FRAMING_LEGACY = 'legacy'
+FRAMING_BINARY = 'binary'
+# Framings supported by this implementation, in the order of preference
+SUPPORTED_FRAMINGS = [FRAMING_BINARY, FRAMING_LEGACY]
+
+BINARY_MAGIC = 0xFB
+BINARY_HEAD = struct.Struct('!BBI')
+
+# Flags of the binary framing
+FLAG_ZLIB = 0x01
+
+# Payload compression. Compression requires the binary framing, the legacy framing has no
+# place for flags. Packets shorter than the threshold are never compressed, and a compressed
+# packet is sent only if it is actually shorter than the original one.
+COMPRESSION_NONE = 'none'
+COMPRESSION_ZLIB = 'zlib'
+SUPPORTED_COMPRESSIONS = [COMPRESSION_ZLIB, COMPRESSION_NONE]
+DEFAULT_COMPRESSION_LEVEL = 6
+DEFAULT_COMPRESSION_THRESHOLD = 1024
+
+# Sanity limit for the binary framing. A corrupted header shall not make us allocate gigabytes.
+MAX_PACKET_SIZE = 256 * 1024 * 1024
+
+# Size of a single recv() call when the payload is read into a string
+RECV_CHUNK_SIZE = 8192
+
+# Initial size of the reusable receive buffer used by `packet_receive_into()`. The buffer
+# grows on demand to the size of the largest packet received so far and it is never shrunk.
+RECV_BUFFER_SIZE = 64 * 1024
+
+# Python 2.6 (bundled with Aimsun 7) has no memoryview and its recv_into() always writes to
+# the beginning of the target buffer. Newer interpreters can receive directly at an offset
+# of the reusable buffer.
+try:
+    memoryview
+    HAS_MEMORYVIEW = True
+except NameError:
+    HAS_MEMORYVIEW = False
+
 # Pre-defined commands
 AIMSUN_UP = 'AIMSUN_UP_AND_RUNNING'
 
+# The extension sends plain AIMSUN_UP and the capabilities are exchanged afterwards, see
+# `handshake`. Early version 2 extensions appended the separator and their pickled
+# capabilities to AIMSUN_UP; the server still accepts such a handshake packet.
+HELLO_SEPARATOR = '\n'
+
+# Control channel. If both sides support it, the Aimsun extension opens a second connection
+# that carries only the short synchronisation tokens, so that they are never queued behind
+# large packets on the bulk connection. The first packet on the control connection is
+# CONTROL_HELLO. On the control channel, @UNLOCK carries the number of bulk packets the
+# server sent before it (the extension has to process them first) and the send time.
+CONTROL_HELLO = '@CONTROL'
+UNLOCK = '@UNLOCK'
+
+
+def parse_hello(data):
+    """Return the capabilities announced in the AIMSUN_UP handshake packet.
+
+    Plain AIMSUN_UP announces no capabilities and an empty dictionary is returned. If `data` is
+    not a handshake packet at all, the return value is None.
+
+    :rtype : dict
+    """
+    if data == AIMSUN_UP:
+        return {}
+    if data and data.startswith(AIMSUN_UP + HELLO_SEPARATOR):
+        return pickle.loads(data[len(AIMSUN_UP + HELLO_SEPARATOR):])
+    return None
+
+
+def make_unlock(bulk_seq):
+    """Return the @UNLOCK token for the control channel."""
+    return '%s %d %.6f' % (UNLOCK, bulk_seq, time.time())
+
+
+def parse_control(data):
+    """Split a control token into its name and a list of arguments."""
+    tokens = str(data).split()
+    return tokens[0], tokens[1:]
+
+
+def select_framing(offered_framings):
+    """Return the most preferred framing that is supported by both sides."""
+    for framing in SUPPORTED_FRAMINGS:
+        if framing in offered_framings:
+            return framing
+    return FRAMING_LEGACY
+
+
+def select_compression(offered_compressions, framing, requested=COMPRESSION_ZLIB):
+    """Return the compression method for the connection: the requested one if the peer
+    supports it and the framing allows it, COMPRESSION_NONE otherwise."""
+    if framing == FRAMING_BINARY and requested in offered_compressions and requested in SUPPORTED_COMPRESSIONS:
+        return requested
+    return COMPRESSION_NONE
+
+
+# Command batch packet. All commands of one controller message are sent to Aimsun as a single
+# packet: a header, a table of gantry server ids and an array of five 32-bit integers
+# (gantry server index, device, sub-device, message, validity) per command. The magic string
+# cannot start a pickle or a '@' control token. Version 2 adds the time the batch has been
+# sent by the server (seconds since the epoch as a double) after the header. Version 3 adds
+# a flag after the time stamp, set if the batch is a part of a controller message that did
+# not fit into a single packet and more parts follow.
+BATCH_MAGIC = 'CB'
+BATCH_VERSION = 1
+BATCH_VERSION_TIMED = 2
+BATCH_VERSION_PARTS = 3
+BATCH_HEAD = struct.Struct('!2sBHI')
+BATCH_TIME = struct.Struct('!d')
+BATCH_MORE = struct.Struct('!B')
+BATCH_ID_HEAD = struct.Struct('!B')
+BATCH_FIELDS = 5
+
+
+def is_command_batch(data):
+    """Return True if the packet holds a command batch."""
+    return data[:len(BATCH_MAGIC)] == BATCH_MAGIC
+
+
+def check_command(command):
+    """Raise ValueError if the command tuple cannot be encoded into a command batch."""
+    try:
+        id_gantry_server, (id_device, id_sub_device, id_message, validity) = command
+    except (TypeError, ValueError):
+        raise ValueError('Malformed command %s' % repr(command))
+    if isinstance(id_gantry_server, unicode):
+        id_gantry_server = id_gantry_server.encode('utf-8')
+    if not isinstance(id_gantry_server, str) or len(id_gantry_server) > 255:
+        raise ValueError('Invalid gantry server id in command %s' % repr(command))
+    for value in (id_device, id_sub_device, id_message, validity):
+        if not isinstance(value, (int, long)) or not -2 ** 31 <= value < 2 ** 31:
+            raise ValueError('Invalid value %s in command %s' % (repr(value), repr(command)))
+
+
+def encode_command_batch(commands, sent_time=None, more=None):
+    """Encode a list of `(id_gantry_server, (id_device, id_sub_device, id_message, validity))`
+    command tuples into a command batch packet. If `sent_time` is given, the packet carries
+    the time stamp (version 2 of the batch packet). If `more` is given as well, the packet
+    carries the flag telling whether more parts of the message follow (version 3).
+
+    :rtype : str
+    """
+    gantry_server_index = {}
+    gantry_server_ids = []
+    values = array('i')
+    for id_gantry_server, (id_device, id_sub_device, id_message, validity) in commands:
+        try:
+            index = gantry_server_index[id_gantry_server]
+        except KeyError:
+            index = gantry_server_index[id_gantry_server] = len(gantry_server_ids)
+            gantry_server_ids.append(id_gantry_server)
+        values.extend((index, id_device, id_sub_device, id_message, validity))
+    # The integer array is always sent in little-endian byte order
+    if sys.byteorder == 'big':
+        values.byteswap()
+    if sent_time is None:
+        parts = [BATCH_HEAD.pack(BATCH_MAGIC, BATCH_VERSION, len(gantry_server_ids), len(commands))]
+    elif more is None:
+        parts = [BATCH_HEAD.pack(BATCH_MAGIC, BATCH_VERSION_TIMED, len(gantry_server_ids), len(commands)),
+                 BATCH_TIME.pack(sent_time)]
+    else:
+        parts = [BATCH_HEAD.pack(BATCH_MAGIC, BATCH_VERSION_PARTS, len(gantry_server_ids), len(commands)),
+                 BATCH_TIME.pack(sent_time), BATCH_MORE.pack(bool(more))]
+    for id_gantry_server in gantry_server_ids:
+        if isinstance(id_gantry_server, unicode):
+            # Ids with non-ASCII characters come from ElementTree as unicode strings
+            id_gantry_server = id_gantry_server.encode('utf-8')
+        parts.append(BATCH_ID_HEAD.pack(len(id_gantry_server)))
+        parts.append(id_gantry_server)
+    parts.append(values.tostring())
+    return ''.join(parts)
+
+
+def decode_command_batch(data):
+    """Decode a command batch packet into a list of command tuples, see `encode_command_batch()`.
+
+    :rtype : list
+    """
+    magic, version, num_gantry_servers, num_commands = BATCH_HEAD.unpack_from(data)
+    if magic != BATCH_MAGIC or version not in (BATCH_VERSION, BATCH_VERSION_TIMED, BATCH_VERSION_PARTS):
+        raise ValueError("Unsupported command batch %s version %d" % (repr(magic), version))
+    offset = BATCH_HEAD.size
+    if version >= BATCH_VERSION_TIMED:
+        offset += BATCH_TIME.size
+    if version == BATCH_VERSION_PARTS:
+        offset += BATCH_MORE.size
+    gantry_server_ids = []
+    for i in xrange(num_gantry_servers):
+        id_len, = BATCH_ID_HEAD.unpack_from(data, offset)
+        offset += BATCH_ID_HEAD.size
+        id_gantry_server = str(data[offset:offset + id_len])
+        try:
+            id_gantry_server.decode('ascii')
+        except UnicodeDecodeError:
+            # Return the id as ElementTree did on the server side
+            id_gantry_server = id_gantry_server.decode('utf-8')
+        gantry_server_ids.append(id_gantry_server)
+        offset += id_len
+    values = array('i')
+    values.fromstring(data[offset:offset + num_commands * BATCH_FIELDS * values.itemsize])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    commands = []
+    for pos in xrange(0, len(values), BATCH_FIELDS):
+        commands.append((gantry_server_ids[values[pos]],
+                         (values[pos + 1], values[pos + 2], values[pos + 3], values[pos + 4])))
+    return commands
+
+
+def command_batch_time(data):
+    """Return the time stamp of a command batch packet, or None if it carries none."""
+    magic, version, num_gantry_servers, num_commands = BATCH_HEAD.unpack_from(data)
+    if version in (BATCH_VERSION_TIMED, BATCH_VERSION_PARTS):
+        return BATCH_TIME.unpack_from(data, BATCH_HEAD.size)[0]
+    return None
+
+
+def command_batch_continues(data):
+    """Return True if more parts of the controller message follow the command batch packet."""
+    magic, version, num_gantry_servers, num_commands = BATCH_HEAD.unpack_from(data)
+    if version == BATCH_VERSION_PARTS:
+        return bool(BATCH_MORE.unpack_from(data, BATCH_HEAD.size + BATCH_TIME.size)[0])
+    return False
+
+
+# Heartbeat. The server periodically sends `@PING <seq> <send time>` and the Aimsun extension
+# echoes it back as `@PONG <seq> <send time> <echo time>` over the same channel. Both sides
+# run on the same host, so the time stamps are directly comparable.
+PING = '@PING'
+PONG = '@PONG'
+DEFAULT_HEARTBEAT_INTERVAL = 5.0
+DEFAULT_HEARTBEAT_TIMEOUT = 30.0
+
+
+def make_pong(ping_args):
+    """Return the reply to a @PING token with the given arguments."""
+    return '%s %s %s %.6f' % (PONG, ping_args[0], ping_args[1], time.time())
+
+
+class Heartbeat(object):
+    """Sender side of the heartbeat: issues @PING tokens, matches the @PONG replies and keeps
+    the round-trip time distribution."""
+
+    def __init__(self, timeout=DEFAULT_HEARTBEAT_TIMEOUT):
+        self.timeout = timeout
+        self.counters = linkstats.Counters()
+        self.round_trip = linkstats.RollingPercentiles()
+        self._seq = 0
+        self._last_pong = time.time()
+
+    def make_ping(self):
+        self._seq += 1
+        self.counters.add('pings_sent')
+        return '%s %d %.6f' % (PING, self._seq, time.time())
+
+    def pong_received(self, pong_args):
+        now = time.time()
+        self._last_pong = now
+        self.counters.add('pongs_received')
+        self.round_trip.add(now - float(pong_args[1]))
+
+    def is_alive(self):
+        """Return False if no @PONG has been received within the timeout."""
+        return time.time() - self._last_pong < self.timeout
+
+    def get_stats(self):
+        """:rtype : dict"""
+        stats = self.counters.snapshot()
+        stats.update(self.round_trip.snapshot('rtt_'))
+        stats['last_pong_age'] = time.time() - self._last_pong
+        stats['alive'] = self.is_alive()
+        return stats
+
+
 class PacketCommunicator(object):
 
-    def __init__(self, socket_instance, logger_instance):
+    def __init__(self, socket_instance, logger_instance, framing=FRAMING_LEGACY):
         self.socket = socket_instance
         self.logger = logging.getLogger(logger_instance)
+        self.framing = framing
+        # Header and payload of a packet have to be written without interleaving with
+        # packets sent from other threads
+        self._send_lock = threading.Lock()
+        # Compression of sent packets, see `set_compression()`
+        self.compression = COMPRESSION_NONE
+        self.compression_level = DEFAULT_COMPRESSION_LEVEL
+        self.compression_threshold = DEFAULT_COMPRESSION_THRESHOLD
+        # Traffic and compression counters, see `get_stats()`
+        self.counters = linkstats.Counters()
+        # Time spent in `packet_send()`, including waiting for packets sent by other threads
+        self.send_latency = linkstats.LatencyStats()
+        # Reusable receive buffer for `packet_receive_into()`
+        self._recv_buffer = bytearray(RECV_BUFFER_SIZE)
+        self._recv_view = None
+        if HAS_MEMORYVIEW:
+            self._recv_view = memoryview(self._recv_buffer)
 
-    def packet_receive(self):
+    def set_framing(self, framing):
+        """Switch the framing used for sending packets. Received packets are recognised
+        automatically."""
+        if framing not in SUPPORTED_FRAMINGS:
+            raise ValueError("Unsupported framing `%s`" % framing)
+        self.logger.debug("switching to %s framing" % framing)
+        self.framing = framing
+
+    def set_compression(self, compression, level=DEFAULT_COMPRESSION_LEVEL, threshold=DEFAULT_COMPRESSION_THRESHOLD):
+        """Switch the compression of sent packets. Compressed packets are recognised and
+        decompressed automatically when received."""
+        if compression not in SUPPORTED_COMPRESSIONS:
+            raise ValueError("Unsupported compression `%s`" % compression)
+        if compression != COMPRESSION_NONE and self.framing != FRAMING_BINARY:
+            raise ValueError("Compression requires the binary framing")
+        self.logger.debug("switching to %s compression (level %d, threshold %d bytes)" %
+                          (compression, level, threshold))
+        self.compression = compression
+        self.compression_level = level
+        self.compression_threshold = threshold
+
+    def get_stats(self):
+        """Return traffic and compression statistics of this connection.
+
+        Compression ratio is the number of payload bytes before compression divided by the
+        number of bytes after compression, computed over compressed packets only. Times are
+        in seconds spent in zlib.
+
+        :rtype : dict
+        """
+        stats = self.counters.snapshot()
+        stats['compression_ratio'] = linkstats.ratio(stats.get('compression_bytes_in', 0),
+                                                     stats.get('compression_bytes_out', 0))
+        stats['decompression_ratio'] = linkstats.ratio(stats.get('decompression_bytes_out', 0),
+                                                       stats.get('decompression_bytes_in', 0))
+        stats.update(self.send_latency.snapshot('send_latency_'))
+        return stats
+
+    def _receive_header_bytes(self, num_bytes):
+        """Read exactly `num_bytes` of the packet header, or return None if the connection
+        has been closed."""
         data_recv = None
         data = ''
         try:
-            # First portion is the length as 5 digit integer
             head_len = 0
-            while head_len < HEAD_LENGTH:
-                data_recv = self.socket.recv(HEAD_LENGTH - head_len)
+            while head_len < num_bytes:
+                data_recv = self.socket.recv(num_bytes - head_len)
                 if not data_recv:
                     break
                 data += data_recv
@@ -41,16 +383,56 @@ class PacketCommunicator(object):
         if not data_recv:
             self.logger.debug('no data from the socket, exiting')
             return None
-        # Convert string to integer representing message length in bytes
-        msg_len = int(data)
+        return data
+
+    def _receive_header(self):
+        """Read the packet header and return a tuple of the announced payload length and
+        packet flags, or None if the connection has been closed."""
+        # The first byte tells us the framing of the packet
+        data = self._receive_header_bytes(1)
+        if data is None:
+            return None
+        if data.isdigit():
+            # Legacy framing, the length is a 5 digit integer
+            data_recv = self._receive_header_bytes(HEAD_LENGTH - 1)
+            if data_recv is None:
+                return None
+            # Convert string to integer representing message length in bytes
+            msg_len = int(data + data_recv)
+            flags = 0
+        elif ord(data) == BINARY_MAGIC:
+            data_recv = self._receive_header_bytes(BINARY_HEAD.size - 1)
+            if data_recv is None:
+                return None
+            magic, flags, msg_len = BINARY_HEAD.unpack(data + data_recv)
+            if flags & ~FLAG_ZLIB:
+                raise ValueError("Unsupported packet flags 0x%02x" % flags)
+            if msg_len > MAX_PACKET_SIZE:
+                raise ValueError("Packet of %d bytes exceeds the limit of %d bytes" % (msg_len, MAX_PACKET_SIZE))
+        else:
+            self.logger.error("invalid first byte of the packet header: %s" % repr(data))
+            raise ValueError("Invalid packet header")
         # Announce message length
         self.logger.debug("got header announcing %d bytes from SIRID server" % msg_len)
-        # Now fetch the whole string of msg_len
+        return msg_len, flags
+
+    def _decompress(self, data):
+        """Decompress a received packet payload."""
+        start = time.time()
+        payload = zlib.decompress(data)
+        self.counters.add('decompression_time', time.time() - start)
+        self.counters.add('decompressed_packets')
+        self.counters.add('decompression_bytes_in', len(data))
+        self.counters.add('decompression_bytes_out', len(payload))
+        return payload
+
+    def _receive_payload(self, msg_len):
+        """Read `msg_len` bytes of payload into a newly allocated string."""
         data_recv = None
         data = ''
         data_len = 0
         while data_len < msg_len:
-            data_recv = self.socket.recv(min(msg_len - data_len, 8192))
+            data_recv = self.socket.recv(min(msg_len - data_len, RECV_CHUNK_SIZE))
             if not data_recv:
                 break
             data += data_recv
@@ -63,13 +445,246 @@ class PacketCommunicator(object):
         self.logger.debug("got the whole message of %d bytes" % data_len)
         return data
 
-    def packet_send(self, data):
-        msg_str = HEAD_FORMAT % len(data)
-        if len(msg_str) != HEAD_LENGTH:
-            self.logger.error("inconsistent message length representation: %d instead of %d characters" %
-                         (len(msg_str), HEAD_LENGTH))
-            raise ValueError("Message length should be represented by %d characters, got %d" %
-                             (HEAD_LENGTH, len(msg_str)))
-        self.socket.sendall(msg_str)
-        self.socket.sendall(data)
+    def _receive_payload_into(self, msg_len):
+        """Read `msg_len` bytes of payload into the reusable receive buffer.
+
+        Returns the number of bytes read, or None if the connection has been closed."""
+        # Grow the buffer if the packet does not fit. Doubling the size keeps the number of
+        # reallocations logarithmic in the size of the largest packet.
+        if msg_len > len(self._recv_buffer):
+            self._recv_buffer = bytearray(max(msg_len, 2 * len(self._recv_buffer)))
+            if HAS_MEMORYVIEW:
+                self._recv_view = memoryview(self._recv_buffer)
+            self.logger.debug("receive buffer grown to %d bytes" % len(self._recv_buffer))
+        data_len = 0
+        while data_len < msg_len:
+            if HAS_MEMORYVIEW:
+                num_recv = self.socket.recv_into(self._recv_view[data_len:msg_len], msg_len - data_len)
+            else:
+                # Python 2.6 fallback: one copy per chunk, but still no reallocation of the packet
+                data_recv = self.socket.recv(min(msg_len - data_len, RECV_CHUNK_SIZE))
+                num_recv = len(data_recv)
+                self._recv_buffer[data_len:data_len + num_recv] = data_recv
+            if not num_recv:
+                self.logger.debug('no data from the socket when reading payload, exiting')
+                return None
+            data_len += num_recv
+        self.logger.debug("got the whole message of %d bytes" % data_len)
+        return data_len
+
+    def packet_receive(self):
+        header = self._receive_header()
+        if header is None:
+            return None
+        msg_len, flags = header
+        # Now fetch the whole string of msg_len
+        data = self._receive_payload(msg_len)
+        if data is None:
+            return None
+        self.counters.add('packets_received')
+        self.counters.add('bytes_received', msg_len)
+        if flags & FLAG_ZLIB:
+            data = self._decompress(data)
+        return data
+
+    def packet_receive_into(self):
+        """Receive a packet into the reusable receive buffer without copying it.
+
+        Returns a read-only `buffer` over the payload, or None if the connection has been
+        closed. The buffer is valid only until the next call of this method; use `str()`
+        to obtain a copy that outlives it. `struct.unpack_from()`, `array.fromstring()` and
+        file objects accept the buffer directly.
+
+        Compressed packets are decompressed into a newly allocated string which is returned
+        instead of the buffer."""
+        header = self._receive_header()
+        if header is None:
+            return None
+        msg_len, flags = header
+        data_len = self._receive_payload_into(msg_len)
+        if data_len is None:
+            return None
+        self.counters.add('packets_received')
+        self.counters.add('bytes_received', msg_len)
+        if flags & FLAG_ZLIB:
+            return self._decompress(buffer(self._recv_buffer, 0, data_len))
+        return buffer(self._recv_buffer, 0, data_len)
+
+    def _compress(self, data):
+        """Return a tuple of the payload to be sent and packet flags."""
+        if self.compression != COMPRESSION_ZLIB or len(data) < self.compression_threshold:
+            return data, 0
+        start = time.time()
+        compressed = zlib.compress(data, self.compression_level)
+        self.counters.add('compression_time', time.time() - start)
+        if len(compressed) >= len(data):
+            # Incompressible payload, send it as it is
+            self.counters.add('incompressible_packets')
+            return data, 0
+        self.counters.add('compressed_packets')
+        self.counters.add('compression_bytes_in', len(data))
+        self.counters.add('compression_bytes_out', len(compressed))
+        return compressed, FLAG_ZLIB
+
+    def _make_header(self, data):
+        """Compress the payload if requested and return a tuple `(header, payload)`."""
+        if self.framing == FRAMING_BINARY:
+            data, flags = self._compress(data)
+            if len(data) > MAX_PACKET_SIZE:
+                raise ValueError("Packet of %d bytes exceeds the limit of %d bytes" % (len(data), MAX_PACKET_SIZE))
+            msg_str = BINARY_HEAD.pack(BINARY_MAGIC, flags, len(data))
+        else:
+            msg_str = HEAD_FORMAT % len(data)
+            if len(msg_str) != HEAD_LENGTH:
+                self.logger.error("inconsistent message length representation: %d instead of %d characters" %
+                             (len(msg_str), HEAD_LENGTH))
+                raise ValueError("Message length should be represented by %d characters, got %d" %
+                                 (HEAD_LENGTH, len(msg_str)))
+        return msg_str, data
+
+    def packet_send(self, data, droppable=False):
+        """Send a packet. `droppable` marks packets that may be discarded under load; the
+        blocking communicator always sends them."""
+        start = time.time()
+        msg_str, data = self._make_header(data)
+        # The payload is sent directly from the caller's string, large packets are not copied
+        # into a single buffer together with the header
+        with self._send_lock:
+            self.socket.sendall(msg_str)
+            self.socket.sendall(data)
+        self.send_latency.add(time.time() - start)
+        self.counters.add('packets_sent')
+        self.counters.add('bytes_sent', len(data))
         # self.logger.debug("sent `%s`." % repr(msg_str + data))
+
+
+# Policies of `AsyncPacketCommunicator` when its send queue is full
+QUEUE_DROP_OLDEST = 'drop_oldest'
+QUEUE_BLOCK = 'block'
+QUEUE_FAIL = 'fail'
+QUEUE_POLICIES = [QUEUE_DROP_OLDEST, QUEUE_BLOCK, QUEUE_FAIL]
+DEFAULT_QUEUE_SIZE = 64
+
+
+class SendQueueFull(Exception):
+    """Raised by `AsyncPacketCommunicator.packet_send()` under the `fail` policy."""
+
+    def __init__(self, depth):
+        Exception.__init__(self, depth)
+        self.depth = depth
+
+    def __str__(self):
+        return 'send queue full (%d packets)' % self.depth
+
+
+class AsyncPacketCommunicator(PacketCommunicator):
+    """Packet communicator whose `packet_send()` never waits for the peer.
+
+    Packets are put into a bounded queue and written by a background thread, so that a slow
+    peer does not stall the caller (in `aapi_gantry` the caller is the simulation thread).
+    Compression and framing happen in the background thread as well and the header and the
+    payload of a packet are written together by a single `sendall()`.
+
+    When the queue is full, the policy decides:
+    - `drop_oldest` discards the oldest queued packet sent with `droppable=True` (measurements)
+      and blocks only if there is no such packet,
+    - `block` waits until the background thread makes room,
+    - `fail` raises `SendQueueFull`.
+
+    Receiving is unchanged and still blocking.
+    """
+
+    def __init__(self, socket_instance, logger_instance, framing=FRAMING_LEGACY,
+                 queue_size=DEFAULT_QUEUE_SIZE, policy=QUEUE_DROP_OLDEST):
+        PacketCommunicator.__init__(self, socket_instance, logger_instance, framing)
+        if policy not in QUEUE_POLICIES:
+            raise ValueError("Unsupported send queue policy `%s`" % policy)
+        self.queue_size = queue_size
+        self.policy = policy
+        # Items are tuples `(payload, droppable, enqueue time)`
+        self._queue = deque()
+        self._queue_condition = threading.Condition()
+        self._closed = False
+        # Exception that terminated the writer thread, re-raised to the next sender
+        self._error = None
+        self._writer = threading.Thread(target=self._write_loop, name='%s-writer' % logger_instance)
+        self._writer.setDaemon(True)
+        self._writer.start()
+
+    def get_stats(self):
+        """Return statistics of the connection including the depth of the send queue.
+
+        :rtype : dict
+        """
+        stats = PacketCommunicator.get_stats(self)
+        with self._queue_condition:
+            stats['queue_depth'] = len(self._queue)
+        stats['queue_size'] = self.queue_size
+        stats['queue_policy'] = self.policy
+        return stats
+
+    def queue_depth(self):
+        with self._queue_condition:
+            return len(self._queue)
+
+    def _drop_oldest(self):
+        """Remove the oldest droppable packet from the full queue. Returns False if there is none."""
+        for pos, item in enumerate(self._queue):
+            if item[1]:
+                del self._queue[pos]
+                self.counters.add('dropped_packets')
+                self.logger.debug("send queue full, dropped a packet of %d bytes" % len(item[0]))
+                return True
+        return False
+
+    def packet_send(self, data, droppable=False):
+        with self._queue_condition:
+            if self._error is not None:
+                raise self._error
+            if self._closed:
+                raise ValueError("Communicator has been closed")
+            if len(self._queue) >= self.queue_size:
+                self.counters.add('queue_full')
+                if self.policy == QUEUE_FAIL:
+                    raise SendQueueFull(len(self._queue))
+                if self.policy != QUEUE_DROP_OLDEST or not self._drop_oldest():
+                    while len(self._queue) >= self.queue_size and self._error is None:
+                        self._queue_condition.wait()
+                    if self._error is not None:
+                        raise self._error
+            self._queue.append((data, droppable, time.time()))
+            if len(self._queue) > self.counters.get('queue_depth_max'):
+                self.counters.set('queue_depth_max', len(self._queue))
+            self._queue_condition.notify_all()
+
+    def _write_loop(self):
+        while True:
+            with self._queue_condition:
+                while not self._queue and not self._closed:
+                    self._queue_condition.wait()
+                if not self._queue:
+                    return
+                data, droppable, enqueued = self._queue.popleft()
+                self._queue_condition.notify_all()
+            try:
+                msg_str, data = self._make_header(data)
+                with self._send_lock:
+                    self.socket.sendall(msg_str + data)
+            except Exception as e:
+                self.logger.exception('send queue writer terminated')
+                with self._queue_condition:
+                    self._error = e
+                    self._queue.clear()
+                    self._queue_condition.notify_all()
+                return
+            # Latency of a queued packet includes the time it spent in the queue
+            self.send_latency.add(time.time() - enqueued)
+            self.counters.add('packets_sent')
+            self.counters.add('bytes_sent', len(data))
+
+    def close(self, timeout=None):
+        """Stop accepting packets and wait until the queued ones have been written."""
+        with self._queue_condition:
+            self._closed = True
+            self._queue_condition.notify_all()
+        self._writer.join(timeout)
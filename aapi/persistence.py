@@ -0,0 +1,131 @@
+#
+# Background persistence of the last long_status document
+#
+# The server stores every long_status document in `last_measurements.xml`, so that it has
+# something to send to the controllers after a restart. Writing the file in the Aimsun
+# receiver thread would add the latency of the disk (and of any antivirus scanner watching
+# it) to every detection interval, and a crash in the middle of the write would leave a
+# truncated file behind. DocumentWriter writes in a thread of its own instead:
+# - only the newest document is kept; documents submitted while the writer is busy or
+#   waiting for `min_interval` to pass replace the pending one,
+# - the document is written into a temporary file in the same directory, flushed to disk and
+#   renamed over the target, so that the file always holds a complete document.
+#
+import os
+import threading
+import time
+import linkstats
+
+# Seconds between two writes of the file, 0 writes every document
+DEFAULT_MIN_INTERVAL = 0.0
+TEMP_SUFFIX = '.tmp'
+
+
+def replace_file(source, target):
+    """Rename `source` to `target`, replacing an existing `target` atomically."""
+    if os.name == 'nt':
+        # os.rename() on Windows fails if the target exists
+        import ctypes
+        movefile_replace_existing = 0x1
+        movefile_write_through = 0x8
+        if not ctypes.windll.kernel32.MoveFileExW(unicode(source), unicode(target),
+                                                  movefile_replace_existing | movefile_write_through):
+            raise ctypes.WinError()
+    else:
+        os.rename(source, target)
+
+
+def write_atomically(path, data):
+    """Write the data into the file `path` through a temporary file."""
+    temp_path = path + TEMP_SUFFIX
+    fhandle = open(temp_path, 'w')
+    try:
+        fhandle.write(data)
+        fhandle.flush()
+        os.fsync(fhandle.fileno())
+    finally:
+        fhandle.close()
+    replace_file(temp_path, path)
+
+
+class DocumentWriter(object):
+    """Thread writing the newest submitted document into a file."""
+
+    def __init__(self, path, min_interval=DEFAULT_MIN_INTERVAL, logger=None):
+        self.path = path
+        self.min_interval = min_interval
+        self.logger = logger
+        self.counters = linkstats.Counters()
+        self.write_time = linkstats.RollingPercentiles()
+        self._condition = threading.Condition()
+        self._pending = None
+        self._last_write = 0.0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='persistence')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def submit(self, data):
+        """Schedule the document for writing, replacing the one still pending. Never blocks
+        on the disk."""
+        with self._condition:
+            if self._closed:
+                return
+            if self._pending is not None:
+                self.counters.add('documents_coalesced')
+            self._pending = data
+            self.counters.add('documents_submitted')
+            self._condition.notify()
+
+    def _take(self):
+        """Wait for a document that may be written now; None means the writer is closed."""
+        with self._condition:
+            while True:
+                if self._pending is not None:
+                    delay = self._last_write + self.min_interval - time.time()
+                    if delay <= 0 or self._closed:
+                        data = self._pending
+                        self._pending = None
+                        return data
+                    self._condition.wait(delay)
+                elif self._closed:
+                    return None
+                else:
+                    self._condition.wait()
+
+    def _run(self):
+        while True:
+            data = self._take()
+            if data is None:
+                return
+            start = time.time()
+            try:
+                write_atomically(self.path, data)
+            except (IOError, OSError) as e:
+                self.counters.add('write_errors')
+                if self.logger is not None:
+                    self.logger.error('cannot write %s: %s' % (self.path, e))
+            else:
+                self.counters.add('documents_written')
+                self.counters.add('bytes_written', len(data))
+            self._last_write = time.time()
+            self.write_time.add(self._last_write - start)
+
+    def close(self, timeout=None):
+        """Write the pending document, if any, and stop the writer."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join(timeout)
+
+    def get_stats(self):
+        """Return the persistence statistics.
+
+        :rtype : dict
+        """
+        stats = self.counters.snapshot()
+        stats.update(self.write_time.snapshot('write_'))
+        with self._condition:
+            stats['pending'] = int(self._pending is not None)
+        stats['min_interval'] = self.min_interval
+        return stats
@@ -0,0 +1,343 @@
+#
+# Shared-memory transport between the Aimsun extension and the SIRID server
+#
+# Both processes always run on the same host, so instead of pushing every packet through
+# the loopback TCP connection they may exchange packets through a memory-mapped file. The
+# file holds two single-producer/single-consumer ring buffers ("lanes"), one per direction.
+# A packet is stored in a lane as a 32-bit little-endian length followed by the payload;
+# records wrap around the end of the lane.
+#
+# Every lane header holds two monotonically increasing 64-bit positions: the write position
+# is updated only by the producer after the record has been copied into the lane, the read
+# position only by the consumer after the record has been consumed. Both run on x86 hosts,
+# where the stores of a process are seen by other processes in program order, so no further
+# synchronisation is needed.
+#
+# The TCP connection that carried the AIMSUN_UP handshake stays open and serves as the
+# liveness channel: a waiting side watches it and gives up once the peer closes it.
+#
+import errno
+import mmap
+import os
+import select
+import socket
+import struct
+import tempfile
+import threading
+import time
+import logging
+import linkstats
+import packet
+
+TRANSPORT_TCP = 'tcp'
+TRANSPORT_SHM = 'shm'
+# Transports supported by this implementation, in the order of preference
+SUPPORTED_TRANSPORTS = [TRANSPORT_SHM, TRANSPORT_TCP]
+
+# Magic, version, number of lanes, lane capacity
+FILE_MAGIC = 'SRNG'
+FILE_VERSION = 1
+FILE_HEAD = struct.Struct('<4sBBxxI')
+FILE_HEAD_SIZE = 64
+# Write position, producer closed flag, ... read position. The positions live on different
+# cache lines so that the producer and the consumer do not fight over one line.
+WRITE_POS = struct.Struct('<Q')
+WRITE_POS_OFFSET = 0
+CLOSED_OFFSET = 8
+READ_POS = struct.Struct('<Q')
+READ_POS_OFFSET = 64
+LANE_HEAD_SIZE = 128
+RECORD_HEAD = struct.Struct('<I')
+
+# Lanes of the two directions
+LANE_TO_SERVER = 0
+LANE_TO_AIMSUN = 1
+NUM_LANES = 2
+
+ROLE_SERVER = 'server'
+ROLE_AIMSUN = 'aimsun'
+
+DEFAULT_LANE_SIZE = 4 * 1024 * 1024
+# A waiting side first yields the processor a few times and then sleeps (or waits on the
+# liveness socket) for a time growing up to the poll interval
+SPIN_COUNT = 50
+MIN_POLL_INTERVAL = 0.0001
+DEFAULT_POLL_INTERVAL = 0.002
+
+
+def select_transport(offered_transports, requested=TRANSPORT_TCP):
+    """Return the requested transport if the peer supports it, TRANSPORT_TCP otherwise."""
+    if requested in offered_transports and requested in SUPPORTED_TRANSPORTS:
+        return requested
+    return TRANSPORT_TCP
+
+
+def default_path():
+    """Return the default location of the shared file of this server process."""
+    return os.path.join(tempfile.gettempdir(), 'sirid_aimsun_%d.shm' % os.getpid())
+
+
+def create_file(path, lane_size=DEFAULT_LANE_SIZE):
+    """Create (or reset) the shared file with empty lanes of `lane_size` bytes each."""
+    fh = open(path, 'wb')
+    try:
+        fh.write(FILE_HEAD.pack(FILE_MAGIC, FILE_VERSION, NUM_LANES, lane_size).ljust(FILE_HEAD_SIZE, '\0'))
+        # Write the whole file so that no page has to be allocated during the simulation
+        chunk = '\0' * 65536
+        remaining = NUM_LANES * (LANE_HEAD_SIZE + lane_size)
+        while remaining > 0:
+            fh.write(chunk[:min(remaining, len(chunk))])
+            remaining -= len(chunk)
+    finally:
+        fh.close()
+
+
+class ShmRing(object):
+    """One lane of the shared file, used either as a producer or as a consumer."""
+
+    def __init__(self, shm, lane, lane_size):
+        self._shm = shm
+        self.size = lane_size
+        self._head = FILE_HEAD_SIZE + lane * (LANE_HEAD_SIZE + lane_size)
+        self._data = self._head + LANE_HEAD_SIZE
+
+    def write_pos(self):
+        return WRITE_POS.unpack_from(self._shm, self._head + WRITE_POS_OFFSET)[0]
+
+    def read_pos(self):
+        return READ_POS.unpack_from(self._shm, self._head + READ_POS_OFFSET)[0]
+
+    def is_closed(self):
+        return self._shm[self._head + CLOSED_OFFSET] != '\0'
+
+    def close(self):
+        self._shm[self._head + CLOSED_OFFSET] = '\1'
+
+    def free_space(self):
+        return self.size - (self.write_pos() - self.read_pos())
+
+    def _copy_in(self, pos, data):
+        """Copy `data` into the lane at the given position, wrapping around its end."""
+        offset = pos % self.size
+        first = self.size - offset
+        if first >= len(data):
+            self._shm[self._data + offset:self._data + offset + len(data)] = data
+        else:
+            self._shm[self._data + offset:self._data + self.size] = data[:first]
+            self._shm[self._data:self._data + len(data) - first] = data[first:]
+
+    def put(self, data):
+        """Append a record. The caller has checked that there is enough free space."""
+        pos = self.write_pos()
+        self._copy_in(pos, RECORD_HEAD.pack(len(data)))
+        self._copy_in(pos + RECORD_HEAD.size, data)
+        # Publish the record only after its payload is in place
+        struct.pack_into('<Q', self._shm, self._head + WRITE_POS_OFFSET, pos + RECORD_HEAD.size + len(data))
+
+    def peek(self):
+        """Return a tuple `(offset, length, wrapped)` of the oldest record, or None if the
+        lane is empty. `offset` is relative to the beginning of the file."""
+        pos = self.read_pos()
+        if pos == self.write_pos():
+            return None
+        head = self._read(pos, RECORD_HEAD.size)
+        msg_len, = RECORD_HEAD.unpack(head)
+        offset = (pos + RECORD_HEAD.size) % self.size
+        return self._data + offset, msg_len, offset + msg_len > self.size
+
+    def _read(self, pos, length):
+        offset = pos % self.size
+        first = min(length, self.size - offset)
+        data = self._shm[self._data + offset:self._data + offset + first]
+        if first < length:
+            data += self._shm[self._data:self._data + length - first]
+        return data
+
+    def read_record(self, msg_len):
+        """Return a copy of the oldest record with the announced length."""
+        return self._read(self.read_pos() + RECORD_HEAD.size, msg_len)
+
+    def release(self, msg_len):
+        """Discard the oldest record."""
+        struct.pack_into('<Q', self._shm, self._head + READ_POS_OFFSET, self.read_pos() + RECORD_HEAD.size + msg_len)
+
+
+class ShmCommunicator(object):
+    """Drop-in replacement of `packet.PacketCommunicator` exchanging packets through the
+    shared file.
+
+    The server creates the file and announces its path to the Aimsun extension in the
+    configuration packet, the extension then opens the file. `liveness_socket` is the TCP
+    connection of the handshake; it is not used for data but its closure tells the waiting
+    side that the peer is gone.
+    """
+
+    def __init__(self, path, role, logger_instance, liveness_socket=None, lane_size=DEFAULT_LANE_SIZE,
+                 create=False, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.path = path
+        self.logger = logging.getLogger(logger_instance)
+        self.socket = liveness_socket
+        self.poll_interval = poll_interval
+        if create:
+            create_file(path, lane_size)
+        self._fh = open(path, 'r+b')
+        magic, version, num_lanes, lane_size = FILE_HEAD.unpack(self._fh.read(FILE_HEAD.size))
+        if magic != FILE_MAGIC or version != FILE_VERSION or num_lanes != NUM_LANES:
+            self._fh.close()
+            raise ValueError("`%s` is not a SIRID shared-memory file of version %d" % (path, FILE_VERSION))
+        self._shm = mmap.mmap(self._fh.fileno(), FILE_HEAD_SIZE + NUM_LANES * (LANE_HEAD_SIZE + lane_size))
+        if role == ROLE_SERVER:
+            self._out = ShmRing(self._shm, LANE_TO_AIMSUN, lane_size)
+            self._in = ShmRing(self._shm, LANE_TO_SERVER, lane_size)
+        else:
+            self._out = ShmRing(self._shm, LANE_TO_SERVER, lane_size)
+            self._in = ShmRing(self._shm, LANE_TO_AIMSUN, lane_size)
+        # Several threads of the server may send commands, but a lane has a single producer
+        self._send_lock = threading.Lock()
+        # Set by `close()`; the file is unmapped and packets can no longer be sent
+        self.closed = False
+        self.counters = linkstats.Counters()
+        self.send_latency = linkstats.LatencyStats()
+        # Length of the record returned by the last `packet_receive_into()` that has not
+        # been released yet
+        self._pending = None
+        self._recv_buffer = bytearray(packet.RECV_BUFFER_SIZE)
+        self.logger.debug("shared-memory transport `%s` opened, %d bytes per lane" % (path, lane_size))
+
+    def set_framing(self, framing):
+        """Records in the lanes are self-delimiting, the framing does not apply."""
+        if framing not in packet.SUPPORTED_FRAMINGS:
+            raise ValueError("Unsupported framing `%s`" % framing)
+
+    def set_compression(self, compression, level=packet.DEFAULT_COMPRESSION_LEVEL,
+                        threshold=packet.DEFAULT_COMPRESSION_THRESHOLD):
+        """Compressing packets that are only copied in memory would not pay off."""
+        if compression != packet.COMPRESSION_NONE:
+            raise ValueError("The shared-memory transport does not compress packets")
+
+    def get_stats(self):
+        """Return traffic statistics of this connection.
+
+        :rtype : dict
+        """
+        stats = self.counters.snapshot()
+        stats['transport'] = TRANSPORT_SHM
+        if self.closed:
+            return stats
+        stats['receive_backlog'] = self._in.write_pos() - self._in.read_pos()
+        stats['send_backlog'] = self._out.write_pos() - self._out.read_pos()
+        stats.update(self.send_latency.snapshot('send_latency_'))
+        return stats
+
+    def _peer_closed(self):
+        """Return True if the peer closed the liveness socket or its lane."""
+        if self._in.is_closed():
+            return True
+        if self.socket is None:
+            return False
+        try:
+            data = self.socket.recv(1, socket.MSG_PEEK)
+        except socket.error:
+            return True
+        if data:
+            # Nothing shall be sent over the socket once the shared file is in use
+            self.logger.warning("unexpected data on the liveness socket")
+            time.sleep(self.poll_interval)
+            return False
+        return True
+
+    def _wait(self, condition):
+        """Wait until `condition()` holds. Returns False if the peer disconnected meanwhile."""
+        for i in xrange(SPIN_COUNT):
+            if condition():
+                return True
+            time.sleep(0)
+        self.counters.add('waits')
+        interval = MIN_POLL_INTERVAL
+        while not condition():
+            if self.socket is not None:
+                readable, unused, unused = select.select([self.socket], [], [], interval)
+                if readable and self._peer_closed():
+                    return False
+            else:
+                time.sleep(interval)
+                if self._in.is_closed():
+                    return False
+            interval = min(2 * interval, self.poll_interval)
+        return True
+
+    def packet_send(self, data, droppable=False):
+        record_len = RECORD_HEAD.size + len(data)
+        if record_len > self._out.size:
+            raise ValueError("Packet of %d bytes does not fit into the shared-memory lane of %d bytes" %
+                             (len(data), self._out.size))
+        start = time.time()
+        with self._send_lock:
+            if self.closed:
+                raise socket.error(errno.EPIPE, "The shared-memory transport has been closed")
+            if self._out.free_space() < record_len:
+                self.counters.add('send_full')
+                if not self._wait(lambda: self._out.free_space() >= record_len):
+                    raise socket.error("Peer disconnected while the shared-memory lane was full")
+            self._out.put(data)
+        self.send_latency.add(time.time() - start)
+        self.counters.add('packets_sent')
+        self.counters.add('bytes_sent', len(data))
+
+    def _receive_record(self):
+        """Wait for the next record and return its `(offset, length, wrapped)` tuple, or None
+        if the peer has disconnected."""
+        if self._pending is not None:
+            self._in.release(self._pending)
+            self._pending = None
+        if not self._wait(lambda: self._in.peek() is not None):
+            self.logger.debug('peer disconnected, no more data in the shared-memory lane')
+            return None
+        record = self._in.peek()
+        self.counters.add('packets_received')
+        self.counters.add('bytes_received', record[1])
+        return record
+
+    def packet_receive(self):
+        record = self._receive_record()
+        if record is None:
+            return None
+        offset, msg_len, wrapped = record
+        data = self._in.read_record(msg_len)
+        self._in.release(msg_len)
+        return data
+
+    def packet_receive_into(self):
+        """Receive a packet without copying it out of the shared file.
+
+        Returns a read-only `buffer` over the record in the lane, or None if the peer has
+        disconnected. The record stays reserved, and the buffer valid, until the next call of
+        this method. Records that wrap around the end of the lane are copied into a reusable
+        buffer instead."""
+        record = self._receive_record()
+        if record is None:
+            return None
+        offset, msg_len, wrapped = record
+        self._pending = msg_len
+        if not wrapped:
+            return buffer(self._shm, offset, msg_len)
+        if msg_len > len(self._recv_buffer):
+            self._recv_buffer = bytearray(max(msg_len, 2 * len(self._recv_buffer)))
+        self._recv_buffer[:msg_len] = self._in.read_record(msg_len)
+        return buffer(self._recv_buffer, 0, msg_len)
+
+    def close(self, remove=False):
+        """Mark the outgoing lane closed and unmap the file. Threads sending packets
+        afterwards get socket.error, as they would from a closed socket."""
+        with self._send_lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._out.close()
+            self._shm.close()
+            self._fh.close()
+        if remove:
+            try:
+                os.remove(self.path)
+            except OSError:
+                self.logger.warning("cannot remove the shared-memory file `%s`" % self.path)
@@ -1,20 +1,36 @@
 #!/usr/bin/python
-from collections import defaultdict
 import threading
 import socket
 import SocketServer
 import sys
 import xml.etree.ElementTree as Et
-from xml.dom import minidom
 from xml.parsers.expat import ExpatError
 import _winreg as wreg
 import os
 import pickle
-import gantry  # needed for CATEOGRY definition list
-import re  # needed for re-formatting minidom output (only for Python <= 2.6
 import packet
+import measurement_codec
+import long_status
+import linkstats
+import shmring
+import handshake
+import xml_framer
+import event_server
+import outbound
+import gantry_command
+import multiprocessing
+import coalescer
+import status_cache
+import subscription
+import http_gateway
+import connection_reaper
+import delta_status
+import persistence
+import history
+import archive
 import logging
 import ConfigParser
+import select
 import time
 
 # @type boolean
@@ -27,6 +43,56 @@ AIMSUN_DATA_SOCKET = None
 AIMSUN_PORT = 1251
 """:type : PacketCommunicator"""
 AIMSUN_PACKETCOMM = None
+# @type boolean
+AIMSUN_BATCH_COMMANDS = False
+# Control channel to Aimsun carrying the synchronisation tokens, None if the extension
+# uses a single connection
+# @type socket
+AIMSUN_CONTROL_SOCKET = None
+""":type : PacketCommunicator"""
+AIMSUN_CONTROL_PACKETCOMM = None
+# Number of packets sent to Aimsun over the bulk channel since the handshake
+AIMSUN_BULK_SEQ = 0
+# @type ThreadLock
+AIMSUN_BULK_LOCK = threading.Lock()
+""":type : packet.Heartbeat"""
+AIMSUN_HEARTBEAT = None
+# @type boolean
+AIMSUN_TIMED_BATCHES = False
+# Batches tell Aimsun which of them belong to a single controller message
+# @type boolean
+AIMSUN_BATCH_PARTS = False
+# Keeps the batches of a controller message together on the way to Aimsun
+# @type ThreadLock
+AIMSUN_BATCH_LOCK = threading.Lock()
+# Largest number of commands Aimsun accepts in a single batch
+# @type int
+AIMSUN_MAX_BATCH_COMMANDS = 1
+# Packets received from Aimsun during the handshake, processed by the receiver thread
+AIMSUN_PENDING_PACKETS = []
+# Final configuration of a version 1 handshake that timed out waiting for the capabilities
+# of the extension; it is sent if the capabilities arrive late, see `process_aimsun_token()`
+AIMSUN_FALLBACK_CONFIG = None
+# Time from the start of `process_command()` until its commands have been sent to Aimsun
+COMMAND_DELAY = linkstats.RollingPercentiles()
+# Coalescer keeping the latest command per sign, None if the commands are sent right away
+# @type coalescer.CommandCoalescer
+COMMAND_COALESCER = None
+# Worker processes parsing the command stanzas, None if the commands are parsed in the
+# connection threads (`command_workers` in the [local] section of sirid_server.ini)
+COMMAND_POOL = None
+# Gateway streaming the long_status documents to HTTP viewers, None if it is disabled
+# (`port` in the [http] section of sirid_server.ini)
+# @type http_gateway.HttpGateway
+HTTP_GATEWAY = None
+# Background writer of LAST_MEASUREMENTS_FILE, None if the file is not written
+# (`persist` in the [measurements] section of sirid_server.ini)
+# @type persistence.DocumentWriter
+MEASUREMENTS_WRITER = None
+# Archive of the measurements of the running replication, None if they are not archived
+# (`directory` in the [archive] section of sirid_server.ini)
+# @type archive.ArchiveWriter
+MEASUREMENT_ARCHIVE = None
 # @type str
 SIMULATION_READY = '<?xml version="1.0" encoding="UTF-8" ?><root msg="simulation_ready"></root>'
 # @type str
@@ -35,23 +101,98 @@ SIMULATION_FINISHED = '<?xml version="1.0" encoding="UTF-8" ?><root msg="simulat
 RECEIVER_LOCK = threading.Lock()
 # @type ThreadLock
 AIMSUN_STARTUP_LOCK = threading.Lock()
-#
-RECEIVER_WFILES = dict()
+# Outbound queues of the controller connections (see `outbound`), the Aimsun receiver thread
+# only enqueues documents and a writer per connection sends them
+RECEIVER_QUEUES = dict()
 #
 RECEIVER_ADDRESS = dict()
+# Per-connection options requested by the controllers (compression level of the long_status
+# documents sent to the controller)
+RECEIVER_OPTIONS = dict()
+# Key of the subscription.FragmentCache among the encoded variants of a STATUS_CACHE entry
+FRAGMENTS_KEY = 'fragments'
+# Counters of the traffic towards the controllers
+RECEIVER_COUNTERS = linkstats.Counters()
 #
 SEQUENCE_NR = 1
-# See http://stackoverflow.com/questions/749796/pretty-printing-xml-in-python
-MINIDOM_TEXT_RE = re.compile('>\n\s+([^<>\s].*?)\n\s+</', re.DOTALL)
 #
 CONFIG = None
+# Options of sirid_server.ini beyond [local] and [model], all of them optional:
+#
+# [aimsun]
+# compression = zlib|none         compression of packets exchanged with Aimsun
+# compression_level = 6           zlib compression level
+# compression_threshold = 1024    packets shorter than this are sent uncompressed
+# transport = tcp|shm             shm exchanges packets through a memory-mapped file
+# shm_path = ...                  location of the file, a temporary file by default
+# shm_lane_size = 4194304         capacity of each direction in bytes
+# shm_poll_interval = 0.002       longest sleep in seconds of a side waiting for data
+# control_channel = true          send synchronisation tokens over a separate connection
+# max_batch_commands = 65535      commands per batch, larger controller messages are split
+# coalesce_window = 0.0           seconds of commands merged keeping the latest one per sign,
+#                                 0 sends them right away; synchronous simulations flush the
+#                                 window at the end of every simulation step
+# send_queue_size = 0             packets Aimsun may queue for sending (e.g. 64), 0 sends
+#                                 synchronously and never drops a measurement interval
+# send_queue_policy = drop_oldest what Aimsun does when the queue is full: drop_oldest|block|fail
+# heartbeat_interval = 5.0        seconds between @PING tokens sent to Aimsun, 0 disables them
+# heartbeat_timeout = 30.0        Aimsun is reported as not responding after this many seconds
+#
+# [controllers]
+# queue_size = 16                 documents queued for a controller, 0 means unbounded
+# status_cache_size = 4           recent long_status documents resent to controllers that
+#                                 missed them (conditional get_long_status)
+# queue_policy = drop_stale       when a controller falls behind: drop_stale|latest|disconnect
+# max_lag = 30.0                  seconds behind after which `disconnect` closes the connection
+# idle_timeout = 0.0              seconds without traffic after which a connection is closed,
+#                                 0 keeps idle connections open
+# write_timeout = 60.0            seconds a single document may take to be written before the
+#                                 connection is considered stalled and closed, 0 disables it
+# keepalive = true                probe silent connections to find dead peers
+# keepalive_idle = 60             seconds of silence before the first probe
+# keepalive_interval = 10         seconds between the probes
+# keepalive_count = 5             unanswered probes after which the connection is reset
+# delta_keyframe_interval = 10    delta documents between two full keyframes for controllers
+#                                 in delta mode that do not choose their own, 0 means never
+# compression_level = 6           zlib level for controllers that request compression
+# compression_threshold = 1024    documents shorter than this are sent uncompressed
+#
+# [local]
+# xml_framer = streaming|legacy   framer splitting the controller stream into XML stanzas
+# server_mode = threaded|event    a thread per controller connection, or a single event loop
+# command_workers = 0             processes parsing the command stanzas, 0 parses them in place
+#
+# [http]
+# host =                          address of the HTTP gateway for read-only viewers
+# port = 0                        port of the HTTP gateway, 0 disables it
+#
+# [measurements]
+# persist = true                  keep the last long_status document in last_measurements.xml
+# persist_interval = 0.0          minimum seconds between two writes of the file, the documents
+#                                 in between are skipped
+#
+# [history]
+# size = 60                       detection intervals kept for get_history, 0 disables it
+# memory_limit_mb = 64.0          upper limit of the memory taken by the kept measurements
+#
+# [archive]
+# directory =                     directory of the measurement archives of the replications
+#                                 (see `archive`), empty disables archiving
 
 # Maximum size of a XML message. If the input buffer grows above this limit it is
 # cleared and the reading starts over.
 MAX_XML_SIZE = 16 * 1024 * 1024
 
-# Buffer size. This is a chunk size
-BUFFER_SIZE = 16
+# Buffer size. This is the maximum number of bytes read from a controller connection by
+# a single recv(); the framer copes with stanzas split across any number of reads.
+BUFFER_SIZE = 64 * 1024
+
+# Seconds a finishing request handler waits for its writer to send the queued documents
+WRITER_JOIN_TIMEOUT = 5.0
+
+# Server modes selectable by `server_mode` in the [local] section of sirid_server.ini
+SERVER_MODE_THREADED = 'threaded'
+SERVER_MODE_EVENT = 'event'
 
 # Last measurements that will be sent as fake data during the first minute
 LAST_MEASUREMENTS_FILE = 'last_measurements.xml'
@@ -61,20 +202,23 @@ LOGGER_NAME = "sirid_server"
 # Create a logger object
 LOGGER = logging.getLogger(LOGGER_NAME)
 LOGGER.setLevel(logging.DEBUG)
-# Create file handler which logs even debug messages
-fh = logging.FileHandler(LOGGER_NAME + '.log', mode='w')
-fh.setLevel(logging.DEBUG)
-# Create console handler with a lower log level
-ch = logging.StreamHandler()
-ch.setLevel(logging.INFO)
-# create formatters and add it to the handlers
-formatter = logging.Formatter('%(threadName)-10s: %(levelname)-8s %(message)s')
-ch.setFormatter(formatter)
-formatter = logging.Formatter('%(asctime)s - %(threadName)-10s: %(levelname)-8s %(message)s')
-fh.setFormatter(formatter)
-# add the handlers to logger
-LOGGER.addHandler(ch)
-LOGGER.addHandler(fh)
+# On Windows the worker processes of the command parser pool import this module again; they
+# must not truncate the log of the server
+if multiprocessing.current_process().name == 'MainProcess':
+    # Create file handler which logs even debug messages
+    fh = logging.FileHandler(LOGGER_NAME + '.log', mode='w')
+    fh.setLevel(logging.DEBUG)
+    # Create console handler with a lower log level
+    ch = logging.StreamHandler()
+    ch.setLevel(logging.INFO)
+    # create formatters and add it to the handlers
+    formatter = logging.Formatter('%(threadName)-10s: %(levelname)-8s %(message)s')
+    ch.setFormatter(formatter)
+    formatter = logging.Formatter('%(asctime)s - %(threadName)-10s: %(levelname)-8s %(message)s')
+    fh.setFormatter(formatter)
+    # add the handlers to logger
+    LOGGER.addHandler(ch)
+    LOGGER.addHandler(fh)
 
 LOGGER.debug("logging started")
 
@@ -82,174 +226,451 @@ fhandle = open(LAST_MEASUREMENTS_FILE, 'r')
 LAST_MEASUREMENTS = fhandle.read()
 fhandle.close()
 
-LOGGER.debug("last measurements loaded")
+# Recent long_status documents serving the conditional get_long_status requests
+STATUS_CACHE = status_cache.StatusCache()
+STATUS_CACHE.add(status_cache.find_seq_nr(LAST_MEASUREMENTS), LAST_MEASUREMENTS)
+# Continue the sequence of the stored document, so that the sequence numbers known to the
+# controllers stay valid across restarts of the server
+if STATUS_CACHE.latest()[0] is not None:
+    SEQUENCE_NR = STATUS_CACHE.latest()[0] + 1
 
+LOGGER.debug("last measurements loaded")
 
-def recursive_defaultdict():
-    return defaultdict(recursive_defaultdict)
+# Measurements of the last detection intervals serving get_history, configured in `__main__`
+HISTORY = history.MeasurementHistory()
+
+
+def get_config_option(section, option, default):
+    """Return an option of sirid_server.ini converted to the type of `default`, or `default`
+    if the option is not configured."""
+    if CONFIG is None or not CONFIG.has_option(section, option):
+        return default
+    if isinstance(default, bool):
+        return CONFIG.getboolean(section, option)
+    if isinstance(default, int):
+        return CONFIG.getint(section, option)
+    if isinstance(default, float):
+        return CONFIG.getfloat(section, option)
+    return CONFIG.get(section, option)
+
+
+def receiver_stats():
+    """Statistics of the traffic towards the controllers, see `linkstats`."""
+    stats = RECEIVER_COUNTERS.snapshot()
+    stats['compression_ratio'] = linkstats.ratio(stats.get('compression_bytes_in', 0),
+                                                 stats.get('compression_bytes_out', 0))
+    stats['delta_ratio'] = linkstats.ratio(stats.get('delta_full_bytes', 0), stats.get('delta_bytes', 0))
+    queues = RECEIVER_QUEUES.values()
+    stats['connections'] = len(queues)
+    stats['queued_documents'] = sum([queue.depth() for queue in queues])
+    stats['max_lag'] = max([0.0] + [queue.lag() for queue in queues])
+    return stats
+
+linkstats.register('controllers', receiver_stats)
+linkstats.register('history', HISTORY.get_stats)
+# Watches the controller connections for idle and stalled ones, configured in `__main__`
+REAPER = connection_reaper.ConnectionReaper(logger=LOGGER)
+linkstats.register('connections', REAPER.get_stats)
+linkstats.register('aimsun_commands', lambda: COMMAND_DELAY.snapshot('delay_'))
+
+
+def document_for_receiver(entry, thread_name):
+    """Return the long_status document of a STATUS_CACHE entry as it shall be sent to the
+    receiver in `thread_name`, taking into account its subscription and the compression it
+    requested. The fragments and the encoded variants of the document are kept in the entry
+    so that each variant is produced only once.
+
+    A receiver in delta mode gets the delta against the last document it acknowledged, or
+    the full document as a keyframe, see `delta_status`; the document counts as sent."""
+    seq_nr, xml_string, encoded_cache = entry
+    options = RECEIVER_OPTIONS.get(thread_name, {})
+    variant = None
+    delta = options.get('delta')
+    if delta is not None:
+        base_seq_nr = delta.next_base(seq_nr)
+        if base_seq_nr is not None:
+            base_entry = STATUS_CACHE.find(base_seq_nr)
+            document = None
+            if base_entry is not None:
+                document = delta_status.delta_document(entry, base_entry)
+            if document is None:
+                # The base document has left the cache or the schema has changed
+                delta.keyframe_forced()
+            else:
+                xml_string = document
+                variant = ('delta', base_seq_nr)
+                RECEIVER_COUNTERS.add('delta_documents')
+                RECEIVER_COUNTERS.add('delta_bytes', len(document))
+                RECEIVER_COUNTERS.add('delta_full_bytes', len(entry[1]))
+        if variant is None:
+            RECEIVER_COUNTERS.add('delta_keyframes')
+    sub = options.get('subscription')
+    if sub is None:
+        return encode_for_receiver(xml_string, thread_name, encoded_cache, variant)
+    fragments_key = FRAGMENTS_KEY
+    sub_variant = sub.key()
+    if variant is not None:
+        fragments_key = (FRAGMENTS_KEY, variant)
+        sub_variant = (variant, sub.key())
+    fragments = encoded_cache.get(fragments_key)
+    if fragments is None:
+        fragments = encoded_cache[fragments_key] = subscription.FragmentCache(xml_string)
+    return encode_for_receiver(fragments.document(sub), thread_name, encoded_cache, sub_variant)
+
+
+def encode_for_receiver(xml_string, thread_name, encoded_cache, variant=None):
+    """Return the document as it shall be sent to the receiver in `thread_name`, taking into
+    account the compression requested by the receiver. Encoded variants of the document are
+    kept in `encoded_cache` so that each variant is encoded only once per fan-out; `variant`
+    tells apart different documents sharing the cache."""
+    level = RECEIVER_OPTIONS.get(thread_name, {}).get('compression_level')
+    if level is None:
+        return xml_string
+    cache_key = level
+    if variant is not None:
+        cache_key = (variant, level)
+    try:
+        return encoded_cache[cache_key]
+    except KeyError:
+        pass
+    threshold = get_config_option('controllers', 'compression_threshold', packet.DEFAULT_COMPRESSION_THRESHOLD)
+    if len(xml_string) < threshold:
+        encoded = xml_string
+    else:
+        start = time.time()
+        encoded = long_status.compress_document(xml_string, level)
+        RECEIVER_COUNTERS.add('compression_time', time.time() - start)
+        RECEIVER_COUNTERS.add('compressed_documents')
+        RECEIVER_COUNTERS.add('compression_bytes_in', len(xml_string))
+        RECEIVER_COUNTERS.add('compression_bytes_out', len(encoded))
+    encoded_cache[cache_key] = encoded
+    return encoded
 
 
 def aimsun_receiver():
     global LAST_MEASUREMENTS
+    global COMMAND_COALESCER
+    global MEASUREMENT_ARCHIVE
     global AIMSUN_PACKETCOMM
     global AIMSUN_DATA_SOCKET
     global SEQUENCE_NR
     global AIMSUN_RUNNING
 
+    # Detector schema announced by the Aimsun extension (binary measurement codec only)
+    schema_id = None
+    schema = None
+
     while True:
 
-        data = AIMSUN_PACKETCOMM.packet_receive()
+        # Measurement packets may be large, receive them into the reusable buffer of the
+        # packet communicator instead of concatenating them chunk by chunk
+        if AIMSUN_PENDING_PACKETS:
+            data = AIMSUN_PENDING_PACKETS.pop(0)
+        else:
+            data = AIMSUN_PACKETCOMM.packet_receive_into()
         if not data:
             break
 
-        time_str, dets = pickle.loads(data)
+        if data[:1] == '@':
+            # Without the control channel heartbeat replies come over the bulk channel
+            process_aimsun_token(data)
+            continue
+        if measurement_codec.is_schema(data):
+            # Static detector descriptors, sent once before the first detection interval
+            schema_id, schema = measurement_codec.decode_schema(data)
+            LOGGER.info('got detector schema %08x with %d detectors' % (schema_id, len(schema)))
+            continue
+        elif measurement_codec.is_interval(data):
+            interval_schema_id, time_str, values = measurement_codec.decode_interval(data)
+            if interval_schema_id != schema_id:
+                LOGGER.error('measurements for unknown detector schema %08x ignored' % interval_schema_id)
+                continue
+        else:
+            # Legacy Aimsun extension pickles the detector descriptors together with the data
+            time_str, dets = pickle.loads(str(data))
+            schema, values = measurement_codec.dicts_to_values(dets)
 
         # Convert measurement data to XML
-        gantry_server = recursive_defaultdict()
-        gs_device_type = recursive_defaultdict()
-        gs_sub_device_type = recursive_defaultdict()
-        for det in dets:
-            # Consult aapi_gantry.py to see how these pieces are glued together
-            det_name, det_map, data = det
-            # TODO: This is ugly. Group the information into a class or some other structure.
-            id_gantry_server, id_device, device_type, id_sub_device, \
-                sub_device_type, sub_device_description, id_lane, det_type, str_lane, prefix = det_map
-            # Store information needed to construct the XML output
-            gs_device_type[id_gantry_server][id_device] = \
-                device_type
-            gs_sub_device_type[id_gantry_server][id_device][id_sub_device] = \
-                (sub_device_type, sub_device_description)
-            gantry_server[id_gantry_server][id_device][id_sub_device][id_lane] = \
-                (det_type, det_name, prefix, str_lane, data)
-
-        xml_string = ''
-        envelope = Et.Element('root', attrib={'msg': 'long_status'})
-        for id_gantry_server in gantry_server:
-            # Create root element of the gantry server packet
-            root = Et.SubElement(envelope, 'gantry', attrib={'msg': 'long_status', 'id': id_gantry_server})
-            # print 'gantry server:', id_gantry_server
-            seq_nr_node = Et.SubElement(root, 'seq_nr')
-            seq_nr_node.text = str(SEQUENCE_NR)
-            send_time_node = Et.SubElement(root, 'send_time')
-            send_time_node.text = str(time_str)
-            sender_node = Et.SubElement(root, 'sender')
-            sender_node.text = id_gantry_server
-            devices = gantry_server[id_gantry_server]
-            for id_device in devices:
-                device_type = gs_device_type[id_gantry_server][id_device]
-                device_node = Et.SubElement(root, 'device', attrib={'id': str(id_device), 'type': device_type})
-                sub_devices = devices[id_device]
-                for id_sub_device in sub_devices:
-                    sub_device_type, sub_device_description = \
-                        gs_sub_device_type[id_gantry_server][id_device][id_sub_device]
-                    sub_device_attribs = {'id': str(id_sub_device), 'time_stamp': time_str,
-                                          'type': sub_device_type, 'description': sub_device_description}
-                    sub_device_node = Et.SubElement(device_node, 'subdevice', attrib=sub_device_attribs)
-                    lanes = sub_devices[id_sub_device]
-                    for id_lane in lanes:
-                        det_type, det_name, prefix, str_lane, data = lanes[id_lane]
-                        lane_node = Et.SubElement(sub_device_node,
-                                                  'lane',
-                                                  attrib={'id': str(id_lane), 'type': det_type, 'lane': str_lane})
-                        LOGGER.debug("   %d/%d/%d (%s,%s)" % (id_device, id_sub_device, id_lane, det_name, prefix))
-                        count, speed, occup = data
-                        for i in xrange(9):
-                            category_node = Et.SubElement(lane_node, 'category', attrib=gantry.CATEGORY[i])
-                            count_node = Et.SubElement(category_node, 'intensity')
-                            speed_node = Et.SubElement(category_node, 'speed')
-                            occup_node = Et.SubElement(category_node, 'occupancy')
-                            try:
-                                count_node.text = str(int(count[i]))
-                                speed_node.text = str(float(speed[i]))
-                                occup_node.text = str(float(occup[i]))
-                                LOGGER.debug("    [%d]: %10f %10f %10f" % (i, count[i], speed[i], occup[i]))
-                            except KeyError as ke:
-                                # Accept the situation when the model does not provide 9 classes of vehicles
-                                # TODO: This is just a kludge, the model does have to have 9 classes
-                                LOGGER.warning('Key error when processing detector data:', ke)
-
-        # See also http://pymotw.com/2/xml/etree/ElementTree/create.html for information about pretty-printing
-        minified_str = Et.tostring(envelope, 'UTF-8')
-        reparsed = minidom.parseString(minified_str)
-        xml_with_text_indents = reparsed.toprettyxml(indent="  ")
-        xml_string += MINIDOM_TEXT_RE.sub('>\g<1></', xml_with_text_indents)
+        template = long_status.template_for(schema)
+        xml_string = template.render(time_str, values, SEQUENCE_NR)
+        HISTORY.add(schema, SEQUENCE_NR, time_str, values)
+        if MEASUREMENT_ARCHIVE is not None:
+            MEASUREMENT_ARCHIVE.add(schema, SEQUENCE_NR, time_str, values)
 
         # Copy the result out to a global string variable. Yuck.
         # The global is needed due to possible "GET_LONG_STATUS" request from the client.
+        entry = STATUS_CACHE.add(SEQUENCE_NR, xml_string)
+        # The measurements are kept for the delta documents of the controllers in delta mode
+        entry[2][delta_status.MEASUREMENTS_KEY] = (template, values, time_str)
+        if has_subscriptions():
+            # Split the document into the fragments of the gantry servers once for all
+            # subscribers
+            entry[2][FRAGMENTS_KEY] = subscription.FragmentCache(xml_string)
         SEQUENCE_NR += 1
         LAST_MEASUREMENTS = xml_string
-        send_last_measurements(RECEIVER_WFILES.keys())
-
-        fh_measurements = open(LAST_MEASUREMENTS_FILE, 'w')
-        fh_measurements.write(LAST_MEASUREMENTS)
-        fh_measurements.close()
+        send_last_measurements(RECEIVER_QUEUES.keys())
+        if HTTP_GATEWAY is not None:
+            HTTP_GATEWAY.publish(entry)
+        if MEASUREMENTS_WRITER is not None:
+            MEASUREMENTS_WRITER.submit(xml_string)
 
     print '-- Aimsun disconnected, receiver thread finished'
+    if isinstance(AIMSUN_PACKETCOMM, shmring.ShmCommunicator):
+        # Connection handlers, the coalescer and the heartbeat may still be sending to
+        # Aimsun; from now on they get socket.error
+        with AIMSUN_BULK_LOCK:
+            AIMSUN_PACKETCOMM.close(remove=True)
+    close_control_channel()
+    if COMMAND_COALESCER is not None:
+        discarded = COMMAND_COALESCER.close()
+        if discarded:
+            LOGGER.info('%d coalesced commands discarded' % len(discarded))
+        COMMAND_COALESCER = None
+    if MEASUREMENT_ARCHIVE is not None:
+        MEASUREMENT_ARCHIVE.close()
+        MEASUREMENT_ARCHIVE = None
     AIMSUN_DATA_SOCKET = None
     AIMSUN_RUNNING = False
 
-    if RECEIVER_WFILES:
+    if RECEIVER_QUEUES:
         LOGGER.info('-- notifying the controllers that the simulation is no longer active')
-        LOGGER.debug('sending notification')
-        with RECEIVER_LOCK:
-            LOGGER.debug('   got lock')
-            for thread_name in RECEIVER_WFILES:
-                # noinspection PyBroadException
-                try:
-                    wfile = RECEIVER_WFILES[thread_name]
-                    wfile.write(SIMULATION_FINISHED)
-                    wfile.flush()
-                    LOGGER.info("   -- notification sent to receiver in {0:s}/{1:s}".format(
-                        thread_name, RECEIVER_ADDRESS[thread_name]))
-                except:
-                    e_type, e_val, e_trace = sys.exc_info()
-                    LOGGER.exception('Exception for receiver {0:s} - {1:s} {2:s}'.format(thread_name, e_type, e_val))
-        LOGGER.debug('   lock released')
+        for thread_name in RECEIVER_QUEUES.keys():
+            if send_to_receiver(thread_name, SIMULATION_FINISHED):
+                LOGGER.info("   -- notification queued for receiver in {0:s}/{1:s}".format(
+                    thread_name, RECEIVER_ADDRESS[thread_name]))
     else:
         LOGGER.info('-- no controllers seem to be active at the moment, no notification sent')
 
 
+def make_receiver_queue(thread_name):
+    """Return a new outbound queue for the controller connection `thread_name` configured by
+    the [controllers] section of sirid_server.ini.
+
+    :rtype : outbound.OutboundQueue
+    """
+    queue = outbound.OutboundQueue(thread_name, counters=RECEIVER_COUNTERS)
+    configure_receiver_queue(queue)
+    return queue
+
+
+def configure_receiver_queue(queue):
+    queue.counters = RECEIVER_COUNTERS
+    queue.configure(get_config_option('controllers', 'queue_size', outbound.DEFAULT_QUEUE_SIZE),
+                    get_config_option('controllers', 'queue_policy', outbound.POLICY_DROP_STALE),
+                    get_config_option('controllers', 'max_lag', outbound.DEFAULT_MAX_LAG))
+
+
+def watch_connection(sock, thread_name, queue, abort):
+    """Turn TCP keepalive on for a new controller connection and let REAPER watch it."""
+    if get_config_option('controllers', 'keepalive', True):
+        try:
+            connection_reaper.enable_keepalive(
+                sock, get_config_option('controllers', 'keepalive_idle', connection_reaper.DEFAULT_KEEPALIVE_IDLE),
+                get_config_option('controllers', 'keepalive_interval', connection_reaper.DEFAULT_KEEPALIVE_INTERVAL),
+                get_config_option('controllers', 'keepalive_count', connection_reaper.DEFAULT_KEEPALIVE_COUNT))
+        except socket.error as e:
+            LOGGER.warning('cannot enable keepalive for %s: %s' % (thread_name, e))
+    REAPER.register(thread_name, queue, abort)
+
+
+def forget_receiver(thread_name):
+    """Remove a controller connection from the receiver tables, so that the fan-out skips it
+    right away."""
+    queue = RECEIVER_QUEUES.pop(thread_name, None)
+    if queue is not None:
+        queue.close()
+
+
+def send_to_receiver(thread_name, data, frame=False):
+    """Queue a document for the controller connection `thread_name`. Long_status documents
+    are queued as frames that the slow-consumer policy may drop. Returns False if the
+    connection is gone or has been given up."""
+    queue = RECEIVER_QUEUES.get(thread_name)
+    if queue is None:
+        return False
+    if not queue.put(data, frame):
+        LOGGER.error('receiver %s/%s does not accept data any more, discarding it' % (
+            thread_name, RECEIVER_ADDRESS.get(thread_name)))
+        RECEIVER_QUEUES.pop(thread_name, None)
+        return False
+    return True
+
+
 def send_last_measurements(receiver_list):
     if LAST_MEASUREMENTS:
-        # The receiver locks blocks also possible error output from the GantryRequest instance
-        # If an error occurs there, it will be handled after the sending task has been completed.
+        # Only references to the shared, already encoded document are queued here; the
+        # writers of the connections send them, so that a slow controller delays nobody else
         current_thread = threading.current_thread()
         master_thread_name = current_thread.name
-        print '   waiting on receiver lock in master thread ' + master_thread_name
+        entry = STATUS_CACHE.latest()
         with RECEIVER_LOCK:
-            LOGGER.debug('locked by %s for %s' % (master_thread_name, str(receiver_list)))
-            print '-- send_last_measurement begin in ' + master_thread_name
+            LOGGER.debug('fan-out by %s for %s' % (master_thread_name, str(receiver_list)))
             for thread_name in receiver_list:
-                # noinspection PyBroadException
-                try:
-                    wfile = RECEIVER_WFILES[thread_name]
-                    print "   -- sending data to receiver %s/%s" % (thread_name, RECEIVER_ADDRESS[thread_name])
-                    LOGGER.debug("sending data to receiver %s/%s" % (thread_name, RECEIVER_ADDRESS[thread_name]))
-                    wfile.write(LAST_MEASUREMENTS)
-                    LOGGER.debug("write ok")
-                    wfile.flush()
-                    LOGGER.debug(
-                        "flush ok, sent data to receiver %s/%s" % (thread_name, RECEIVER_ADDRESS[thread_name]))
-                except socket.error as e:
-                    LOGGER.error('socket error in %s for receiver %s/%s' % (
-                        master_thread_name, thread_name, RECEIVER_ADDRESS[thread_name]))
-                    print "   !! socket.error for write() in %s/%s (errno=%d, `%s`), discarding thread" % \
-                          (thread_name, RECEIVER_ADDRESS[thread_name], e.errno, e.strerror)
-                    RECEIVER_WFILES.pop(thread_name, None)
-                except:
-                    e_type, e_val, e_trace = sys.exc_info()
-                    LOGGER.error('exception %s (%s) in %s for receiver %s/%s' % (
-                        e_type, e_val, master_thread_name, thread_name, RECEIVER_ADDRESS[thread_name]))
-                    print thread_name, "Exception -", e_type, e_val
-            print '   send_last_measurement end in ' + master_thread_name
-        LOGGER.debug('unlocked by' + master_thread_name)
-        print '   lock released in ' + master_thread_name
+                if thread_name not in RECEIVER_QUEUES:
+                    continue
+                print "   -- queueing data for receiver %s/%s" % (thread_name, RECEIVER_ADDRESS[thread_name])
+                data = document_for_receiver(entry, thread_name)
+                if send_to_receiver(thread_name, data, frame=True):
+                    RECEIVER_COUNTERS.add('documents_queued')
     else:
         print '-- no last measurements are available, ignoring this request'
 
     LOGGER.debug('number of active threads: %d' % threading.active_count())
 
 
+def process_aimsun_token(data):
+    """Process a control token received from Aimsun."""
+    global AIMSUN_FALLBACK_CONFIG
+
+    if handshake.parse_caps_packet(data) is not None:
+        # The extension announced its capabilities after the handshake had timed out and
+        # still waits for the final configuration; it gets the version 1 one in force
+        fallback_config = AIMSUN_FALLBACK_CONFIG
+        AIMSUN_FALLBACK_CONFIG = None
+        if fallback_config is None:
+            LOGGER.warning('unexpected capabilities from Aimsun ignored')
+            return
+        LOGGER.warning('capabilities of Aimsun arrived after the handshake timeout, sending version 1 configuration')
+        with AIMSUN_BULK_LOCK:
+            AIMSUN_PACKETCOMM.packet_send(fallback_config)
+        return
+    token, args = packet.parse_control(data)
+    if token == packet.PONG and AIMSUN_HEARTBEAT is not None:
+        AIMSUN_HEARTBEAT.pong_received(args)
+    else:
+        LOGGER.warning('unknown token %s from Aimsun ignored' % repr(str(data)))
+
+
+def aimsun_control_receiver(packetcomm):
+    """Receive tokens sent by Aimsun over the control channel."""
+    while True:
+        data = packetcomm.packet_receive()
+        if not data:
+            break
+        process_aimsun_token(data)
+    LOGGER.debug('Aimsun control channel closed, control receiver thread finished')
+
+
+def aimsun_heartbeat(heartbeat, interval):
+    """Periodically send @PING to Aimsun and report when the replies stop coming."""
+    was_alive = True
+    while AIMSUN_HEARTBEAT is heartbeat and AIMSUN_DATA_SOCKET is not None:
+        time.sleep(interval)
+        # noinspection PyBroadException
+        try:
+            if AIMSUN_CONTROL_PACKETCOMM is not None:
+                AIMSUN_CONTROL_PACKETCOMM.packet_send(heartbeat.make_ping())
+            elif AIMSUN_PACKETCOMM is not None:
+                send_to_aimsun(heartbeat.make_ping())
+        except:
+            LOGGER.exception('cannot send heartbeat to Aimsun, heartbeat thread finished')
+            break
+        is_alive = heartbeat.is_alive()
+        if was_alive and not is_alive:
+            print '!! Aimsun does not respond to heartbeat for %.1f seconds' % heartbeat.timeout
+            LOGGER.error('Aimsun does not respond to heartbeat for %.1f seconds' % heartbeat.timeout)
+        elif is_alive and not was_alive:
+            LOGGER.info('Aimsun responds to heartbeat again')
+        was_alive = is_alive
+
+
+def open_control_channel(framing):
+    """Accept the control connection of the Aimsun extension.
+
+    :return: True if the control channel has been established
+    """
+    global AIMSUN_CONTROL_SOCKET
+    global AIMSUN_CONTROL_PACKETCOMM
+
+    try:
+        AIMSUN_CONTROL_SOCKET, addr = AIMSUN_LISTEN_SOCKET.accept()
+        AIMSUN_CONTROL_SOCKET.settimeout(60)
+        packetcomm = packet.PacketCommunicator(AIMSUN_CONTROL_SOCKET, LOGGER_NAME + '.control', framing)
+        data = packetcomm.packet_receive()
+    except socket.timeout:
+        print '!! ERROR: Timeout when waiting for the Aimsun control channel'
+        return False
+    if data != packet.CONTROL_HELLO:
+        print '!! ERROR: Unexpected first packet %s on the Aimsun control channel' % repr(data)
+        return False
+    AIMSUN_CONTROL_SOCKET.settimeout(None)
+    # Control tokens are short and shall not wait for Nagle's algorithm
+    AIMSUN_CONTROL_SOCKET.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    AIMSUN_CONTROL_PACKETCOMM = packetcomm
+    linkstats.register('aimsun_control', AIMSUN_CONTROL_PACKETCOMM.get_stats)
+    print "   Control channel connected from", addr
+    return True
+
+
+def close_control_channel():
+    global AIMSUN_CONTROL_SOCKET
+    global AIMSUN_CONTROL_PACKETCOMM
+
+    if AIMSUN_CONTROL_SOCKET is not None:
+        AIMSUN_CONTROL_SOCKET.close()
+    AIMSUN_CONTROL_SOCKET = None
+    AIMSUN_CONTROL_PACKETCOMM = None
+    linkstats.unregister('aimsun_control')
+
+
+def send_to_aimsun(data):
+    """Send a packet to Aimsun over the bulk channel and return its sequence number."""
+    global AIMSUN_BULK_SEQ
+
+    with AIMSUN_BULK_LOCK:
+        AIMSUN_PACKETCOMM.packet_send(data)
+        AIMSUN_BULK_SEQ += 1
+        return AIMSUN_BULK_SEQ
+
+
+def unlock_aimsun():
+    """Let the synchronous Aimsun simulation continue with the next step."""
+    if AIMSUN_CONTROL_PACKETCOMM is not None:
+        # Aimsun applies all packets sent over the bulk channel so far before it unlocks
+        with AIMSUN_BULK_LOCK:
+            bulk_seq = AIMSUN_BULK_SEQ
+        AIMSUN_CONTROL_PACKETCOMM.packet_send(packet.make_unlock(bulk_seq))
+    else:
+        AIMSUN_PACKETCOMM.packet_send(packet.UNLOCK)
+
+
+def aimsun_preferences():
+    """Return the [aimsun] options of sirid_server.ini taking part in the capability negotiation."""
+    preferences = {}
+    for option, default in handshake.DEFAULT_PREFERENCES.items():
+        preferences[option] = get_config_option('aimsun', option, default)
+    return preferences
+
+
+def offer_capabilities(is_synchronous):
+    """Send the legacy configuration extended by the capabilities of the server, and return the
+    capabilities sent back by the extension, or an empty dictionary for legacy extensions.
+
+    :rtype : dict
+    """
+    global AIMSUN_FALLBACK_CONFIG
+
+    AIMSUN_FALLBACK_CONFIG = None
+    config = {'synchronous': is_synchronous, 'offer': handshake.capabilities()}
+    AIMSUN_PACKETCOMM.packet_send(pickle.dumps(config, pickle.HIGHEST_PROTOCOL))
+    # Wait for a complete packet only if something arrives in time, so that a timeout never
+    # interrupts a packet half-way
+    readable, unused, unused = select.select([AIMSUN_DATA_SOCKET], [], [], handshake.HANDSHAKE_TIMEOUT)
+    if not readable:
+        print "   No capabilities announced, using protocol version 1"
+        # A busy extension may still answer the offer and wait for the final configuration
+        AIMSUN_FALLBACK_CONFIG = pickle.dumps({'synchronous': is_synchronous}, pickle.HIGHEST_PROTOCOL)
+        return {}
+    data = AIMSUN_PACKETCOMM.packet_receive()
+    capabilities = handshake.parse_caps_packet(data)
+    if capabilities is None:
+        # A legacy extension has already sent its first measurements
+        AIMSUN_PENDING_PACKETS.append(data)
+        return {}
+    print "   Capabilities:", repr(capabilities)
+    return capabilities
+
+
 def start_aimsun(is_synchronous=False, replication_id=0):
     """Start Aimsun microsimulator.
 
@@ -262,6 +683,14 @@ def start_aimsun(is_synchronous=False, replication_id=0):
     global AIMSUN_DATA_SOCKET
     global AIMSUN_PACKETCOMM
     global AIMSUN_RECEIVER_THREAD
+    global AIMSUN_BATCH_COMMANDS
+    global AIMSUN_BULK_SEQ
+    global AIMSUN_HEARTBEAT
+    global AIMSUN_TIMED_BATCHES
+    global AIMSUN_BATCH_PARTS
+    global AIMSUN_MAX_BATCH_COMMANDS
+    global COMMAND_COALESCER
+    global MEASUREMENT_ARCHIVE
 
     # Connect to the windows registry and find out the location of Aimsun executable
     rh = wreg.ConnectRegistry(None, wreg.HKEY_LOCAL_MACHINE)
@@ -300,26 +729,98 @@ def start_aimsun(is_synchronous=False, replication_id=0):
         return False
     # Make the socket blocking
     AIMSUN_DATA_SOCKET.settimeout(None)
-    print "   Data:", data
+    print "   Data:", repr(data)
     # Check the command
     # @TODO: Move the command names to gantryinterface and import it here
-    if data == packet.AIMSUN_UP:
+    capabilities = packet.parse_hello(data)
+    if capabilities is not None:
         print "   Got the correct initial handshake, sending configuration"
-        config = {'synchronous': is_synchronous}
-        data = pickle.dumps(config, pickle.HIGHEST_PROTOCOL)
-        AIMSUN_PACKETCOMM.packet_send(data)
+        if not capabilities:
+            # Plain AIMSUN_UP, offer our capabilities. Legacy extensions do not answer.
+            capabilities = offer_capabilities(is_synchronous)
+        settings = handshake.negotiate(capabilities, aimsun_preferences())
+        framing = settings['framing']
+        transport = settings['transport']
+        compression = settings['compression']
+        if transport == shmring.TRANSPORT_SHM:
+            shm_path = get_config_option('aimsun', 'shm_path', shmring.default_path())
+            shm_lane_size = get_config_option('aimsun', 'shm_lane_size', shmring.DEFAULT_LANE_SIZE)
+            shm_packetcomm = shmring.ShmCommunicator(
+                shm_path, shmring.ROLE_SERVER, LOGGER_NAME, AIMSUN_DATA_SOCKET, shm_lane_size, create=True,
+                poll_interval=get_config_option('aimsun', 'shm_poll_interval', shmring.DEFAULT_POLL_INTERVAL))
+        if capabilities:
+            # Legacy Aimsun extensions announce no capabilities and keep the configuration
+            # sent with the offer. The configuration packet is always sent using the legacy
+            # framing.
+            config = {'synchronous': is_synchronous, 'protocol': settings['version'],
+                      'framing': framing, 'codec': settings['codec'], 'compression': compression,
+                      'max_batch_commands': settings['max_batch_commands']}
+            if settings['control_channel']:
+                config['control_channel'] = True
+            if settings['send_queue']:
+                config['send_queue'] = settings['send_queue']
+            if settings['heartbeat']:
+                config['heartbeat'] = settings['heartbeat']
+            if transport == shmring.TRANSPORT_SHM:
+                config['transport'] = {'method': transport, 'path': shm_path,
+                                       'poll_interval': shm_packetcomm.poll_interval}
+            AIMSUN_PACKETCOMM.packet_send(pickle.dumps(config, pickle.HIGHEST_PROTOCOL))
+        print "   Protocol version %d, %s framing and %s measurement codec for Aimsun communication" % \
+            (settings['version'], framing, settings['codec'])
+        AIMSUN_BULK_SEQ = 0
+        AIMSUN_PACKETCOMM.set_framing(framing)
+        AIMSUN_PACKETCOMM.set_compression(compression['method'], compression['level'], compression['threshold'])
+        print "   Compression of Aimsun packets: %s" % compression['method']
+        if transport == shmring.TRANSPORT_SHM:
+            # From now on the TCP connection only tells us whether Aimsun is still alive
+            AIMSUN_PACKETCOMM = shm_packetcomm
+            print "   Exchanging packets with Aimsun through shared file `%s`" % shm_path
+        linkstats.register('aimsun_link', AIMSUN_PACKETCOMM.get_stats)
+        # Extensions that understand command batches get all commands of a controller message
+        # in a single packet
+        AIMSUN_BATCH_COMMANDS = settings['batch']
+        AIMSUN_MAX_BATCH_COMMANDS = settings['max_batch_commands']
+        print "   Command batches %s" % ('enabled' if AIMSUN_BATCH_COMMANDS else 'disabled')
+        # Time-stamped batches let Aimsun measure the latency of commands
+        AIMSUN_TIMED_BATCHES = settings['batch_version'] >= packet.BATCH_VERSION_TIMED
+        # A message split into several batches is applied in a single simulation step only if
+        # Aimsun knows which batches belong together
+        AIMSUN_BATCH_PARTS = settings['batch_version'] >= packet.BATCH_VERSION_PARTS
+        coalesce_window = get_config_option('aimsun', 'coalesce_window', 0.0)
+        if coalesce_window > 0:
+            COMMAND_COALESCER = coalescer.CommandCoalescer(coalesce_window, forward_commands, LOGGER)
+            linkstats.register('aimsun_coalescing', COMMAND_COALESCER.get_stats)
+            print "   Commands coalesced over %.3f seconds" % coalesce_window
+        if settings['control_channel']:
+            if not open_control_channel(framing):
+                return False
+            threading.Thread(target=aimsun_control_receiver, args=(AIMSUN_CONTROL_PACKETCOMM,)).start()
+        archive_directory = get_config_option('archive', 'directory', '')
+        if archive_directory:
+            MEASUREMENT_ARCHIVE = archive.ArchiveWriter(archive_directory, replication_id, LOGGER)
+            linkstats.register('archive', MEASUREMENT_ARCHIVE.get_stats)
+            print "   Measurements archived in `%s`" % archive_directory
         # Start receiver thread
         AIMSUN_RECEIVER_THREAD = threading.Thread(target=aimsun_receiver)
         AIMSUN_RECEIVER_THREAD.start()
         print '   Started receiver thread'
+        if settings['heartbeat']:
+            AIMSUN_HEARTBEAT = packet.Heartbeat(
+                get_config_option('aimsun', 'heartbeat_timeout', packet.DEFAULT_HEARTBEAT_TIMEOUT))
+            linkstats.register('aimsun_heartbeat', AIMSUN_HEARTBEAT.get_stats)
+            heartbeat_thread = threading.Thread(target=aimsun_heartbeat,
+                                                args=(AIMSUN_HEARTBEAT, settings['heartbeat']))
+            heartbeat_thread.setDaemon(True)
+            heartbeat_thread.start()
+            print '   Started heartbeat thread, interval %.1f seconds' % settings['heartbeat']
+        else:
+            AIMSUN_HEARTBEAT = None
         # Report back to the sender
         if is_synchronous:
             print '-- sending SIMULATION_READY to the client(s)'
-            for thread_name in RECEIVER_WFILES:
-                wfile = RECEIVER_WFILES[thread_name]
-                wfile.write(SIMULATION_READY)
-                wfile.flush()
-                print '   sent to %s XML %s' % (thread_name, SIMULATION_READY)
+            for thread_name in RECEIVER_QUEUES.keys():
+                if send_to_receiver(thread_name, SIMULATION_READY):
+                    print '   sent to %s XML %s' % (thread_name, SIMULATION_READY)
         return True
 
 
@@ -328,71 +829,268 @@ def process_command(root, is_synchronous):
     :param root: Et.Element
     """
 
-    is_missing_symbol = False
-
-    for gantry_node in root:
-        if gantry_node.tag != "gantry":
-            raise ValueError('Expected <gantry> tag, got <%s>' % gantry_node.tag)
-        id_gantry_server = gantry_node.attrib['id']
-        for device_node in gantry_node:
-            if device_node.tag != 'device':
-                raise ValueError('Expected <device> tag, got <%s>' % device_node.tag)
-            id_device = int(device_node.attrib['id'])
-            for sub_device_node in device_node:
-                if sub_device_node.tag != 'subdevice':
-                    raise ValueError('Expected <subdevice> tag, got <%s>' % sub_device_node.tag)
-                id_sub_device = int(sub_device_node.attrib['id'])
-                if len(sub_device_node) != 1:
-                    raise ValueError('Node <subdevice> has more than one child node')
-                # Sub-device node contains only a single child node. This node should be a
-                # command node
-                command_node = sub_device_node[0]
-                if command_node.tag == 'command':
-                    validity = int(command_node.attrib['validity'])
-                    if len(command_node) > 2:
-                        node_list = []
-                        for tnode in command_node:
-                            node_list.append(tnode.tag)
-                        raise ValueError('Node <command> has more than two child nodes: ' + repr(node_list))
-                    symbol_node = command_node.find("symbol")
-                    addsymbol_node = command_node.find("addsymbol")
-
-                    # Existing nodes evaluate to false
-                    if addsymbol_node is not None:
-                        print "WARNING: Don't know how to handle <addsymbol>"
-
-                    if symbol_node is not None:
-                        id_message = int(symbol_node.text)
-                        command = (id_gantry_server, (id_device, id_sub_device, id_message, validity))
-                        print "Sending command `%s` to Aimsun ..." % repr(command)
-                        # TODO: This is repeated in gantryinterface.py as well
-                        data = pickle.dumps(command, pickle.HIGHEST_PROTOCOL)
-                        AIMSUN_PACKETCOMM.packet_send(data)
-                    else:
-                        print "ERROR: No <symbol> node for %s/%s/%s" % (id_gantry_server, id_device, id_sub_device)
-                        print repr(symbol_node)
-                        print Et.tostring(command_node)
-                        is_missing_symbol = True
-                else:
-                    raise ValueError('Expected <command> tag, got <%s>' % command_node.tag)
-
-    if is_missing_symbol:
-        LOGGER.error("missing <symbol> node:\n" + Et.tostring(root, 'UTF-8'))
+    start = time.time()
+    # Command stanzas are usually decoded from their strings already (`process_xml_string()`)
+    batch = gantry_command.command_batch(root)
+    if batch.addsymbols():
+        print "WARNING: Don't know how to handle <addsymbol> (%d commands)" % batch.addsymbols()
+    if batch.errors:
+        LOGGER.error("missing <symbol> node for " + ', '.join(batch.errors))
+    route_commands(batch.commands(), is_synchronous, start)
+
+
+def process_command_in_pool(xml_string, thread_name):
+    """Let a worker process of COMMAND_POOL parse and validate a command stanza and route the
+    resulting command tuples to Aimsun. The connection waits for the result, which keeps the
+    commands of a controller in order."""
+
+    start = time.time()
+    result = COMMAND_POOL.apply(gantry_command.parse_command_stanza, (xml_string,))
+    if result is None:
+        print "** parse error in the command stanza from %s" % thread_name
+        return
+    commands, errors = result
+    if errors:
+        LOGGER.error("missing <symbol> node:\n" + xml_string)
+    # Aimsun is already running, the connection is asynchronous (see `process_xml_root()`)
+    route_commands(commands, False, start)
+
+
+def route_commands(commands, is_synchronous, start):
+    """Send the validated command tuples to Aimsun, `start` is the time the processing of
+    the command stanza started. With COMMAND_COALESCER the commands wait in the coalescing
+    window; a synchronous simulation gets them before it continues with the next step."""
+
+    if COMMAND_COALESCER is not None:
+        try:
+            COMMAND_COALESCER.add(commands, start)
+        except ValueError as e:
+            LOGGER.error('command batch rejected: %s' % e)
+        if is_synchronous:
+            COMMAND_COALESCER.flush()
+    elif commands:
+        forward_commands(commands, [start])
 
     if is_synchronous:
         print "Unlocking Aimsun threads ..."
-        AIMSUN_DATA_SOCKET.sendall('00007@UNLOCK')
+        unlock_aimsun()
+
+
+def forward_commands(commands, start_times):
+    """Send command tuples to Aimsun, `start_times` are the times the processing of the
+    command stanzas they come from started."""
+
+    # Commands are forwarded only after the whole message has been validated, so that Aimsun
+    # never receives a part of a malformed message
+    if AIMSUN_BATCH_COMMANDS:
+        print "Sending batch of %d commands to Aimsun ..." % len(commands)
+        # Messages with more commands than Aimsun accepts in a batch are split
+        if len(commands) > AIMSUN_MAX_BATCH_COMMANDS and not AIMSUN_BATCH_PARTS:
+            LOGGER.warning('message of %d commands split into batches of %d, Aimsun may apply them '
+                           'in different simulation steps' % (len(commands), AIMSUN_MAX_BATCH_COMMANDS))
+        with AIMSUN_BATCH_LOCK:
+            for pos in xrange(0, len(commands), AIMSUN_MAX_BATCH_COMMANDS):
+                sent_time = None
+                more = None
+                if AIMSUN_TIMED_BATCHES:
+                    sent_time = time.time()
+                if AIMSUN_BATCH_PARTS:
+                    more = pos + AIMSUN_MAX_BATCH_COMMANDS < len(commands)
+                send_to_aimsun(packet.encode_command_batch(commands[pos:pos + AIMSUN_MAX_BATCH_COMMANDS],
+                                                           sent_time, more))
+    else:
+        for command in commands:
+            print "Sending command `%s` to Aimsun ..." % repr(command)
+            # TODO: This is repeated in gantryinterface.py as well
+            data = pickle.dumps(command, pickle.HIGHEST_PROTOCOL)
+            send_to_aimsun(data)
+    now = time.time()
+    for start in start_times:
+        COMMAND_DELAY.add(now - start)
 
 
-def process_get_long_status(thread_name):
+def process_get_long_status(root, thread_name):
     """Process a XML command GET_LONG_STATUS sent from the controller
+
+    The controller may opt in for compressed documents by adding a `<compression>zlib</compression>`
+    element, optionally with a `level` attribute. Compressed documents are sent as
+    `<root msg="compressed" encoding="zlib+base64" size="...">...</root>` where the text is the
+    base64 encoded zlib stream of the original document and `size` is its length in bytes.
+    `<compression>none</compression>` switches the compression off again.
+
+    A controller that sends `<seq_nr>N</seq_nr>`, the sequence number of the last document it
+    has got, receives `<root msg="not_modified" seq_nr="N"/>` if there is no newer document,
+    otherwise the documents newer than N that are still in STATUS_CACHE (or just the newest
+    one).
+
+    `<delta>true</delta>`, optionally with a `keyframe_interval` attribute, switches the
+    controller to delta documents, `<delta>false</delta>` back to full documents, see
+    `delta_status`. In delta mode the request acknowledges document N; a request without
+    <seq_nr> is answered with a full document.
     """
 
     print "-- get_long_status requested by thread %s/%s" % (thread_name, RECEIVER_ADDRESS[thread_name])
-    send_last_measurements([thread_name])
+    compression = root.find('compression')
+    if compression is not None:
+        options = RECEIVER_OPTIONS.setdefault(thread_name, {})
+        method = (compression.text or '').strip()
+        if method == packet.COMPRESSION_ZLIB:
+            try:
+                level = int(compression.attrib.get(
+                    'level', get_config_option('controllers', 'compression_level', packet.DEFAULT_COMPRESSION_LEVEL)))
+            except ValueError:
+                print '!! Unknown compression level %s ignored' % repr(compression.attrib['level'])
+                level = packet.DEFAULT_COMPRESSION_LEVEL
+            options['compression_level'] = min(max(level, 1), 9)
+            print '   compression level %d requested' % options['compression_level']
+        elif method == packet.COMPRESSION_NONE:
+            options.pop('compression_level', None)
+        else:
+            print '!! Unknown compression method %s ignored' % repr(method)
+    delta = root.find('delta')
+    if delta is not None:
+        options = RECEIVER_OPTIONS.setdefault(thread_name, {})
+        mode = (delta.text or '').strip()
+        if mode == 'true':
+            keyframe_interval = get_config_option('controllers', 'delta_keyframe_interval',
+                                                  delta_status.DEFAULT_KEYFRAME_INTERVAL)
+            try:
+                keyframe_interval = int(delta.attrib.get('keyframe_interval', keyframe_interval))
+            except ValueError:
+                print '!! Unknown keyframe interval %s ignored' % repr(delta.attrib['keyframe_interval'])
+            options['delta'] = delta_status.DeltaState(max(keyframe_interval, 0))
+            print '   delta documents requested, keyframe every %d documents' % options['delta'].keyframe_interval
+        elif mode == 'false':
+            options.pop('delta', None)
+        else:
+            print '!! Unknown delta mode %s ignored' % repr(mode)
+    seq_nr = None
+    seq_nr_node = root.find('seq_nr')
+    if seq_nr_node is not None:
+        try:
+            seq_nr = int(seq_nr_node.text)
+        except (TypeError, ValueError):
+            print '!! Unknown text in <seq_nr> tag ignored (%s)' % seq_nr_node.text
+    delta = RECEIVER_OPTIONS.get(thread_name, {}).get('delta')
+    if delta is not None:
+        if seq_nr is None:
+            delta.resync()
+        else:
+            delta.acknowledge(seq_nr)
+    send_status(thread_name, seq_nr)
     print "   get_long_status finished for thread %s/%s" % (thread_name, RECEIVER_ADDRESS[thread_name])
 
 
+def send_status(thread_name, seq_nr=None):
+    """Reply to get_long_status of the controller connection `thread_name` from STATUS_CACHE.
+    The reply does not take RECEIVER_LOCK and reuses the encoded variants of the documents."""
+    if seq_nr is None:
+        entries = [STATUS_CACHE.latest()]
+    else:
+        entries = STATUS_CACHE.newer_than(seq_nr)
+        if not entries:
+            print '   document %d not modified' % seq_nr
+            RECEIVER_COUNTERS.add('status_not_modified')
+            send_to_receiver(thread_name, status_cache.not_modified(seq_nr))
+            return
+    for entry in entries:
+        if not entry[1]:
+            print '-- no last measurements are available, ignoring this request'
+            continue
+        data = document_for_receiver(entry, thread_name)
+        if not send_to_receiver(thread_name, data, frame=True):
+            break
+        RECEIVER_COUNTERS.add('status_documents')
+
+
+def process_ack(root, thread_name):
+    """Process a XML command ACK sent from the controller, `<gantry msg="ack"><seq_nr>N</seq_nr></gantry>`
+    acknowledging document N to the delta mode, see `delta_status`. There is no reply."""
+
+    delta = RECEIVER_OPTIONS.get(thread_name, {}).get('delta')
+    try:
+        seq_nr = int(root.find('seq_nr').text)
+    except (AttributeError, TypeError, ValueError):
+        print '!! Invalid acknowledgement from %s/%s ignored' % (thread_name, RECEIVER_ADDRESS.get(thread_name))
+        return
+    if delta is None:
+        LOGGER.debug('acknowledgement of %d from %s outside of delta mode ignored' % (seq_nr, thread_name))
+        return
+    delta.acknowledge(seq_nr)
+
+
+def process_subscribe(root, thread_name):
+    """Process a XML command SUBSCRIBE sent from the controller, see `subscription`. The
+    controller gets `<root msg="subscribed" gantry_servers="..." devices="..." categories="..."/>`
+    listing its new subscription, or `<root msg="subscription_error">` with the reason."""
+
+    print "-- subscription of thread %s/%s" % (thread_name, RECEIVER_ADDRESS[thread_name])
+    try:
+        sub = subscription.parse_subscription(root)
+    except ValueError as e:
+        print '!! Invalid subscription ignored: %s' % e
+        envelope = Et.Element('root', attrib={'msg': 'subscription_error'})
+        envelope.text = str(e)
+        send_to_receiver(thread_name, '<?xml version="1.0" encoding="UTF-8" ?>' + Et.tostring(envelope))
+        return
+    options = RECEIVER_OPTIONS.setdefault(thread_name, {})
+    if sub.is_everything():
+        options.pop('subscription', None)
+    else:
+        options['subscription'] = sub
+    print '   subscribed to %s' % repr(sub)
+    envelope = Et.Element('root', attrib={'msg': 'subscribed',
+                                          'gantry_servers': ' '.join(sub.gantry_servers),
+                                          'devices': ' '.join(sub.devices),
+                                          'categories': ' '.join(sub.categories)})
+    send_to_receiver(thread_name, '<?xml version="1.0" encoding="UTF-8" ?>' + Et.tostring(envelope))
+
+
+def process_get_history(root, thread_name):
+    """Process a XML command GET_HISTORY sent from the controller, see `history`. The
+    controller gets `<root msg="history">` with the selected measurements, or
+    `<root msg="history_error">` with the reason."""
+
+    print "-- get_history requested by thread %s/%s" % (thread_name, RECEIVER_ADDRESS[thread_name])
+    try:
+        query = history.parse_history_request(root)
+    except ValueError as e:
+        print '!! Invalid history request ignored: %s' % e
+        envelope = Et.Element('root', attrib={'msg': 'history_error'})
+        envelope.text = str(e)
+        send_to_receiver(thread_name, '<?xml version="1.0" encoding="UTF-8" ?>' + Et.tostring(envelope))
+        return
+    send_to_receiver(thread_name, HISTORY.query(query))
+
+
+def has_subscriptions():
+    """Return True if any controller connection has a subscription."""
+    for options in RECEIVER_OPTIONS.values():
+        if 'subscription' in options:
+            return True
+    return False
+
+
+def process_get_stats(thread_name):
+    """Process a XML command GET_STATS sent from the controller. The reply lists the counters
+    of all registered statistics providers:
+
+    <root msg="stats"><stats name="aimsun_link"><value name="packets_sent">12</value>...</stats>...</root>
+    """
+
+    print "-- get_stats requested by thread %s/%s" % (thread_name, RECEIVER_ADDRESS[thread_name])
+    envelope = Et.Element('root', attrib={'msg': 'stats'})
+    stats = linkstats.snapshot()
+    for name in sorted(stats):
+        stats_node = Et.SubElement(envelope, 'stats', attrib={'name': name})
+        values = stats[name]
+        for value_name in sorted(values):
+            value_node = Et.SubElement(stats_node, 'value', attrib={'name': value_name})
+            value_node.text = str(values[value_name])
+    xml_string = '<?xml version="1.0" encoding="UTF-8" ?>' + Et.tostring(envelope)
+    send_to_receiver(thread_name, xml_string)
+
+
 def process_xml_message(root, is_synchronous, thread_name):
     """Process a XML command batch sent from the controller
     :param root: Et.Element
@@ -418,7 +1116,19 @@ def process_xml_message(root, is_synchronous, thread_name):
         if 'msg' in root.attrib:
             msg_type = root.attrib['msg']
             if msg_type == 'get_long_status':
-                process_get_long_status(thread_name)
+                process_get_long_status(root, thread_name)
+                log_message = False
+            elif msg_type == 'get_stats':
+                process_get_stats(thread_name)
+                log_message = False
+            elif msg_type == 'subscribe':
+                process_subscribe(root, thread_name)
+                log_message = False
+            elif msg_type == 'ack':
+                process_ack(root, thread_name)
+                log_message = False
+            elif msg_type == 'get_history':
+                process_get_history(root, thread_name)
                 log_message = False
             else:
                 LOGGER.error("Unsupported tag <gantry msg='%s'>" % msg_type)
@@ -432,6 +1142,120 @@ def process_xml_message(root, is_synchronous, thread_name):
         # raise TypeError('Unsupported message type')
 
 
+def process_xml_string(xml_string, thread_name):
+    """Try to parse the string that the receiver identified as a single XML stanza."""
+
+    # Now we have something that looks like a valid XML command stanza for a gantry server
+    print '--------------------'
+    print "XML STRING:"
+    print xml_string
+    print '--------------------'
+
+    if COMMAND_POOL is not None and AIMSUN_RUNNING and gantry_command.is_command_stanza(xml_string):
+        process_command_in_pool(xml_string, thread_name)
+        return
+
+    try:
+        if gantry_command.is_command_stanza(xml_string):
+            # Command stanzas are decoded without building their element trees
+            root = gantry_command.decode_command_stanza(xml_string)
+        else:
+            root = Et.fromstring(xml_string)
+        print "   %s: the XML string has been parsed successfully" % thread_name
+    except (ExpatError, SyntaxError) as e:
+        # Python 2.7 raises ParseError, a subclass of SyntaxError
+        # Mention parsing error and continue to process another line of input
+        print "** parse error:", repr(e)
+        print "   %s returning immediately" % thread_name
+        return
+    except:
+        print '   unexpected error:', sys.exc_info()[0]
+        print '-- handler %s for connection %s raising exception' % (thread_name, RECEIVER_ADDRESS.get(thread_name))
+        raise
+
+    process_xml_root(root, thread_name)
+
+
+def process_xml_root(root, thread_name):
+    """Process a parsed XML stanza."""
+
+    # Global flag indicating that we have a running instance of the microsimulator
+    global AIMSUN_RUNNING
+
+    # Initially we assume asynchronous mode when Aimsun does not wait for the control
+    is_synchronous = False
+
+    # Only one thread is allowed to start Aimsun, other threads wait until the lock has been
+    # released.
+    with AIMSUN_STARTUP_LOCK:
+        # Check if Aimsun is already running, if not, start it.
+        if not AIMSUN_RUNNING:
+            # Check that the message is of type get_long_status. In that case it may contain
+            # - a child element that requests our communication with the client to be synchronous,
+            # - replication id to start
+            replication_id = 0
+            if root.tag == 'gantry' and root.attrib['msg'] == 'get_long_status':
+                synchronous = root.find('synchronous')
+                if synchronous is not None:
+                    # TODO: Check if self.is_synchronous is necessary. Local variable should suffice.
+                    is_synchronous = (synchronous.text.strip() == 'true')
+                    if is_synchronous:
+                        print '** Synchronous operational mode requested'
+                    else:
+                        print '!! Unknown text in <synchronous> tag ignored, assuming async mode'
+                replication = root.find('replication')
+                if replication is not None:
+                    try:
+                        replication_id = int(replication.text)
+                        print '** Got replication id %s' % replication_id
+                    except ValueError:
+                        print '!! Unknown text in <replication> tag ignored (%s)' % replication.text
+            # Start Aimsun
+            if start_aimsun(is_synchronous, replication_id):
+                AIMSUN_RUNNING = True
+                print "** Aimsun is up and running"
+            else:
+                print "!! warning: cannot start Aimsun"
+                return
+                # raise OSError("Cannot start Aimsun microsimulator")
+
+    # Convert the XML command tree to a less verbose sequence of command objects for Aimsun.
+    # We have a problem handling long XML messages directly in an AAPI extension due to GIL
+    # (global interpreter lock) - the command is being parsed over several microsimulation
+    # steps.
+    process_xml_message(root, is_synchronous, thread_name)
+
+
+def make_stanza_framer():
+    """Return a new framer for a controller connection. When the command stanzas are parsed
+    by COMMAND_POOL, the framer does not build element trees; otherwise it builds them for
+    all stanzas but the command ones, which `process_xml_string()` decodes."""
+    return xml_framer.make_framer(get_config_option('local', 'xml_framer', xml_framer.FRAMER_STREAMING),
+                                  MAX_XML_SIZE, build_tree=COMMAND_POOL is None,
+                                  decode_commands=COMMAND_POOL is None)
+
+
+def process_framed_data(framer, data, num_errors, thread_name):
+    """Feed data read from the controller connection `thread_name` to its framer and process
+    the completed stanzas. Returns the number of framer errors reported so far."""
+    for root, xml_string in framer.feed(data):
+        if root is None:
+            process_xml_string(xml_string, thread_name)
+        else:
+            print '--------------------'
+            print "XML STRING:"
+            print xml_string
+            print '--------------------'
+            process_xml_root(root, thread_name)
+    # Report stanzas that the streaming framer could not parse
+    while num_errors < len(framer.errors):
+        message, xml_string = framer.errors[num_errors]
+        print "** parse error:", message
+        LOGGER.error('%s: XML parse error %s in:\n%s' % (thread_name, message, xml_string))
+        num_errors += 1
+    return num_errors
+
+
 class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     pass
 
@@ -448,6 +1272,11 @@ class GantryRequest(SocketServer.StreamRequestHandler):
     to connect at a time.
     """
 
+    def setup(self):
+        # Replies are written as whole documents, do not let Nagle hold back their tails
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        SocketServer.StreamRequestHandler.setup(self)
+
     def handle(self):
 
         # Global file-like object that writes to the connection to the client
@@ -456,33 +1285,28 @@ class GantryRequest(SocketServer.StreamRequestHandler):
         current_thread = threading.current_thread()
         thread_name = current_thread.name
 
-        # Make the information about the outbound connection global. This way also the Aimsun
-        # sender thread will be able to write data to all clients
-        RECEIVER_WFILES[thread_name] = self.wfile
+        # Make the outbound queue of the connection global. This way also the Aimsun receiver
+        # thread will be able to send data to all clients; the writer thread empties the queue
+        # into the connection
+        self.queue = make_receiver_queue(thread_name)
+        self.queue.on_overrun = self.abort
+        self.writer = outbound.QueueWriter(self.queue, self.wfile, LOGGER, on_error=self.abort)
+        self.writer.start()
+        self.thread_name = thread_name
+        RECEIVER_QUEUES[thread_name] = self.queue
         RECEIVER_ADDRESS[thread_name] = str(self.client_address)
+        watch_connection(self.request, thread_name, self.queue, self.abort)
 
         print "-- handler %s started for connection from %s" % (thread_name, str(self.client_address))
 
-        # Current unprocessed data read from the request
-        data = ''
-
-        # No root tag has been found
-        no_root_tag = True
-        start_pos = 0
-        close_pos = 0
-        tag_name = None
-        closing_tag = None
-        look_for_eet = True
-
-        empty_count = 0
+        # The framer splits the stream into XML stanzas; the streaming framer parses them
+        # while they arrive
+        framer = make_stanza_framer()
+        num_errors = 0
 
         # Infinite loop serving the requests from the SIRID hub.
         while True:
 
-            # Sanity check: limit the buffer size
-            if len(data) > MAX_XML_SIZE:
-                data = ''
-
             # Read data from the connection, maximum BUFFER_SIZE bytes
             try:
                 buff = self.request.recv(BUFFER_SIZE)
@@ -494,133 +1318,14 @@ class GantryRequest(SocketServer.StreamRequestHandler):
                 break
 
             if not buff:
-                # No data from the connection means the connection has been closed
-                print "   -- #%04d, empty buff [%s] after recv(), probable closed connection for %s/%s" % (
-                    empty_count, repr(buff), thread_name, str(self.client_address))
-                empty_count += 1
-                if empty_count >= 1000:
-                    print "      too many empty buffers, quitting"
-                    break
-                else:
-                    time.sleep(1)
-                    continue
+                # A blocking recv() returns no data only at the end of file: the controller
+                # has closed the connection, or it has been aborted
+                print "   -- end of file after recv(), connection closed for %s/%s" % (
+                    thread_name, str(self.client_address))
+                break
 
-            empty_count = 0
-
-            # Append the buffer to the existing data
-            data += buff
-
-            # This flag is set to False in case that we need to read another part of
-            # the incoming message
-            do_process_data = True
-
-            # Loop over the contents of `data`
-            while do_process_data:
-
-                # Loop over the contents of `data` until an opening tag has been found or until the
-                # buffer is exhausted and we shall read in the next part of the incoming message
-                while no_root_tag:
-                    # Find the first opening tag
-                    open_pos = data.find('<', start_pos)
-                    # Negative position signals that the string was not found. In such a care
-                    # we will continue reading, which means first breaking out of the `no_root_tag`
-                    # loop.
-                    if open_pos == -1:
-                        break
-                    # We have the opening tag. What follows is according to the XML specification
-                    # either '?xml ... >' or in case that the header is not present, the root element
-                    # of the XML stanza.
-                    # We need to isolate the whole element first
-                    close_pos = data.find('>', open_pos)
-                    if close_pos == -1:
-                        # No closing mark yet, we will continue reading, which means first breaking
-                        # out of the `no_root_tag` loop.
-                        break
-                    # We have isolated the opening element. The element tag name is either in the
-                    # format of <root> or <root attr="val">. The suggested logic is therefore:
-                    # look for the space, if found, the tag name is delimited by the space, otherwise
-                    # it is limited by the closing mark
-                    sp_pos = data.find(' ', open_pos)
-                    if 0 <= sp_pos < close_pos:
-                        # Tag format <root attr="val">
-                        tag_name = data[open_pos + 1:sp_pos]
-                    else:
-                        # Tag format <root>
-                        tag_name = data[open_pos + 1:close_pos]
-                    if tag_name[0].isalpha():
-                        # We have a root tag
-                        print '   got root tag <%s>' % tag_name
-                        no_root_tag = False
-                    # In any case the further search will start after the closing tag of the identified
-                    # element
-                    start_pos = close_pos
-
-                # End of the loop. In case that there is no opening tag, `no_root_tag` is still
-                # True. In such a case we will interrupt the loop processing and continue to
-                # reading the next part of the input message
-                if no_root_tag:
-                    # Do not search the already searched part of the buffer again
-                    if open_pos == -1:
-                        start_pos = len(data)
-                    else:
-                        start_pos = open_pos
-                    # Signal the need to read another portion of the incoming message
-                    do_process_data = False
-                    continue
-                # Now we continue looking for the closing counterpart of the opening tag. We will
-                # start right after the closing > of the current tag, but before doing so we have
-                # to verify that the root tag is not of the "empty-element" form <root ... />
-                # The test for empty-element tag shall occur only in the first round of testing
-                # right after the opening part of the tag has been identified.
-                if look_for_eet:
-                    if data[close_pos - 1] == '/':
-                        # Empty-element tag
-                        self.process_xml_string(data[open_pos:close_pos + 1])
-                        # Discard the processed part of the buffer
-                        data = data[close_pos + 1:]
-                        # And we go back to `no_root_tag`
-                        no_root_tag = True
-                        start_pos = 0
-                        # But there might still be a payload in `data` which has not been processed,
-                        # so `do_process_data` shall remain set to True
-                        continue
-                    else:
-                        # Define what the closing tag tag is
-                        closing_tag = '</' + tag_name + '>'
-                        # Remember its length
-                        closing_tag_len = len(closing_tag)
-                        # Do not look consider empty-element tags until the next root element candidate
-                        look_for_eet = False
-
-                close_pos = data.find(closing_tag, close_pos)
-                # It is not guaranteed that the current contents of `data` contains also the
-                # closing tag
-                if close_pos == -1:
-                    # No closing tag found yet, read further on.
-                    # We have to account for the possibility that a part of the closing tag has
-                    # been already read (the text ends for example with '...</roo') so the
-                    # position from which we continue the search is not the end of current
-                    # `data` string, but it is offset by the length of the closing tag
-                    close_pos = len(data) - closing_tag_len
-                    if close_pos < 0:
-                        close_pos = 0
-                    # Signal the need to read another portion of the incoming message
-                    do_process_data = False
-                else:
-                    # We have a closing tag
-                    end_pos = close_pos + closing_tag_len
-                    self.process_xml_string(data[open_pos:end_pos])
-                    # Discard the part of `data` that corresponds to the XML message
-                    data = data[end_pos:]
-                    # Reset the state of the XML pre-parser: we have no root tag and the search
-                    # start from the beginning of `data`
-                    no_root_tag = True
-                    start_pos = 0
-                    look_for_eet = True
-                    # The `data` string may still contain a part of the next XML message (or even
-                    # a full one) and `do_process_data` shall therefore still remain set to True
-
-                    # End of the inner part of the `do_process_data loop
+            REAPER.received(thread_name)
+            num_errors = process_framed_data(framer, buff, num_errors, thread_name)
 
         # End of the receiver loop
         print "-- handler %s/%s returning" % (thread_name, str(self.client_address))
@@ -631,6 +1336,10 @@ class GantryRequest(SocketServer.StreamRequestHandler):
         thread_name = current_thread.name
 
         print "-- closing %s connection from %s" % (thread_name, str(self.client_address))
+        # Let the writer send what has been queued so far
+        forget_receiver(thread_name)
+        self.queue.close()
+        self.writer.join(WRITER_JOIN_TIMEOUT)
         # Force close the request socket
         SocketServer.StreamRequestHandler.finish(self)
         # Force close the request socket
@@ -642,79 +1351,54 @@ class GantryRequest(SocketServer.StreamRequestHandler):
             print "   -- socket.error in finish() for %s/%s (errno=%d, `%s`) when exiting request handler" % \
                   (thread_name, self.client_address, e.errno, e.strerror)
 
-        # Delete the entry in RECEIVER_WFILES
-        RECEIVER_WFILES.pop(thread_name, None)
+        RECEIVER_OPTIONS.pop(thread_name, None)
+        REAPER.unregister(thread_name)
 
-    def process_xml_string(self, xml_string):
-        """Try to parse the string that the receiver identified as a single XML stanza."""
+    def abort(self):
+        """Shut the connection down after its writer has failed, fallen too far behind or
+        the reaper gave up on it. The request handler then finds the connection closed."""
+        forget_receiver(self.thread_name)
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
 
-        # Global flag indicating that we have a running instance of the microsimulator
-        global AIMSUN_RUNNING
 
-        current_thread = threading.current_thread()
-        thread_name = current_thread.name
+class GantryConnection(object):
+    """Handler of a controller connection served by the event-loop server.
 
-        # Initially we assume asynchronous mode when Aimsun does not wait for the control
-        is_synchronous = False
-
-        # Now we have something that looks like a valid XML command stanza for a gantry server
-        print '--------------------'
-        print "XML STRING:"
-        print xml_string
-        print '--------------------'
+    It provides the semantics of GantryRequest without a thread of its own: the name of the
+    connection takes the role of the thread name in RECEIVER_QUEUES and the outbound queue of
+    the connection, emptied by the event loop, replaces the writer thread.
+    """
 
-        try:
-            root = Et.fromstring(xml_string)
-            print "   %s: the XML string has been parsed successfully" % thread_name
-        except ExpatError as e:
-            # Mention parsing error and continue to process another line of input
-            print "** parse error:", repr(e)
-            print "   %s returning immediately" % thread_name
-            return
-        except:
-            print '   unexpected error:', sys.exc_info()[0]
-            print '-- handler %s for connection %s raising exception' % (thread_name, str(self.client_address))
-            raise
-
-        # Only one thread is allowed to start Aimsun, other threads wait until the lock has been
-        # released.
-        with AIMSUN_STARTUP_LOCK:
-            # Check if Aimsun is already running, if not, start it.
-            if not AIMSUN_RUNNING:
-                # Check that the message is of type get_long_status. In that case it may contain
-                # - a child element that requests our communication with the client to be synchronous,
-                # - replication id to start
-                replication_id = 0
-                if root.tag == 'gantry' and root.attrib['msg'] == 'get_long_status':
-                    synchronous = root.find('synchronous')
-                    if synchronous is not None:
-                        # TODO: Check if self.is_synchronous is necessary. Local variable should suffice.
-                        is_synchronous = (synchronous.text.strip() == 'true')
-                        if is_synchronous:
-                            print '** Synchronous operational mode requested'
-                        else:
-                            print '!! Unknown text in <synchronous> tag ignored, assuming async mode'
-                    replication = root.find('replication')
-                    if replication is not None:
-                        try:
-                            replication_id = int(replication.text)
-                            print '** Got replication id %s' % replication_id
-                        except ValueError:
-                            print '!! Unknown text in <replication> tag ignored (%s)' % replication.text
-                # Start Aimsun
-                if start_aimsun(is_synchronous, replication_id):
-                    AIMSUN_RUNNING = True
-                    print "** Aimsun is up and running"
-                else:
-                    print "!! warning: cannot start Aimsun"
-                    return
-                    # raise OSError("Cannot start Aimsun microsimulator")
-
-        # Convert the XML command tree to a less verbose sequence of command objects for Aimsun.
-        # We have a problem handling long XML messages directly in an AAPI extension due to GIL
-        # (global interpreter lock) - the command is being parsed over several microsimulation
-        # steps.
-        process_xml_message(root, is_synchronous, thread_name)
+    def __init__(self, connection):
+        """
+        :type connection: event_server.Connection
+        """
+        self.connection = connection
+        self.name = connection.name
+        self.framer = make_stanza_framer()
+        self.num_errors = 0
+        configure_receiver_queue(connection.queue)
+        RECEIVER_QUEUES[self.name] = connection.queue
+        RECEIVER_ADDRESS[self.name] = str(connection.address)
+        watch_connection(connection.socket, self.name, connection.queue, self.abort)
+        print "-- connection %s opened from %s" % (self.name, str(connection.address))
+
+    def data_received(self, data):
+        REAPER.received(self.name)
+        self.num_errors = process_framed_data(self.framer, data, self.num_errors, self.name)
+
+    def connection_lost(self):
+        print "-- closing %s connection from %s" % (self.name, str(self.connection.address))
+        RECEIVER_QUEUES.pop(self.name, None)
+        RECEIVER_OPTIONS.pop(self.name, None)
+        REAPER.unregister(self.name)
+
+    def abort(self):
+        forget_receiver(self.name)
+        self.connection.abort()
 
 
 if __name__ == "__main__":
@@ -741,13 +1425,48 @@ if __name__ == "__main__":
     # Set the socket timeout to 60 secnds
     AIMSUN_LISTEN_SOCKET.settimeout(60)
 
-    # Create the multithreaded version of the server, binding to localhost on port 9999
-    SERVER = ThreadedTCPServer((host_ip_str, port_num), GantryRequest)
-    SERVER.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    REAPER.idle_timeout = get_config_option('controllers', 'idle_timeout', connection_reaper.DEFAULT_IDLE_TIMEOUT)
+    REAPER.write_timeout = get_config_option('controllers', 'write_timeout',
+                                             connection_reaper.DEFAULT_WRITE_TIMEOUT)
+    REAPER.start()
+
+    STATUS_CACHE.size = max(get_config_option('controllers', 'status_cache_size', status_cache.DEFAULT_SIZE), 1)
+    HISTORY.size = get_config_option('history', 'size', history.DEFAULT_SIZE)
+    HISTORY.max_bytes = int(get_config_option('history', 'memory_limit_mb', history.DEFAULT_MAX_BYTES / 1048576.0) *
+                            1048576)
+
+    command_workers = get_config_option('local', 'command_workers', 0)
+    if command_workers > 0:
+        COMMAND_POOL = multiprocessing.Pool(command_workers)
+        print 'Command stanzas are parsed by %d worker processes' % command_workers
+
+    server_mode = get_config_option('local', 'server_mode', SERVER_MODE_THREADED)
+    if server_mode == SERVER_MODE_EVENT:
+        # Serve all controller connections from a single event loop
+        SERVER = event_server.EventLoopServer((host_ip_str, port_num), GantryConnection)
+    else:
+        # Create the multithreaded version of the server, binding to localhost on port 9999
+        SERVER = ThreadedTCPServer((host_ip_str, port_num), GantryRequest)
+        SERVER.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    if get_config_option('measurements', 'persist', True):
+        MEASUREMENTS_WRITER = persistence.DocumentWriter(
+            LAST_MEASUREMENTS_FILE,
+            get_config_option('measurements', 'persist_interval', persistence.DEFAULT_MIN_INTERVAL), LOGGER)
+        linkstats.register('measurements_file', MEASUREMENTS_WRITER.get_stats)
+
+    http_port = get_config_option('http', 'port', 0)
+    if http_port > 0:
+        HTTP_GATEWAY = http_gateway.HttpGateway(
+            (get_config_option('http', 'host', ''), http_port), STATUS_CACHE)
+        HTTP_GATEWAY.start()
+        linkstats.register('http_gateway', HTTP_GATEWAY.get_stats)
+        print 'HTTP gateway for long_status viewers started on port %d' % http_port
 
     # server.timeout = 10
     # server.handle_request()
-    print 'SIRID server component started on %s:%d, waiting for connection.' % (host_ip_str, port_num)
+    print 'SIRID server component started on %s:%d (%s mode), waiting for connection.' % (
+        host_ip_str, port_num, server_mode)
 
     # Activate the server; this will keep running until you
     # interrupt the program with Ctrl-C
@@ -756,3 +1475,6 @@ if __name__ == "__main__":
         print 'clean server exit'
     except KeyboardInterrupt:
         print 'keyboard interrupt, exiting'
+    if MEASUREMENTS_WRITER is not None:
+        # Write the document still pending
+        MEASUREMENTS_WRITER.close(WRITER_JOIN_TIMEOUT)
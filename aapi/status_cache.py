@@ -0,0 +1,90 @@
+#
+# Cache of the recent long_status documents served to the controllers
+#
+# Every long_status document carries its sequence number in the <seq_nr> elements. A
+# controller may send the sequence number of the last document it has seen in its
+# get_long_status request; the server then replies with a short `not_modified` document if
+# there is nothing newer, or with the documents it missed as long as they are still in the
+# cache. The cache also keeps the encoded (compressed) variants of every document, so that
+# repeated requests within one detection interval cost no encoding and take no lock of the
+# fan-out.
+#
+import re
+import threading
+from collections import deque
+
+# Number of recent documents kept for controllers that missed some of them
+DEFAULT_SIZE = 4
+
+SEQ_NR_RE = re.compile(r'<seq_nr>\s*(\d+)\s*</seq_nr>')
+
+
+def not_modified(seq_nr):
+    """Return the reply telling a controller that `seq_nr` is still the latest document.
+
+    :rtype : str
+    """
+    return '<?xml version="1.0" encoding="UTF-8" ?><root msg="not_modified" seq_nr="%d"/>' % seq_nr
+
+
+def find_seq_nr(xml_string):
+    """Return the sequence number of a long_status document, or None if it has none."""
+    match = SEQ_NR_RE.search(xml_string)
+    if match is None:
+        return None
+    return int(match.group(1))
+
+
+class StatusCache(object):
+    """The last `size` long_status documents as `(seq_nr, xml_string, encoded)` entries,
+    oldest first, where `encoded` is a dictionary of the encoded variants of the document
+    filled in by the users of the cache. The sequence number may be None for a document of
+    unknown origin; such a document is never reported as not modified."""
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self._lock = threading.Lock()
+        self._entries = deque()
+        self.size = max(size, 1)
+
+    def add(self, seq_nr, xml_string):
+        """Add the newest document and return its entry.
+
+        :rtype : tuple
+        """
+        entry = (seq_nr, xml_string, {})
+        with self._lock:
+            self._entries.append(entry)
+            while len(self._entries) > self.size:
+                self._entries.popleft()
+        return entry
+
+    def latest(self):
+        """Return the entry of the newest document, or None if the cache is empty."""
+        with self._lock:
+            if not self._entries:
+                return None
+            return self._entries[-1]
+
+    def find(self, seq_nr):
+        """Return the entry of document `seq_nr`, or None if it is not in the cache."""
+        with self._lock:
+            for entry in self._entries:
+                if entry[0] is not None and entry[0] == seq_nr:
+                    return entry
+        return None
+
+    def newer_than(self, seq_nr):
+        """Return the entries of the documents newer than `seq_nr`, oldest first. If the
+        document `seq_nr` is no longer in the cache, only the newest entry is returned; an
+        empty list means that `seq_nr` is the newest document.
+
+        :rtype : list
+        """
+        with self._lock:
+            entries = list(self._entries)
+        if not entries:
+            return []
+        for pos in xrange(len(entries) - 1, -1, -1):
+            if entries[pos][0] is not None and entries[pos][0] == seq_nr:
+                return entries[pos + 1:]
+        return entries[-1:]
@@ -0,0 +1,182 @@
+#
+# Subscriptions of the controllers to parts of the long_status document
+#
+# A controller that handles only some gantry servers may subscribe to them with
+#
+#   <gantry msg="subscribe">
+#     <gantry_server>R01-R-MX20*</gantry_server>
+#     <device>20</device>
+#     <category>2</category>
+#   </gantry>
+#
+# Every element may be repeated; gantry server ids may contain shell-style wildcards. The
+# controller then gets only the matching <gantry> elements of every long_status document,
+# and of those only the listed devices and vehicle categories. A missing kind of element
+# means no restriction; `<gantry msg="subscribe"/>` subscribes to everything again.
+#
+# The documents of the subscribers are cut out of the pretty-printed long_status document
+# rendered once per detection interval: FragmentCache splits it into the fragments of the
+# gantry servers once and assembles the document of each subscription from them, caching the
+# filtered fragments and the assembled documents for subscribers with the same filter.
+#
+import fnmatch
+import re
+import threading
+
+ID_RE = re.compile(r' id="([^"]*)"')
+
+# Indentation of the elements in the pretty-printed long_status document
+GANTRY_INDENT = 2
+DEVICE_INDENT = 4
+CATEGORY_INDENT = 10
+
+
+class Subscription(object):
+    """Gantry server id patterns, device ids and category ids a controller subscribed to.
+    An empty tuple means no restriction."""
+
+    def __init__(self, gantry_servers=(), devices=(), categories=()):
+        self.gantry_servers = tuple(sorted(gantry_servers))
+        self.devices = tuple(sorted(devices))
+        self.categories = tuple(sorted(categories))
+        self._patterns = [re.compile(fnmatch.translate(pattern)) for pattern in self.gantry_servers]
+
+    def key(self):
+        """Return a hashable key that is the same for equal subscriptions."""
+        return self.gantry_servers, self.devices, self.categories
+
+    def is_everything(self):
+        return not (self.gantry_servers or self.devices or self.categories)
+
+    def matches_gantry_server(self, id_gantry_server):
+        if not self._patterns:
+            return True
+        for pattern in self._patterns:
+            if pattern.match(id_gantry_server):
+                return True
+        return False
+
+    def __repr__(self):
+        return 'Subscription(%s, %s, %s)' % (list(self.gantry_servers), list(self.devices), list(self.categories))
+
+
+def parse_subscription(root):
+    """Return the Subscription requested by a `<gantry msg="subscribe">` message.
+
+    :type root: Et.Element
+    :rtype : Subscription
+    """
+    values = {'gantry_server': [], 'device': [], 'category': []}
+    for node in root:
+        if node.tag not in values:
+            raise ValueError('Unsupported subscription element <%s>' % node.tag)
+        text = (node.text or '').strip()
+        if not text:
+            raise ValueError('Empty subscription element <%s>' % node.tag)
+        if node.tag != 'gantry_server':
+            # Device and category ids are numbers, normalise their text
+            text = str(int(text))
+        values[node.tag].append(text)
+    return Subscription(values['gantry_server'], values['device'], values['category'])
+
+
+def element_id(element):
+    """Return the `id` attribute of the element string, taken from its start tag."""
+    match = ID_RE.search(element, 0, element.find('>'))
+    if match is None:
+        return None
+    return match.group(1)
+
+
+def split_elements(text, tag, indent):
+    """Split a pretty-printed XML text at the elements <tag> indented by `indent` spaces.
+
+    Returns a list of `(is_element, id, string)` parts whose strings joined together give
+    the original text: the elements with their ids and the text between them.
+
+    :rtype : list
+    """
+    start_mark = '\n' + ' ' * indent + '<' + tag + ' '
+    end_mark = '\n' + ' ' * indent + '</' + tag + '>'
+    parts = []
+    pos = 0
+    while True:
+        start = text.find(start_mark, pos)
+        if start == -1:
+            parts.append((False, None, text[pos:]))
+            return parts
+        parts.append((False, None, text[pos:start]))
+        # The element ends with its end tag, or with its start tag if it is empty
+        line_end = text.find('\n', start + 1)
+        if line_end == -1:
+            line_end = len(text)
+        if text[start:line_end].rstrip().endswith('/>'):
+            end = line_end
+        else:
+            end = text.find(end_mark, start)
+            if end == -1:
+                raise ValueError('Unterminated element <%s> in the document' % tag)
+            end += len(end_mark)
+        element = text[start:end]
+        parts.append((True, element_id(element), element))
+        pos = end
+
+
+def filter_elements(text, tag, indent, ids):
+    """Return the text without the elements <tag> at `indent` whose id is not in `ids`."""
+    kept = []
+    for is_element, id_element, part in split_elements(text, tag, indent):
+        if not is_element or id_element in ids:
+            kept.append(part)
+    return ''.join(kept)
+
+
+class FragmentCache(object):
+    """The fragments of the gantry servers of a single long_status document and the documents
+    assembled from them for the subscriptions."""
+
+    def __init__(self, xml_string):
+        self.xml_string = xml_string
+        # Parts of the document, see `split_elements()`; the elements are the gantry servers
+        self.parts = split_elements(xml_string, 'gantry', GANTRY_INDENT)
+        self._lock = threading.Lock()
+        self._fragments = {}
+        self._documents = {}
+
+    def fragment(self, pos, devices, categories):
+        """Return the fragment of the gantry server in part `pos` restricted to the devices
+        and categories."""
+        key = (pos, devices, categories)
+        with self._lock:
+            if key in self._fragments:
+                return self._fragments[key]
+        fragment = self.parts[pos][2]
+        if devices:
+            fragment = filter_elements(fragment, 'device', DEVICE_INDENT, devices)
+        if categories:
+            fragment = filter_elements(fragment, 'category', CATEGORY_INDENT, categories)
+        with self._lock:
+            self._fragments[key] = fragment
+        return fragment
+
+    def document(self, subscription):
+        """Return the document for the subscription.
+
+        :type subscription: Subscription
+        """
+        if subscription is None or subscription.is_everything():
+            return self.xml_string
+        key = subscription.key()
+        with self._lock:
+            if key in self._documents:
+                return self._documents[key]
+        parts = []
+        for pos, (is_element, id_gantry_server, part) in enumerate(self.parts):
+            if not is_element:
+                parts.append(part)
+            elif subscription.matches_gantry_server(id_gantry_server):
+                parts.append(self.fragment(pos, subscription.devices, subscription.categories))
+        document = ''.join(parts)
+        with self._lock:
+            self._documents[key] = document
+        return document
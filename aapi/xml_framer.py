@@ -0,0 +1,274 @@
+#
+# Framing of the XML stanzas sent by the controllers to the SIRID server
+#
+# The controllers send a stream of back-to-back XML documents over a TCP connection without
+# any length prefix, each of them optionally starting with an XML declaration. A framer is
+# fed with the raw data as they arrive and returns the documents completed so far as a list
+# of `(root, xml_string)` tuples.
+#
+# StreamingXmlFramer pushes the data into an expat parser and builds the element tree while
+# the data arrive, so that every stanza is parsed exactly once. LegacyXmlFramer is the
+# original hand-written scanner that looks for the root tag and its closing counterpart; it
+# returns only the strings (root is None) which have to be parsed by the caller. It is kept
+# as a fallback and for `benchmark_xml_framer.py`.
+#
+# With `decode_commands` the streaming framer does not build the trees of command stanzas
+# (<root> documents); the caller decodes them with gantry_command.decode_command_stanza(),
+# which is faster than building the tree in Python.
+#
+import xml.etree.ElementTree as Et
+from xml.parsers import expat
+
+# Default upper limit of the size of a single XML document
+MAX_XML_SIZE = 16 * 1024 * 1024
+
+FRAMER_STREAMING = 'streaming'
+FRAMER_LEGACY = 'legacy'
+
+
+def make_framer(name, max_size=MAX_XML_SIZE, build_tree=True, decode_commands=False):
+    """Return a new framer of the given kind (FRAMER_STREAMING or FRAMER_LEGACY). With
+    `build_tree` False the streaming framer only checks and splits the documents and leaves
+    building the trees to the caller, like the legacy framer. With `decode_commands` it
+    leaves only the command stanzas to the caller."""
+    if name == FRAMER_STREAMING:
+        return StreamingXmlFramer(max_size, build_tree, decode_commands)
+    if name == FRAMER_LEGACY:
+        return LegacyXmlFramer(max_size)
+    raise ValueError("Unknown XML framer `%s`" % name)
+
+
+def find_document_start(data, start=0):
+    """Return the position of the first '<' in `data` that may start a document (an XML
+    declaration or an element), or -1."""
+    pos = data.find('<', start)
+    while pos != -1:
+        if pos + 1 == len(data) or data[pos + 1] == '?' or data[pos + 1].isalpha():
+            return pos
+        pos = data.find('<', pos + 1)
+    return -1
+
+
+class StreamingXmlFramer(object):
+    """Incremental framer based on the expat push parser.
+
+    A fresh parser is created for every document. When the root element closes, the document
+    is complete; whatever follows it in the data fed so far belongs to the next document and
+    is fed into a new parser. Malformed documents are reported in `errors` and skipped, the
+    framer then resynchronises at the next '<' that may start a document.
+
+    If `build_tree` is False, the documents are returned as `(None, xml_string)` tuples
+    without building their element trees. If `decode_commands` is True, this applies to the
+    command stanzas only.
+    """
+
+    def __init__(self, max_size=MAX_XML_SIZE, build_tree=True, decode_commands=False):
+        self.max_size = max_size
+        self.build_tree = build_tree
+        self.decode_commands = decode_commands
+        # Parse errors of the documents skipped so far, as `(message, xml_string)` tuples
+        self.errors = []
+        self._resync = False
+        self._new_parser()
+
+    def _new_parser(self):
+        self._parser = expat.ParserCreate()
+        # Python 2 expat returns unicode by default, ElementTree converts ASCII strings back
+        # to str; we keep UTF-8 encoded strings throughout
+        self._parser.returns_unicode = False
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start
+        self._parser.EndElementHandler = self._end
+        if self.build_tree:
+            self._parser.CharacterDataHandler = self._data
+        # The target of the parser events is chosen by the root element of the document
+        self._builder = None
+        self._depth = 0
+        # Data fed to the current parser, needed to split the stream at the end of the document
+        self._chunks = []
+        self._size = 0
+        # Position of the end of the root element in the data fed to the current parser
+        self._root_end_tag = None
+        self._root = None
+        self._complete = False
+
+    def _start(self, tag, attrib):
+        if self._depth == 0:
+            if self.build_tree and not (self.decode_commands and tag == 'root'):
+                self._builder = Et.TreeBuilder()
+        self._depth += 1
+        if self._builder is not None:
+            self._builder.start(tag, attrib)
+
+    def _end(self, tag):
+        self._depth -= 1
+        if self._builder is not None:
+            self._builder.end(tag)
+        if self._depth == 0:
+            if self._builder is not None:
+                self._root = self._builder.close()
+            self._complete = True
+            # Expat reports the start of the end tag of the root, or the position right after
+            # the root if it is an empty-element tag
+            self._root_end_tag = self._parser.CurrentByteIndex
+
+    def _data(self, text):
+        if self._builder is not None:
+            self._builder.data(text)
+
+    def feed(self, data):
+        """Feed the next part of the stream and return the list of `(root, xml_string)`
+        tuples of the documents completed by it.
+
+        :rtype : list
+        """
+        documents = []
+        while data:
+            if self._resync:
+                pos = find_document_start(data)
+                if pos == -1:
+                    return documents
+                data = data[pos:]
+                self._resync = False
+            if not self._size:
+                # An XML declaration is only allowed at the very beginning of the document
+                data = data.lstrip()
+                if not data:
+                    break
+            self._chunks.append(data)
+            self._size += len(data)
+            error = None
+            try:
+                self._parser.Parse(data, False)
+            except expat.ExpatError as e:
+                error = e
+            if self._complete:
+                # The document is complete. Anything after the root element, including the
+                # part that made the parser fail, is the beginning of the next document.
+                buffered = ''.join(self._chunks)
+                root_end = self._root_end_tag
+                if buffered.startswith('</', root_end):
+                    root_end = buffered.find('>', root_end) + 1
+                documents.append((self._root, buffered[:root_end]))
+                data = buffered[root_end:]
+                self._new_parser()
+            elif error is not None:
+                buffered = ''.join(self._chunks)
+                self.errors.append((str(error), buffered))
+                data = buffered[self._parser.ErrorByteIndex + 1:]
+                self._new_parser()
+                self._resync = True
+            elif self._size > self.max_size:
+                self.errors.append(('document exceeds %d bytes' % self.max_size, ''))
+                self._new_parser()
+                self._resync = True
+                break
+            else:
+                break
+        return documents
+
+
+class LegacyXmlFramer(object):
+    """The original framer of `GantryRequest.handle()`.
+
+    It looks for the first opening tag of an element, derives the closing tag from its name
+    and searches for it in the data received so far. The documents are returned as strings
+    and have to be parsed by the caller.
+    """
+
+    def __init__(self, max_size=MAX_XML_SIZE):
+        self.max_size = max_size
+        self.errors = []
+        # Current unprocessed data read from the request
+        self.data = ''
+        # No root tag has been found
+        self.no_root_tag = True
+        self.start_pos = 0
+        self.open_pos = 0
+        self.close_pos = 0
+        self.tag_name = None
+        self.closing_tag = None
+        self.closing_tag_len = 0
+        self.look_for_eet = True
+
+    def feed(self, buff):
+        """Feed the next part of the stream and return the list of `(None, xml_string)`
+        tuples of the documents completed by it.
+
+        :rtype : list
+        """
+        documents = []
+
+        # Sanity check: limit the buffer size
+        if len(self.data) > self.max_size:
+            self.data = ''
+
+        # Append the buffer to the existing data
+        self.data += buff
+
+        # Loop over the contents of `data`
+        while True:
+
+            # Loop over the contents of `data` until an opening tag has been found or until the
+            # buffer is exhausted and we shall read in the next part of the incoming message
+            while self.no_root_tag:
+                # Find the first opening tag
+                self.open_pos = self.data.find('<', self.start_pos)
+                if self.open_pos == -1:
+                    break
+                # We need to isolate the whole element first
+                self.close_pos = self.data.find('>', self.open_pos)
+                if self.close_pos == -1:
+                    break
+                # The element tag name is either in the format of <root> or <root attr="val">
+                sp_pos = self.data.find(' ', self.open_pos)
+                if 0 <= sp_pos < self.close_pos:
+                    self.tag_name = self.data[self.open_pos + 1:sp_pos]
+                else:
+                    self.tag_name = self.data[self.open_pos + 1:self.close_pos]
+                if self.tag_name[0].isalpha():
+                    # We have a root tag
+                    self.no_root_tag = False
+                # In any case the further search will start after the closing tag of the identified
+                # element
+                self.start_pos = self.close_pos
+
+            if self.no_root_tag:
+                # Do not search the already searched part of the buffer again
+                if self.open_pos == -1:
+                    self.start_pos = len(self.data)
+                else:
+                    self.start_pos = self.open_pos
+                # Signal the need to read another portion of the incoming message
+                return documents
+
+            # The test for empty-element tag shall occur only in the first round of testing
+            # right after the opening part of the tag has been identified.
+            if self.look_for_eet:
+                if self.data[self.close_pos - 1] == '/':
+                    # Empty-element tag
+                    documents.append((None, self.data[self.open_pos:self.close_pos + 1]))
+                    self.data = self.data[self.close_pos + 1:]
+                    self.no_root_tag = True
+                    self.start_pos = 0
+                    continue
+                else:
+                    self.closing_tag = '</' + self.tag_name + '>'
+                    self.closing_tag_len = len(self.closing_tag)
+                    self.look_for_eet = False
+
+            self.close_pos = self.data.find(self.closing_tag, self.close_pos)
+            if self.close_pos == -1:
+                # A part of the closing tag may have been already read
+                self.close_pos = len(self.data) - self.closing_tag_len
+                if self.close_pos < 0:
+                    self.close_pos = 0
+                return documents
+            else:
+                end_pos = self.close_pos + self.closing_tag_len
+                documents.append((None, self.data[self.open_pos:end_pos]))
+                # Discard the part of `data` that corresponds to the XML message
+                self.data = self.data[end_pos:]
+                self.no_root_tag = True
+                self.start_pos = 0
+                self.look_for_eet = True